@@ -54,30 +54,8 @@ def run_migration_multi_host_downtime_and_speed(test, params, env):
                                (self.sub_type))
 
 
-        def mig_finished(self, vm):
-            ret = True
-            if (vm.params["display"] == "spice" and
-                vm.get_spice_var("spice_seamless_migration") == "on"):
-                s = vm.monitor.info("spice")
-                if isinstance(s, str):
-                    ret = "migrated: true" in s
-                else:
-                    ret = s.get("migrated") == "true"
-            o = vm.monitor.info("migrate")
-            if isinstance(o, str):
-                return ret and (not "status: active" in o)
-            else:
-                return ret and (o.get("status") != "active")
-
-
         def wait_for_migration(self, vm, timeout):
-            if not utils_misc.wait_for(lambda: self.mig_finished(vm),
-                                       timeout,
-                                       2, 2,
-                                      "Waiting for migration to complete"):
-                raise virt_vm.VMMigrateTimeoutError("Timeout expired while"
-                                                    " waiting for migration"
-                                                    " to finish")
+            vm.wait_for_migration(timeout)
 
 
         def post_migration_downtime(self, vm, cancel_delay, mig_offline,
@@ -1,7 +1,7 @@
 import logging, os, time
 from autotest.client.shared import error
 from autotest.client import utils
-from virttest import utils_test, remote, virt_vm, utils_misc, kvm_monitor
+from virttest import utils_test, remote, utils_misc, kvm_monitor
 
 
 @error.context_aware
@@ -25,29 +25,6 @@ def run_migration_multi_host_firewall_block(test, params, env):
     sub_type = params.get("sub_type")
 
 
-    def wait_for_migration(vm, timeout):
-        def mig_finished():
-            ret = True
-            if (vm.params["display"] == "spice" and
-                vm.get_spice_var("spice_seamless_migration") == "on"):
-                s = vm.monitor.info("spice")
-                if isinstance(s, str):
-                    ret = "migrated: true" in s
-                else:
-                    ret = s.get("migrated") == "true"
-            o = vm.monitor.info("migrate")
-            if isinstance(o, str):
-                return ret and (not "status: active" in o)
-            else:
-                return ret and (o.get("status") != "active")
-
-        if not utils_misc.wait_for(mig_finished, timeout, 2, 2,
-                                  "Waiting for migration to complete"):
-            raise virt_vm.VMMigrateTimeoutError("Timeout expired while waiting "
-                                        "for migration to finish")
-
-
-
     class TestMultihostMigrationLongWait(base_class):
         def __init__(self, test, params, env):
             super(TestMultihostMigrationLongWait, self).__init__(test, params, env)
@@ -216,7 +193,7 @@ def run_migration_multi_host_firewall_block(test, params, env):
             session = vm.wait_for_login(timeout=self.login_timeout)
             session.cmd("killall cpuflags-test")
 
-            wait_for_migration(vm, self.mig_timeout)
+            vm.wait_for_migration(self.mig_timeout)
 
             self._hosts_barrier(self.hosts, mig_data.mig_id, 'mig_done',
                                 self.mig_timeout)
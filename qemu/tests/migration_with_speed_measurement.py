@@ -1,4 +1,4 @@
-import os, re, logging, time
+import os, logging, time
 from virttest import utils_misc
 from autotest.client.shared import error, utils
 
@@ -33,47 +33,31 @@ def run_migration_with_speed_measurement(test, params, env):
 
     vm_mem = int(params.get("mem", "512"))
 
-    get_mig_speed = re.compile("^transferred ram: (\d+) kbytes$",
-                               re.MULTILINE)
-
     mig_speed = params.get("mig_speed", "1G")
     mig_speed_accuracy = float(params.get("mig_speed_accuracy", "0.2"))
     clonevm = None
 
     def get_migration_statistic(vm):
-        last_transfer_mem = 0
-        transfered_mem = 0
-        mig_stat = utils.Statistic()
+        tracker = vm.get_migration_tracker()
         for _ in range(30):
-            o = vm.monitor.info("migrate")
-            warning_msg = ("Migration already ended. Migration speed is"
-                           " probably too high and will block vm while"
-                           " filling its memory.")
-            fail_msg = ("Could not determine the transferred memory from"
-                        " monitor data: %s" % o)
-            if isinstance(o, str):
-                if not "status: active" in o:
-                    raise error.TestWarn(warning_msg)
-                try:
-                    transfered_mem = int(get_mig_speed.search(o).groups()[0])
-                except (IndexError, ValueError):
-                    raise error.TestFail(fail_msg)
-            else:
-                if o.get("status") != "active":
-                    raise error.TestWarn(warning_msg)
-                try:
-                    transfered_mem = o.get("ram").get("transferred") / (1024)
-                except (IndexError, ValueError):
-                    raise error.TestFail(fail_msg)
-
-            real_mig_speed = (transfered_mem - last_transfer_mem) / 1024
-
-            last_transfer_mem = transfered_mem
+            sample = tracker.poll()
+            if not tracker.is_active():
+                raise error.TestWarn("Migration already ended. Migration "
+                                     "speed is probably too high and will "
+                                     "block vm while filling its memory.")
+            if sample["transferred"] is None:
+                raise error.TestFail("Could not determine the transferred "
+                                     "memory from monitor data: %s" % sample)
+            if sample["dirty_rate"] is not None:
+                logging.debug("Dirty pages rate: %s pages/s",
+                              sample["dirty_rate"])
+            time.sleep(1)
 
+        mig_stat = utils.Statistic()
+        for _, rate in tracker.get_transfer_rates():
+            real_mig_speed = rate / (1024 * 1024)
             logging.debug("Migration speed: %s MB/s" % (real_mig_speed))
             mig_stat.record(real_mig_speed)
-            time.sleep(1)
-
         return mig_stat
 
     try:
@@ -25,8 +25,50 @@ def handle_var(vm, params, varname):
     return True
 
 
+def get_barrier_matchers(lines, data_dir, params):
+    """
+    Create a ppm_utils.RegionMatcher for each barrier_2 command of a steps
+    file, reading each expected screendump only once.
+
+    @param lines: Lines of the steps file.
+    @param data_dir: Directory of the screendumps of the steps file.
+    @return: A dict mapping line indexes to matchers.
+    """
+    similarity = params.get("barrier_similarity")
+    if similarity:
+        similarity = float(similarity)
+    else:
+        similarity = None
+    max_distance = int(params.get("barrier_hash_distance", 5))
+    matchers = {}
+    screendump = None
+    for index, line in enumerate(lines):
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == "step":
+            screendump = None
+        elif words[0] == "screendump":
+            screendump = words[1]
+        elif words[0] == "barrier_2" and len(words) >= 7:
+            dx, dy, x1, y1 = map(int, words[1:5])
+            expected = None
+            if similarity is not None and screendump:
+                filename = os.path.join(data_dir, screendump)
+                try:
+                    expected = ppm_utils.PPMImage.from_file(filename)
+                except (IOError, ValueError), e:
+                    logging.warn("Could not read screendump %s: %s",
+                                 filename, e)
+            matchers[index] = ppm_utils.RegionMatcher(words[5], x1, y1,
+                                                      dx, dy, expected,
+                                                      similarity,
+                                                      max_distance)
+    return matchers
+
+
 def barrier_2(vm, words, params, debug_dir, data_scrdump_filename,
-              current_step_num):
+              current_step_num, matcher=None):
     if len(words) < 7:
         logging.error("Bad barrier_2 command line")
         return False
@@ -34,6 +76,8 @@ def barrier_2(vm, words, params, debug_dir, data_scrdump_filename,
     # Parse barrier command line
     _, dx, dy, x1, y1, md5sum, timeout = words[:7]
     dx, dy, x1, y1, timeout = map(int, [dx, dy, x1, y1, timeout])
+    if matcher is None:
+        matcher = ppm_utils.RegionMatcher(md5sum, x1, y1, dx, dy)
 
     # Define some paths
     scrdump_filename = os.path.join(debug_dir, "scrdump.ppm")
@@ -92,17 +136,15 @@ def barrier_2(vm, words, params, debug_dir, data_scrdump_filename,
             logging.warn(e)
             continue
 
-        # Read image file
-        (w, h, data) = ppm_utils.image_read_from_ppm_file(scrdump_filename)
-
-        # Make sure image is valid
-        if not ppm_utils.image_verify_ppm_file(scrdump_filename):
-            logging.warn("Got invalid screendump: dimensions: %dx%d, "
-                         "data size: %d", w, h, len(data))
+        # Read image file, making sure it is valid
+        try:
+            image = ppm_utils.PPMImage.from_file(scrdump_filename)
+        except ValueError, e:
+            logging.warn("Got invalid screendump: %s", e)
             continue
 
         # Compute md5sum of whole image
-        whole_image_md5sum = ppm_utils.image_md5sum(w, h, data)
+        whole_image_md5sum = image.md5sum()
 
         # Write screendump to history_dir (as JPG) if requested
         # and if the screendump differs from the previous one
@@ -122,10 +164,13 @@ def barrier_2(vm, words, params, debug_dir, data_scrdump_filename,
             except NameError:
                 pass
 
-        # Compare md5sum of barrier region with the expected md5sum
-        calced_md5sum = ppm_utils.get_region_md5sum(w, h, data, x1, y1, dx, dy,
-                                                    cropped_scrdump_filename)
-        if calced_md5sum == md5sum:
+        # Compare the barrier region with the expected one
+        image.crop(x1, y1, dx, dy).write(cropped_scrdump_filename)
+        matched, similarity = matcher.match(image)
+        if matched:
+            if similarity < 1.0:
+                logging.debug("Barrier region matched with %.4f similarity",
+                              similarity)
             # Success -- remove screendump history unless requested not to
             if keep_screendump_history and not keep_all_history:
                 shutil.rmtree(history_dir)
@@ -204,8 +249,11 @@ def run_steps(test, params, env):
     current_screendump = None
     skip_current_step = False
 
+    data_dir = ppm_utils.get_data_dir(steps_filename)
+    matchers = get_barrier_matchers(lines, data_dir, params)
+
     # Iterate over the lines in the file
-    for line in lines:
+    for index, line in enumerate(lines):
         line = line.strip()
         if not line:
             continue
@@ -233,13 +281,12 @@ def run_steps(test, params, env):
                 logging.error("Variable not defined: %s", words[1])
         elif words[0] == "barrier_2":
             if current_screendump:
-                scrdump_filename = os.path.join(
-                    ppm_utils.get_data_dir(steps_filename),
-                    current_screendump)
+                scrdump_filename = os.path.join(data_dir, current_screendump)
             else:
                 scrdump_filename = None
             if not barrier_2(vm, words, params, test.debugdir,
-                             scrdump_filename, current_step_num):
+                             scrdump_filename, current_step_num,
+                             matchers.get(index)):
                 skip_current_step = True
         else:
             vm.send_key(words[0])
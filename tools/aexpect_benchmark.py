@@ -0,0 +1,100 @@
+#!/usr/bin/python
+"""
+Benchmark of the pattern matching used by aexpect.Expect.
+
+Feeds synthetic command output (kernel build/dd like lines, followed by a
+shell prompt) in fixed size chunks to the incremental matchers used by
+read_until_output_matches() and read_until_last_line_matches(), and to the
+full rescan done for arbitrary filter functions, and reports the time spent
+per MB of output.  The incremental matchers should take constant time per
+MB as the output grows (read_until_output_matches() only matches
+incrementally patterns whose matches have a maximum width, so the prompt
+pattern used here has one).
+
+@copyright: Red Hat 2013
+"""
+import sys, time, optparse
+
+import common
+from virttest import aexpect
+
+
+PROMPT = "[root@localhost ~]# "
+LINE = "  CC      drivers/net/ethernet/intel/e1000/e1000_main.o\n"
+
+
+def get_chunks(size, chunk_size):
+    """
+    Return a list of chunks adding up to about size bytes of output, the
+    last one ending with a shell prompt.
+    """
+    chunk = (LINE * (chunk_size / len(LINE) + 1))[:chunk_size]
+    chunks = [chunk] * (size / chunk_size)
+    chunks.append("\n" + PROMPT)
+    return chunks
+
+
+def get_last_nonempty_line(cont):
+    nonempty_lines = [l for l in cont.splitlines() if l.strip()]
+    if nonempty_lines:
+        return nonempty_lines[-1]
+    else:
+        return ""
+
+
+def time_matcher(matcher, chunks):
+    """
+    Feed chunks to matcher, return the elapsed time.
+    """
+    start = time.time()
+    for chunk in chunks:
+        match = matcher.feed(chunk)
+    elapsed = time.time() - start
+    if match is None:
+        raise RuntimeError("%s did not find the prompt" %
+                           matcher.__class__.__name__)
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser("usage: %prog [options]")
+    parser.add_option("-s", "--sizes", dest="sizes", default="1,2,4,8,16",
+                      help="output sizes to test, in MB (default: %default)")
+    parser.add_option("-c", "--chunk-size", dest="chunk_size", type="int",
+                      default=4096,
+                      help="bytes per read (default: %default)")
+    parser.add_option("-m", "--max-rescan-size", dest="max_rescan_size",
+                      type="int", default=4,
+                      help="largest size (MB) to run the full rescan on, "
+                      "as it is quadratic (default: %default)")
+    options, args = parser.parse_args()
+
+    patterns = aexpect.compile_patterns([r"[\#\$] ?$"])
+    print "%8s %18s %18s %18s %18s" % ("size", "output (s/MB)",
+                                        "rescan (s/MB)", "last line (s/MB)",
+                                        "rescan (s/MB)")
+    for size in [int(s) for s in options.sizes.split(",")]:
+        chunks = get_chunks(size * 1024 * 1024, options.chunk_size)
+        results = [time_matcher(aexpect._OutputMatcher(patterns), chunks)]
+        if size <= options.max_rescan_size:
+            results.append(time_matcher(
+                aexpect._FilterMatcher(patterns, lambda x: x), chunks))
+        else:
+            results.append(None)
+        results.append(time_matcher(aexpect._LastLineMatcher(patterns),
+                                    chunks))
+        if size <= options.max_rescan_size:
+            results.append(time_matcher(
+                aexpect._FilterMatcher(patterns, get_last_nonempty_line),
+                chunks))
+        else:
+            results.append(None)
+
+        line = "%6dMB" % size
+        for result in results:
+            if result is None:
+                line += " %18s" % "-"
+            else:
+                line += " %18.4f" % (result / size)
+        print line
+        sys.stdout.flush()
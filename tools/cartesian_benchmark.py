@@ -0,0 +1,99 @@
+#!/usr/bin/python
+"""
+Benchmark of the cartesian config parser.
+
+Generates a synthetic config shaped like the real ones (a set of base
+parameters followed by a number of variants blocks, whose variants change
+those parameters, use conditional blocks and filter out some of the
+variants of the previous block), then reports the time spent parsing it and
+expanding it into dicts with a varying number of jobs.  The config only
+depends on the command line options, so results can be compared across
+changes of the parser.
+
+@copyright: Red Hat 2013
+"""
+import os, sys, time, optparse, tempfile
+
+import common
+from virttest import cartesian_config
+
+
+def generate_config(blocks, variants, keys):
+    """
+    Return the text of a synthetic config.
+
+    @param blocks: Number of variants blocks.
+    @param variants: Number of variants per block.
+    @param keys: Number of base parameters.
+    """
+    lines = []
+    for k in range(keys):
+        lines.append("key_%d = value_%d" % (k, k))
+    for b in range(blocks):
+        lines.append("variants:")
+        for v in range(variants):
+            lines.append("    - b%d_v%d:" % (b, v))
+            lines.append("        param_%d = v%d" % (b, v))
+            lines.append("        key_%d += _b%dv%d" % ((b + v) % keys, b, v))
+            lines.append("        key_%d = ${key_%d}/${shortname}" %
+                         ((b * variants + v) % keys, (b + v + 1) % keys))
+            if v == 0:
+                lines.append("        key_%d.* ?<= prefix_" % b)
+            if b > 0:
+                lines.append("        b%d_v%d:" % (b - 1, v))
+                lines.append("            cond_%d = yes" % b)
+                if v == variants - 1:
+                    lines.append("        no b%d_v0" % (b - 1))
+    return "\n".join(lines) + "\n"
+
+
+def time_expansion(filename, jobs):
+    """
+    Parse filename and expand it into dicts, returning the number of dicts
+    and the time spent on each step.
+    """
+    start = time.time()
+    parser = cartesian_config.Parser(filename, jobs=jobs)
+    parsed = time.time()
+    count = 0
+    for _ in parser.get_dicts():
+        count += 1
+    return count, parsed - start, time.time() - parsed
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser("usage: %prog [options]")
+    parser.add_option("-b", "--blocks", dest="blocks", type="int", default=6,
+                      help="number of variants blocks (default: %default)")
+    parser.add_option("-n", "--variants", dest="variants", type="int",
+                      default=5,
+                      help="variants per block (default: %default)")
+    parser.add_option("-k", "--keys", dest="keys", type="int", default=100,
+                      help="number of base parameters (default: %default)")
+    parser.add_option("-j", "--jobs", dest="jobs", default="1,2,4",
+                      help="numbers of jobs to expand the config with "
+                      "(default: %default)")
+    parser.add_option("-o", "--output", dest="output",
+                      help="just write the config to this file")
+    options, args = parser.parse_args()
+
+    config = generate_config(options.blocks, options.variants, options.keys)
+    if options.output:
+        output_file = open(options.output, "w")
+        output_file.write(config)
+        output_file.close()
+        sys.exit(0)
+
+    fd, filename = tempfile.mkstemp(suffix=".cfg")
+    try:
+        os.write(fd, config)
+        os.close(fd)
+        print "%6s %10s %10s %10s %12s" % ("jobs", "dicts", "parse (s)",
+                                           "expand (s)", "dicts/s")
+        for jobs in [int(j) for j in options.jobs.split(",")]:
+            count, parse_time, expand_time = time_expansion(filename, jobs)
+            print "%6d %10d %10.2f %10.2f %12.0f" % (jobs, count, parse_time,
+                                                     expand_time,
+                                                     count / expand_time)
+    finally:
+        os.unlink(filename)
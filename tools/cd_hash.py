@@ -2,6 +2,9 @@
 """
 Program that calculates several hashes for a given CD image.
 
+All the hashes are computed in a single pass over the file, and cached
+along with the ones used by the tests to verify the CD images.
+
 @copyright: Red Hat 2008-2009
 """
 
@@ -9,8 +12,11 @@ import os, sys, optparse, logging
 
 import common
 from autotest.client.shared import logging_manager
-from autotest.client import utils
-from virttest import utils_misc
+from virttest import utils_misc, data_dir
+
+
+DIGESTS = [("md5", 1024 * 1024), ("sha1", 1024 * 1024), ("md5", None),
+           ("sha1", None)]
 
 
 if __name__ == "__main__":
@@ -19,6 +25,9 @@ if __name__ == "__main__":
 
     logging_manager.configure_logging(utils_misc.VirtLoggingConfig())
 
+    digest_cache = utils_misc.FileDigestCache(os.path.join(
+                                data_dir.get_tmp_dir(), "file_digests"))
+
     if args:
         filenames = args
     else:
@@ -38,12 +47,10 @@ if __name__ == "__main__":
                              filename)
             continue
 
+        digests = digest_cache.get_digests(filename, DIGESTS)
         logging.info("Hash values for file %s", os.path.basename(filename))
-        logging.info("md5    (1m): %s", utils.hash_file(filename, 1024*1024,
-                                                        method="md5"))
-        logging.info("sha1   (1m): %s", utils.hash_file(filename, 1024*1024,
-                                                        method="sha1"))
-        logging.info("md5  (full): %s", utils.hash_file(filename, method="md5"))
-        logging.info("sha1 (full): %s", utils.hash_file(filename,
-                                                        method="sha1"))
+        logging.info("md5    (1m): %s", digests[("md5", 1024 * 1024)])
+        logging.info("sha1   (1m): %s", digests[("sha1", 1024 * 1024)])
+        logging.info("md5  (full): %s", digests[("md5", None)])
+        logging.info("sha1 (full): %s", digests[("sha1", None)])
         logging.info("")
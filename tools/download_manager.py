@@ -16,6 +16,9 @@ Downloads blobs defined in assets. Assets are .ini files that contain the
     uncompress_cmd (optionl) = Command that needs to be executed with the
         compressed file as a parameter
 
+The selected assets are downloaded concurrently. Interrupted downloads are
+resumed where they stopped the next time the asset is downloaded.
+
 @copyright: Red Hat 2012
 """
 import glob, os, sys, logging, time
@@ -61,9 +64,8 @@ def download_assets():
             logging.error("Invalid index(es), aborting...")
             sys.exit(1)
 
-    for idx in index_list:
-        asset_info = all_assets[idx]
-        bootstrap.download_file(asset_info['shortname'], interactive=True)
+    bootstrap.download_files([all_assets[idx]['shortname']
+                              for idx in index_list], interactive=True)
 
 if __name__ == "__main__":
     logging_manager.configure_logging(utils_misc.VirtLoggingConfig())
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+"""
+Benchmark of the PPM image functions used by the steps barriers.
+
+Compares ppm_utils.PPMImage (through the image_* functions built on it)
+with the original per pixel implementations, on synthetic screendumps of
+the given size: the md5sum of a cropped region, the fuzzy comparison and
+the green-red comparison image.  The results of both implementations are
+checked to be identical.
+
+@copyright: Red Hat 2013
+"""
+import sys, time, struct, random, optparse
+
+import common
+from virttest import ppm_utils
+
+
+def legacy_image_crop(width, height, data, x1, y1, dx, dy):
+    if x1 > width - 1: x1 = width - 1
+    if y1 > height - 1: y1 = height - 1
+    if dx > width - x1: dx = width - x1
+    if dy > height - y1: dy = height - y1
+    newdata = ""
+    index = (x1 + y1*width) * 3
+    for _ in range(dy):
+        newdata += data[index:(index+dx*3)]
+        index += width*3
+    return (dx, dy, newdata)
+
+
+def legacy_get_region_md5sum(width, height, data, x1, y1, dx, dy):
+    (cw, ch, cdata) = legacy_image_crop(width, height, data, x1, y1, dx, dy)
+    return ppm_utils.image_md5sum(cw, ch, cdata)
+
+
+def legacy_image_comparison(width, height, data1, data2):
+    newdata = ""
+    i = 0
+    while i < width*height*3:
+        pixel1_str = data1[i:i+3]
+        temp = struct.unpack("BBB", pixel1_str)
+        value1 = int((temp[0] + temp[1] + temp[2]) / 3)
+        pixel2_str = data2[i:i+3]
+        temp = struct.unpack("BBB", pixel2_str)
+        value2 = int((temp[0] + temp[1] + temp[2]) / 3)
+        value = int((value1 + value2) / 2)
+        value = 128 + value / 2
+        if pixel1_str == pixel2_str:
+            newpixel = [0, value, 0]
+        else:
+            newpixel = [value, 0, 0]
+        newdata += struct.pack("BBB", newpixel[0], newpixel[1], newpixel[2])
+        i += 3
+    return (width, height, newdata)
+
+
+def legacy_image_fuzzy_compare(width, height, data1, data2):
+    equal = 0.0
+    different = 0.0
+    i = 0
+    while i < width*height*3:
+        pixel1_str = data1[i:i+3]
+        pixel2_str = data2[i:i+3]
+        if pixel1_str == pixel2_str:
+            equal += 1.0
+        else:
+            different += 1.0
+        i += 3
+    return equal / (equal + different)
+
+
+def get_images(width, height, changes):
+    """
+    Return two images of the given size, differing in about the given
+    fraction of their pixels.
+    """
+    rand = random.Random(0)
+    data1 = "".join([chr(rand.randint(0, 255)) for _ in range(width * 3)])
+    data1 = data1 * height
+    data2 = bytearray(data1)
+    for _ in range(int(width * height * changes)):
+        data2[rand.randrange(len(data2))] = rand.randint(0, 255)
+    return data1, str(data2)
+
+
+def time_func(func, *args):
+    """
+    Call func(*args), return a tuple (result, elapsed time).
+    """
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser("usage: %prog [options]")
+    parser.add_option("-s", "--sizes", dest="sizes",
+                      default="320x200,640x480,1024x768",
+                      help="image sizes to test (default: %default)")
+    parser.add_option("-c", "--changes", dest="changes", type="float",
+                      default=0.1,
+                      help="fraction of pixels that differ between the "
+                      "compared images (default: %default)")
+    options, args = parser.parse_args()
+
+    if ppm_utils.numpy is None:
+        print "numpy not available, using the pure python implementation"
+    print "%10s %-10s %12s %12s %10s" % ("size", "function", "legacy (s)",
+                                         "new (s)", "speedup")
+    for size in options.sizes.split(","):
+        width, height = map(int, size.split("x"))
+        data1, data2 = get_images(width, height, options.changes)
+        region = (width / 8, height / 8, width * 3 / 4, height * 3 / 4)
+        benchmarks = [
+            ("crop", legacy_get_region_md5sum, ppm_utils.get_region_md5sum,
+             (width, height, data1) + region),
+            ("fuzzy", legacy_image_fuzzy_compare,
+             ppm_utils.image_fuzzy_compare, (width, height, data1, data2)),
+            ("compare", legacy_image_comparison, ppm_utils.image_comparison,
+             (width, height, data1, data2))]
+        for name, legacy_func, func, func_args in benchmarks:
+            legacy_result, legacy_time = time_func(legacy_func, *func_args)
+            result, new_time = time_func(func, *func_args)
+            if result != legacy_result:
+                raise RuntimeError("%s: results differ for size %s" %
+                                   (name, size))
+            print "%10s %-10s %12.4f %12.4f %9.1fx" % (
+                    size, name, legacy_time, new_time,
+                    legacy_time / max(new_time, 1e-6))
+            sys.stdout.flush()
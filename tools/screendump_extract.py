@@ -0,0 +1,79 @@
+#!/usr/bin/python
+"""
+Extract the screendumps kept in screendump archives (the screendumps_<vm>
+directories left in the test debug dir with keep_screendumps = yes) as
+numbered JPEG files, one per screendump taken, like 0001.jpg, 0002.jpg...
+
+Repeated screendumps are hard links to the file of their first occurrence,
+so extracting an archive takes about as much space as the archive itself.
+A timestamps file listing "<file> <time>" for each screendump is written
+along with the images.
+
+@copyright: Red Hat 2013
+"""
+import os, sys, optparse
+
+import common
+from virttest import screendump_archive
+
+
+def extract(archive_dir, output_dir):
+    """
+    Extract the screendumps of an archive.
+
+    @param archive_dir: Path of the archive directory.
+    @param output_dir: Directory where the images are written.
+    @return: The number of screendumps extracted.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    archive = screendump_archive.ScreendumpArchive(archive_dir)
+    first_filename = {}
+    timestamps = open(os.path.join(output_dir, "timestamps"), "w")
+    count = 0
+    try:
+        for timestamp, image_hash, data in archive.get_frames():
+            count += 1
+            filename = os.path.join(output_dir, "%04d.jpg" % count)
+            if os.path.exists(filename):
+                os.unlink(filename)
+            if image_hash in first_filename:
+                os.link(first_filename[image_hash], filename)
+            else:
+                fileobj = open(filename, "wb")
+                try:
+                    fileobj.write(data)
+                finally:
+                    fileobj.close()
+                first_filename[image_hash] = filename
+            timestamps.write("%s %.3f\n" % (os.path.basename(filename),
+                                            timestamp))
+    finally:
+        timestamps.close()
+    return count
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser("usage: %prog [options] archive_dir "
+                                   "[archive_dir...]")
+    parser.add_option("-o", "--output-dir", dest="output_dir",
+                      help="Write the images of each archive to a "
+                           "subdirectory (named after the archive) of this "
+                           "directory, instead of to the archive directory "
+                           "itself")
+    options, args = parser.parse_args()
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+
+    for archive_dir in args:
+        if not screendump_archive.is_archive(archive_dir):
+            print "%s: not a screendump archive, skipping" % archive_dir
+            continue
+        output_dir = archive_dir
+        if options.output_dir:
+            output_dir = os.path.join(options.output_dir, os.path.basename(
+                                            os.path.abspath(archive_dir)))
+        count = extract(archive_dir, output_dir)
+        print "%s: %d screendumps extracted to %s" % (archive_dir, count,
+                                                      output_dir)
@@ -5,7 +5,7 @@ A class and functions used for running and controlling child processes.
 @copyright: 2008-2009 Red Hat Inc.
 """
 
-import os, sys, pty, select, termios, fcntl
+import os, sys, pty, select, termios, fcntl, collections, time
 
 BASE_DIR = os.path.join('/tmp', 'aexpect_spawn')
 
@@ -54,6 +54,156 @@ def _get_reader_filename(base_dir, a_id, reader):
     return os.path.join(base_dir, "outpipe-%s-%s" % (reader, a_id))
 
 
+# Default size of the buffer kept for each reader of a session (0 means no
+# limit).  When a bounded reader falls behind by more than this, its oldest
+# unread output is dropped (and accounted for, see Spawn.get_dropped_bytes()).
+READER_BUFFER_SIZE = 0
+
+# Minimum interval (in seconds) between updates of the dropped bytes file of
+# a server
+DROPPED_UPDATE_INTERVAL = 1.0
+
+
+class _RingBuffer(object):
+    """
+    FIFO byte buffer holding at most size bytes (0 means no limit).  When
+    it's full the oldest data is dropped, and the number of dropped bytes is
+    kept in 'dropped'.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.dropped = 0
+        self._chunks = collections.deque()
+        self._len = 0
+
+
+    def __len__(self):
+        return self._len
+
+
+    def write(self, data):
+        """
+        Append data, dropping the oldest data if needed.
+        """
+        if not self.size:
+            if data:
+                self._chunks.append(data)
+                self._len += len(data)
+            return
+        if len(data) > self.size:
+            self.dropped += len(data) - self.size
+            data = data[-self.size:]
+        self._chunks.append(data)
+        self._len += len(data)
+        while self._len > self.size:
+            excess = self._len - self.size
+            chunk = self._chunks[0]
+            if len(chunk) <= excess:
+                self._chunks.popleft()
+                excess = len(chunk)
+            else:
+                self._chunks[0] = chunk[excess:]
+            self._len -= excess
+            self.dropped += excess
+
+
+    def read(self, size):
+        """
+        Remove and return up to size bytes from the start of the buffer.
+        """
+        parts = []
+        n = 0
+        while self._chunks and n < size:
+            chunk = self._chunks.popleft()
+            if n + len(chunk) > size:
+                self._chunks.appendleft(chunk[size - n:])
+                chunk = chunk[:size - n]
+            parts.append(chunk)
+            n += len(chunk)
+        self._len -= n
+        return "".join(parts)
+
+
+    def unread(self, data):
+        """
+        Put back data returned by read() that could not be consumed.
+        """
+        if data:
+            self._chunks.appendleft(data)
+            self._len += len(data)
+
+
+class _OutputFile(object):
+    """
+    The file the output of a session is written to.
+
+    If max_size is nonzero the file is rotated when it reaches max_size
+    bytes: up to max_backups previous files are kept, as filename.1 (the
+    newest) to filename.<max_backups>.
+    """
+    def __init__(self, filename, max_size=0, max_backups=1):
+        self.filename = filename
+        self.max_size = max_size
+        self.max_backups = max_backups
+        self.size = 0
+        self.fileobj = open(filename, "w")
+
+
+    def _rotate(self):
+        self.fileobj.close()
+        if self.max_backups:
+            for i in range(self.max_backups - 1, 0, -1):
+                backup = "%s.%d" % (self.filename, i)
+                if os.path.exists(backup):
+                    os.rename(backup, "%s.%d" % (self.filename, i + 1))
+            os.rename(self.filename, self.filename + ".1")
+        self.fileobj = open(self.filename, "w")
+        self.size = 0
+
+
+    def write(self, data):
+        while self.max_size and self.size + len(data) >= self.max_size:
+            n = self.max_size - self.size
+            self.fileobj.write(data[:n])
+            data = data[n:]
+            self._rotate()
+        self.fileobj.write(data)
+        self.fileobj.flush()
+        self.size += len(data)
+
+
+    def close(self):
+        self.fileobj.close()
+
+
+def _get_output_filenames(filename):
+    # Return the output files of a session, oldest first
+    filenames = [filename]
+    i = 1
+    while os.path.exists("%s.%d" % (filename, i)):
+        filenames.insert(0, "%s.%d" % (filename, i))
+        i += 1
+    return filenames
+
+
+def _get_dropped_filename(base_dir, a_id):
+    return os.path.join(base_dir, "dropped-%s" % a_id)
+
+
+def _set_pty_attrs(fd, echo):
+    # Set terminal echo on/off and disable pre- and post-processing
+    attr = termios.tcgetattr(fd)
+    attr[0] &= ~termios.INLCR
+    attr[0] &= ~termios.ICRNL
+    attr[0] &= ~termios.IGNCR
+    attr[1] &= ~termios.OPOST
+    if echo:
+        attr[3] |= termios.ECHO
+    else:
+        attr[3] &= ~termios.ECHO
+    termios.tcsetattr(fd, termios.TCSANOW, attr)
+
+
 # The following is the server part of the module.
 
 if __name__ == "__main__":
@@ -61,6 +211,8 @@ if __name__ == "__main__":
     echo = sys.stdin.readline().strip() == "True"
     readers = sys.stdin.readline().strip().split(",")
     command = sys.stdin.readline().strip() + " && echo %s > /dev/null" % a_id
+    output_size, output_backups, reader_buffer_size = [
+        int(s) for s in sys.stdin.readline().split()]
 
     # Define filenames to be used for communication
     (shell_pid_filename,
@@ -73,6 +225,7 @@ if __name__ == "__main__":
     # Populate the reader filenames list
     reader_filenames = [_get_reader_filename(BASE_DIR, a_id, reader)
                         for reader in readers]
+    dropped_filename = _get_dropped_filename(BASE_DIR, a_id)
 
     # Set $TERM = dumb
     os.putenv("TERM", "dumb")
@@ -86,19 +239,11 @@ if __name__ == "__main__":
         lock_server_running = _lock(lock_server_running_filename)
 
         # Set terminal echo on/off and disable pre- and post-processing
-        attr = termios.tcgetattr(shell_fd)
-        attr[0] &= ~termios.INLCR
-        attr[0] &= ~termios.ICRNL
-        attr[0] &= ~termios.IGNCR
-        attr[1] &= ~termios.OPOST
-        if echo:
-            attr[3] |= termios.ECHO
-        else:
-            attr[3] &= ~termios.ECHO
-        termios.tcsetattr(shell_fd, termios.TCSANOW, attr)
+        _set_pty_attrs(shell_fd, echo)
 
         # Open output file
-        output_file = open(output_filename, "w")
+        output_file = _OutputFile(output_filename, output_size,
+                                  output_backups)
         # Open input pipe
         os.mkfifo(inpipe_filename)
         inpipe_fd = os.open(inpipe_filename, os.O_RDWR)
@@ -118,7 +263,16 @@ if __name__ == "__main__":
         sys.stdout.flush()
 
         # Initialize buffers
-        buffers = ["" for reader in readers]
+        buffers = [_RingBuffer(reader_buffer_size) for reader in readers]
+        dropped = 0
+        dropped_time = 0
+
+        def write_dropped():
+            fileobj = open(dropped_filename + ".tmp", "w")
+            for reader, bfr in zip(readers, buffers):
+                fileobj.write("%s %d\n" % (reader, bfr.dropped))
+            fileobj.close()
+            os.rename(dropped_filename + ".tmp", dropped_filename)
 
         # Read from child and write to files/pipes
         while True:
@@ -130,8 +284,9 @@ if __name__ == "__main__":
             # If a reader pipe is ready for writing --
             for (i, fd) in enumerate(reader_fds):
                 if fd in w:
-                    bytes_written = os.write(fd, buffers[i])
-                    buffers[i] = buffers[i][bytes_written:]
+                    data = buffers[i].read(65536)
+                    bytes_written = os.write(fd, data)
+                    buffers[i].unread(data[bytes_written:])
             # If there's data to read from the child process --
             if shell_fd in r:
                 try:
@@ -144,9 +299,15 @@ if __name__ == "__main__":
                 # trouble and are normally not needed
                 data = data.replace("\r", "")
                 output_file.write(data)
-                output_file.flush()
-                for i in range(len(readers)):
-                    buffers[i] += data
+                for bfr in buffers:
+                    bfr.write(data)
+            # Let the client know if a slow reader lost some output (at
+            # most once per DROPPED_UPDATE_INTERVAL)
+            if (sum(bfr.dropped for bfr in buffers) != dropped and
+                time.time() - dropped_time >= DROPPED_UPDATE_INTERVAL):
+                dropped = sum(bfr.dropped for bfr in buffers)
+                dropped_time = time.time()
+                write_dropped()
             # If os.read() raised an exception or there was nothing to read --
             if check_termination or shell_fd not in r:
                 pid, status = os.waitpid(shell_pid, os.WNOHANG)
@@ -158,6 +319,10 @@ if __name__ == "__main__":
                 data = os.read(inpipe_fd, 1024)
                 os.write(shell_fd, data)
 
+        # Make sure the final dropped bytes counts are reported
+        if sum(bfr.dropped for bfr in buffers) != dropped:
+            write_dropped()
+
         # Write the exit status to a file
         fileobj = open(status_filename, "w")
         fileobj.write(str(status))
@@ -185,9 +350,390 @@ if __name__ == "__main__":
 
 # The following is the client part of the module.
 
-import subprocess, time, signal, re, threading, logging
+import subprocess, time, signal, re, threading, logging, errno, collections
+import sre_parse, sre_constants, pickle
 import utils_misc
 
+# Output limits of new sessions, see set_output_limits()
+_output_limits = (0, 1, READER_BUFFER_SIZE)
+
+
+def set_output_limits(output_size=0, output_backups=1,
+                      reader_buffer_size=READER_BUFFER_SIZE):
+    """
+    Set the limits of the output kept by new sessions.
+
+    The output file of a session (see Spawn.get_output()) is rotated when it
+    reaches output_size bytes, keeping output_backups previous files, so at
+    most (output_backups + 1) * output_size bytes are kept.  Output not yet
+    consumed by a reader (e.g. the expect functions or the Tail thread) is
+    buffered; by default without limit, but if reader_buffer_size is nonzero
+    a reader that falls behind by more than that many bytes loses its oldest
+    output (see Spawn.get_dropped_bytes()).
+
+    @param output_size: Maximum size of the output file (0 means no limit).
+    @param output_backups: Number of rotated output files to keep.
+    @param reader_buffer_size: Maximum size of the buffer of each reader
+            (0 means no limit).
+    """
+    global _output_limits
+    _output_limits = (output_size, output_backups, reader_buffer_size)
+
+
+def _make_pipe():
+    """
+    Return the (read, write) file descriptors of a new non-blocking pipe.
+    """
+    fds = os.pipe()
+    for fd in fds:
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    return fds
+
+
+def _select_readable(fds, timeout):
+    """
+    Wait up to timeout seconds (None means forever) for any of fds to become
+    readable, returning the readable ones.
+    """
+    if timeout is not None:
+        end_time = time.time() + timeout
+    while True:
+        try:
+            return select.select(fds, [], [], timeout)[0]
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+        if timeout is not None:
+            timeout = max(0, end_time - time.time())
+
+
+def _drain(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except OSError:
+        pass
+
+
+class _MuxSession(object):
+    """
+    A child process run by the multiplexer.  This is the in-process
+    counterpart of the server: output from the child's pty goes to the output
+    file and to one ring buffer per reader.
+
+    Readers wait for output with select() on a notification pipe, written
+    when their buffer stops being empty, and on a pipe closed when the
+    session is done.
+    """
+    def __init__(self, a_id, command, echo, readers, output_filename,
+                 output_limits):
+        output_size, output_backups, reader_buffer_size = output_limits
+        self.a_id = a_id
+        self.lock = threading.Lock()
+        self.buffers = dict((reader, _RingBuffer(reader_buffer_size))
+                            for reader in readers)
+        self.notify_fds = dict((reader, _make_pipe()) for reader in readers)
+        self.done_fds = _make_pipe()
+        self.status = None
+        self.done = False
+        self._eof = False
+        self.output_file = _OutputFile(output_filename, output_size,
+                                       output_backups)
+
+        command += " && echo %s > /dev/null" % a_id
+        (self.pid, self.fd) = pty.fork()
+        if self.pid == 0:
+            # Child process: run the command in a subshell
+            try:
+                os.environ["TERM"] = "dumb"
+                os.execv("/bin/sh", ["/bin/sh", "-c", command])
+            finally:
+                os._exit(1)
+        _set_pty_attrs(self.fd, echo)
+        # Don't leak the pty to the children of other sessions
+        fcntl.fcntl(self.fd, fcntl.F_SETFD,
+                    fcntl.fcntl(self.fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+    def handle_read(self):
+        """
+        Read available output from the child.  Return False on end of file.
+        """
+        try:
+            data = os.read(self.fd, 16384)
+        except OSError:
+            data = ""
+        if not data:
+            self._eof = True
+            return False
+        # Remove carriage returns from the data -- they often cause
+        # trouble and are normally not needed
+        data = data.replace("\r", "")
+        self.output_file.write(data)
+        self.lock.acquire()
+        try:
+            for reader, bfr in self.buffers.items():
+                was_empty = not bfr
+                bfr.write(data)
+                if was_empty:
+                    try:
+                        os.write(self.notify_fds[reader][1], "x")
+                    except OSError:
+                        # The pipe is full, so the reader was notified
+                        pass
+        finally:
+            self.lock.release()
+        return True
+
+
+    def check_status(self):
+        """
+        Collect the exit status of the child if it terminated, reading any
+        output left in the pty first.  Return True if the session is done.
+        """
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except OSError:
+            # Somebody else collected the child; the status is lost
+            pid, status = self.pid, None
+        if not pid:
+            return False
+        while not self._eof:
+            r, w, x = select.select([self.fd], [], [], 0)
+            if not r or not self.handle_read():
+                break
+        self.output_file.close()
+        self.lock.acquire()
+        try:
+            if status is not None:
+                self.status = os.WEXITSTATUS(status)
+            self.done = True
+            os.close(self.done_fds[1])
+        finally:
+            self.lock.release()
+        return True
+
+
+    def close_pty(self):
+        """
+        Close the pty of the child, once the multiplexer stopped polling it.
+        """
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+    def get_wait_fds(self, reader):
+        """
+        Return the file descriptors that become readable when output is
+        available to reader or when the session is done.
+        """
+        return [self.notify_fds[reader][0], self.done_fds[0]]
+
+
+    def wait_reader(self, reader, timeout):
+        """
+        Wait up to timeout seconds (None means forever) for output to be
+        available to reader.  Return True if there's output to read or the
+        session is done (in which case reading returns "").
+        """
+        bfr = self.buffers.get(reader)
+        if bfr is None:
+            return True
+        notify_fd = self.notify_fds[reader][0]
+        if timeout is not None:
+            end_time = time.time() + timeout
+        while True:
+            self.lock.acquire()
+            try:
+                if bfr or self.done:
+                    return True
+            finally:
+                self.lock.release()
+            if timeout is not None:
+                timeout = max(0, end_time - time.time())
+            readable = _select_readable(self.get_wait_fds(reader), timeout)
+            if not readable:
+                return False
+            # The notification may be stale (the output was read without
+            # waiting), so check the buffer again
+            if notify_fd in readable:
+                _drain(notify_fd)
+
+
+    def read(self, reader, size):
+        """
+        Return up to size bytes of output available to reader, without
+        blocking.
+        """
+        bfr = self.buffers.get(reader)
+        if bfr is None:
+            return ""
+        self.lock.acquire()
+        try:
+            return bfr.read(size)
+        finally:
+            self.lock.release()
+
+
+    def wait(self):
+        """
+        Wait for the session to finish and return the exit status.
+        """
+        while not self.done:
+            _select_readable([self.done_fds[0]], None)
+        return self.status
+
+
+    def close(self):
+        """
+        Close the pipes of the session, once it's done.
+        """
+        fds = [self.done_fds[0]]
+        for pipe_fds in self.notify_fds.values():
+            fds.extend(pipe_fds)
+        for fd in fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class _Multiplexer(object):
+    """
+    Runs the children of all multiplexed sessions from a single thread,
+    using epoll on their ptys.
+    """
+    def __init__(self):
+        self.pid = os.getpid()
+        self.sessions = {}
+        self._fds = {}
+        self._lock = threading.Lock()
+        self._epoll = select.epoll()
+        self._thread = threading.Thread(target=self._run,
+                                        name="aexpect_multiplexer")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+
+    def spawn(self, a_id, command, echo, readers, output_filename,
+              output_limits):
+        """
+        Run command in a new session and return the _MuxSession.
+        """
+        session = _MuxSession(a_id, command, echo, readers, output_filename,
+                              output_limits)
+        self._lock.acquire()
+        try:
+            self.sessions[a_id] = session
+            self._fds[session.fd] = session
+            self._epoll.register(session.fd, select.EPOLLIN)
+        finally:
+            self._lock.release()
+        return session
+
+
+    def get_session(self, a_id):
+        return self.sessions.get(a_id)
+
+
+    def remove(self, a_id):
+        self._lock.acquire()
+        try:
+            session = self.sessions.pop(a_id, None)
+        finally:
+            self._lock.release()
+        if session is not None:
+            session.close()
+
+
+    def _unregister(self, session):
+        self._lock.acquire()
+        try:
+            if self._fds.get(session.fd) is session:
+                del self._fds[session.fd]
+                self._epoll.unregister(session.fd)
+        finally:
+            self._lock.release()
+
+
+    def _run(self):
+        while True:
+            try:
+                events = self._epoll.poll(0.5)
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                session = self._fds.get(fd)
+                if session is not None and not session.handle_read():
+                    # The pty was closed; stop polling it and let
+                    # check_status() collect the child
+                    self._unregister(session)
+            self._lock.acquire()
+            try:
+                sessions = [s for s in self.sessions.values() if not s.done]
+            finally:
+                self._lock.release()
+            for session in sessions:
+                if session.check_status():
+                    # Close the pty only after unregistering it, as its fd
+                    # may be reused right away by a new session
+                    self._unregister(session)
+                    session.close_pty()
+
+
+_multiplexer = None
+_multiplexer_enabled = False
+_multiplexer_lock = threading.Lock()
+
+
+def use_multiplexer(enabled=True):
+    """
+    Choose how new sessions (Spawn and derived class instances) are run.
+
+    By default every session starts a server: a separate Python process that
+    relays the child's output to a file and to named pipes.  When the
+    multiplexer is enabled, new sessions are run by a single thread of the
+    current process instead, which polls the ptys of all children with epoll
+    and hands out their output through in-memory buffers; output of all Tail
+    instances is also dispatched by a single thread.
+
+    Multiplexed sessions only live as long as the process that started them
+    (their children get SIGHUP when it exits), so they can't be pickled.
+    Sessions that are pickled, e.g. the processes of VMs and other objects
+    kept in the env, must be created with multiplex=False, which starts a
+    server for them even when the multiplexer is enabled.
+
+    @param enabled: Whether to use the multiplexer for new sessions.
+    """
+    global _multiplexer_enabled
+    _multiplexer_enabled = enabled
+
+
+def _get_multiplexer():
+    global _multiplexer
+    _multiplexer_lock.acquire()
+    try:
+        # The multiplexer thread of a parent process doesn't exist in a
+        # forked child
+        if _multiplexer is None or _multiplexer.pid != os.getpid():
+            _multiplexer = _Multiplexer()
+        return _multiplexer
+    finally:
+        _multiplexer_lock.release()
+
+
+def _get_mux_session(a_id):
+    if _multiplexer is None or _multiplexer.pid != os.getpid():
+        return None
+    return _multiplexer.get_session(a_id)
+
+
 
 class ExpectError(Exception):
     def __init__(self, patterns, output):
@@ -273,7 +819,7 @@ class ShellStatusError(ShellError):
 
 
 def run_bg(command, termination_func=None, output_func=None, output_prefix="",
-           timeout=1.0):
+           timeout=1.0, multiplex=True):
     """
     Run command as a subprocess.  Call output_func with each line of output
     from the subprocess (prefixed by output_prefix).  Call termination_func
@@ -292,13 +838,16 @@ def run_bg(command, termination_func=None, output_func=None, output_prefix="",
             before passing it to stdout_func
     @param timeout: Time duration (in seconds) to wait for the subprocess to
             terminate before returning
+    @param multiplex: Whether the subprocess may be run by the multiplexer
+            (see use_multiplexer()).
 
     @return: A Tail object.
     """
     process = Tail(command=command,
                    termination_func=termination_func,
                    output_func=output_func,
-                   output_prefix=output_prefix)
+                   output_prefix=output_prefix,
+                   multiplex=multiplex)
 
     end_time = time.time() + timeout
     while time.time() < end_time and process.is_alive():
@@ -366,10 +915,15 @@ class Spawn:
     pexpect.
     When unpickled it automatically
     resumes _tail() if needed.
+
+    If the multiplexer is enabled (see use_multiplexer()) the child process
+    is run by the multiplexer thread instead of a server, and the readers are
+    in-memory buffers instead of named pipes.  Such instances can't be
+    pickled.
     """
 
     def __init__(self, command=None, a_id=None, auto_close=False, echo=False,
-                 linesep="\n"):
+                 linesep="\n", multiplex=True):
         """
         Initialize the class and run command as a child process.
 
@@ -384,6 +938,9 @@ class Spawn:
                 parameter has an effect only when starting a new server.
         @param linesep: Line separator to be appended to strings sent to the
                 child process by sendline().
+        @param multiplex: Whether the child process may be run by the
+                multiplexer, if it's enabled.  Must be False for instances
+                that will be pickled.
         """
         self.a_id = a_id or utils_misc.generate_random_string(8)
         self.log_file = None
@@ -417,6 +974,18 @@ class Spawn:
             (reader, _get_reader_filename(BASE_DIR, self.a_id, reader))
             for reader in self.readers)
 
+        # Run the command in the multiplexer, or attach to a session it runs
+        self.reader_fds = {}
+        if command and multiplex and _multiplexer_enabled:
+            self._mux_session = _get_multiplexer().spawn(self.a_id, command,
+                                                         echo, self.readers,
+                                                         self.output_filename,
+                                                         _output_limits)
+        else:
+            self._mux_session = _get_mux_session(self.a_id)
+        if self._mux_session:
+            return
+
         # Let the server know a client intends to open some pipes;
         # if the executed command terminates quickly, the server will wait for
         # the client to release the lock before exiting
@@ -434,12 +1003,12 @@ class Spawn:
             sub.stdin.write("%s\n" % echo)
             sub.stdin.write("%s\n" % ",".join(self.readers))
             sub.stdin.write("%s\n" % command)
+            sub.stdin.write("%d %d %d\n" % _output_limits)
             # Wait for the server to complete its initialization
             while not "Server %s ready" % self.a_id in sub.stdout.readline():
                 pass
 
         # Open the reading pipes
-        self.reader_fds = {}
         try:
             assert(_locked(self.lock_server_running_filename))
             for reader, filename in self.reader_filenames.items():
@@ -455,7 +1024,11 @@ class Spawn:
     # exclusively by the constructor call as specified in __getinitargs__().
 
     def __getstate__(self):
-        pass
+        if self._mux_session:
+            raise pickle.PicklingError("process %s is run by the aexpect "
+                                       "multiplexer and can't be pickled "
+                                       "(create it with multiplex=False)" %
+                                       self.a_id)
 
 
     def __setstate__(self, state):
@@ -510,6 +1083,36 @@ class Spawn:
         return self.reader_fds.get(reader)
 
 
+    def _wait_reader(self, reader, timeout):
+        """
+        Wait up to timeout seconds for the specified reader to become
+        readable.  Return True if it's readable (reading returns "" once the
+        process terminated).  Intended for use by derived classes.
+
+        @param reader: The name of the reader.
+        @param timeout: Time to wait (seconds).
+        """
+        if self._mux_session:
+            return self._mux_session.wait_reader(reader, timeout)
+        fd = self._get_fd(reader)
+        r, w, x = select.select([fd], [], [], timeout)
+        return fd in r
+
+
+    def _read_reader(self, reader, size):
+        """
+        Read up to size bytes from the specified reader.  Should only be
+        called after _wait_reader() returned True.  Intended for use by
+        derived classes.
+
+        @param reader: The name of the reader.
+        @param size: Maximum number of bytes to read.
+        """
+        if self._mux_session:
+            return self._mux_session.read(reader, size)
+        return os.read(self._get_fd(reader), size)
+
+
     def get_id(self):
         """
         Return the instance's a_id attribute, which may be used to access the
@@ -525,6 +1128,8 @@ class Spawn:
         Note: this may be the PID of the shell process running the user given
         command.
         """
+        if self._mux_session:
+            return self._mux_session.pid
         try:
             fileobj = open(self.shell_pid_filename, "r")
             pid = int(fileobj.read())
@@ -539,6 +1144,8 @@ class Spawn:
         Wait for the process to exit and return its exit status, or None
         if the exit status is not available.
         """
+        if self._mux_session:
+            return self._mux_session.wait()
         _wait(self.lock_server_running_filename)
         try:
             fileobj = open(self.status_filename, "r")
@@ -549,23 +1156,73 @@ class Spawn:
             return None
 
 
-    def get_output(self):
+    def get_output(self, last_n_bytes=None):
         """
         Return the STDOUT and STDERR output of the process so far.
+
+        If the output file was rotated (see set_output_limits()) only the
+        output kept in the current and backup files is returned.
+
+        @param last_n_bytes: Return only the last last_n_bytes bytes of the
+                output, or None to return all of it.
         """
+        output = []
         try:
-            fileobj = open(self.output_filename, "r")
-            output = fileobj.read()
-            fileobj.close()
-            return output
+            for filename in reversed(_get_output_filenames(
+                                                    self.output_filename)):
+                fileobj = open(filename, "r")
+                try:
+                    if last_n_bytes is None:
+                        output.append(fileobj.read())
+                        continue
+                    fileobj.seek(0, os.SEEK_END)
+                    size = fileobj.tell()
+                    fileobj.seek(max(0, size - last_n_bytes))
+                    data = fileobj.read(last_n_bytes)
+                    output.append(data)
+                    last_n_bytes -= len(data)
+                    if last_n_bytes <= 0:
+                        break
+                finally:
+                    fileobj.close()
         except Exception:
-            return ""
+            pass
+        output.reverse()
+        return "".join(output)
+
+
+    def get_dropped_bytes(self, reader):
+        """
+        Return the number of bytes of output that were dropped for a reader
+        because it was too slow to consume them (see set_output_limits()).
+
+        @param reader: The name of the reader.
+        """
+        if self._mux_session:
+            bfr = self._mux_session.buffers.get(reader)
+            if bfr is None:
+                return 0
+            return bfr.dropped
+        try:
+            fileobj = open(_get_dropped_filename(BASE_DIR, self.a_id), "r")
+            try:
+                for line in fileobj:
+                    name, dropped = line.split()
+                    if name == reader:
+                        return int(dropped)
+            finally:
+                fileobj.close()
+        except Exception:
+            pass
+        return 0
 
 
     def is_alive(self):
         """
         Return True if the process is running.
         """
+        if self._mux_session:
+            return not self._mux_session.done
         return _locked(self.lock_server_running_filename)
 
 
@@ -578,11 +1235,16 @@ class Spawn:
         # Kill it if it's alive
         if self.is_alive():
             utils_misc.kill_process_tree(self.get_pid(), sig)
-        # Wait for the server to exit
-        _wait(self.lock_server_running_filename)
+        # Wait for the server (or the multiplexed process) to exit
+        if self._mux_session:
+            self._mux_session.wait()
+        else:
+            _wait(self.lock_server_running_filename)
         # Call all cleanup routines
         for hook in self.close_hooks:
             hook(self)
+        if self._mux_session:
+            _get_multiplexer().remove(self.a_id)
         # Close reader file descriptors
         for fd in self.reader_fds.values():
             try:
@@ -591,7 +1253,9 @@ class Spawn:
                 pass
         self.reader_fds = {}
         # Remove all used files
-        for filename in (_get_filenames(BASE_DIR, self.a_id)):
+        for filename in (_get_filenames(BASE_DIR, self.a_id) +
+                         _get_output_filenames(self.output_filename)[:-1] +
+                         [_get_dropped_filename(BASE_DIR, self.a_id)]):
             try:
                 os.unlink(filename)
             except OSError:
@@ -613,6 +1277,13 @@ class Spawn:
 
         @param cont: String to send to the child process.
         """
+        if self._mux_session:
+            try:
+                while cont:
+                    cont = cont[os.write(self._mux_session.fd, cont):]
+            except Exception:
+                pass
+            return
         try:
             fd = os.open(self.inpipe_filename, os.O_RDWR)
             os.write(fd, cont)
@@ -640,6 +1311,7 @@ def kill_tail_threads():
     """
     global _thread_kill_requested
     _thread_kill_requested = True
+    _tail_dispatcher.wakeup()
     for t in threading.enumerate():
         if hasattr(t, "name") and t.name.startswith("tail_thread"):
             t.join(10)
@@ -663,7 +1335,8 @@ class Tail(Spawn):
 
     def __init__(self, command=None, a_id=None, auto_close=False, echo=False,
                  linesep="\n", termination_func=None, termination_params=(),
-                 output_func=None, output_params=(), output_prefix=""):
+                 output_func=None, output_params=(), output_prefix="",
+                 multiplex=True):
         """
         Initialize the class and run command as a child process.
 
@@ -689,6 +1362,8 @@ class Tail(Spawn):
         @param output_params: Parameters to send to output_func before the
                 output line.
         @param output_prefix: String to prepend to lines sent to output_func.
+        @param multiplex: Whether the child process may be run by the
+                multiplexer, if it's enabled (see Spawn.__init__()).
         """
         # Add a reader and a close hook
         self._add_reader("tail")
@@ -696,7 +1371,8 @@ class Tail(Spawn):
         self._add_close_hook(Tail._close_log_file)
 
         # Init the superclass
-        Spawn.__init__(self, command, a_id, auto_close, echo, linesep)
+        Spawn.__init__(self, command, a_id, auto_close, echo, linesep,
+                       multiplex)
 
         # Remember some attributes
         self.termination_func = termination_func
@@ -787,19 +1463,46 @@ class Tail(Spawn):
             utils_misc.close_log_file(self.log_file)
 
 
-    def _tail(self):
-        def print_line(text):
-            # Pre-pend prefix and remove trailing whitespace
-            text = self.output_prefix + text.rstrip()
-            # Pass text to output_func
-            try:
-                params = self.output_params + (text,)
-                self.output_func(*params)
-            except TypeError:
-                pass
+    def _print_line(self, text):
+        # Pre-pend prefix and remove trailing whitespace
+        text = self.output_prefix + text.rstrip()
+        # Pass text to output_func
+        try:
+            params = self.output_params + (text,)
+            self.output_func(*params)
+        except TypeError:
+            pass
+
+
+    def _tail_output(self, bfr):
+        # Send the output to output_func line by line (except for the last
+        # line), return the last line
+        if self.output_func:
+            lines = bfr.split("\n")
+            for line in lines[:-1]:
+                self._print_line(line)
+        last_newline_index = bfr.rfind("\n")
+        return bfr[last_newline_index+1:]
+
+
+    def _tail_terminated(self, bfr):
+        # The process terminated; print any remaining output
+        if bfr:
+            self._print_line(bfr)
+        # Get the exit status, print it and send it to termination_func
+        status = self.get_status()
+        if status is None:
+            return
+        self._print_line("(Process terminated with status %s)" % status)
+        try:
+            params = self.termination_params + (status,)
+            self.termination_func(*params)
+        except TypeError:
+            pass
+
 
+    def _tail(self):
         try:
-            fd = self._get_fd("tail")
             bfr = ""
             while True:
                 global _thread_kill_requested
@@ -807,47 +1510,56 @@ class Tail(Spawn):
                     return
                 try:
                     # See if there's any data to read from the pipe
-                    r, w, x = select.select([fd], [], [], 0.05)
+                    readable = self._wait_reader("tail", 0.05)
                 except Exception:
                     break
-                if fd in r:
+                if readable:
                     # Some data is available; read it
-                    new_data = os.read(fd, 1024)
+                    new_data = self._read_reader("tail", 1024)
                     if not new_data:
                         break
-                    bfr += new_data
-                    # Send the output to output_func line by line
-                    # (except for the last line)
-                    if self.output_func:
-                        lines = bfr.split("\n")
-                        for line in lines[:-1]:
-                            print_line(line)
-                    # Leave only the last line
-                    last_newline_index = bfr.rfind("\n")
-                    bfr = bfr[last_newline_index+1:]
+                    bfr = self._tail_output(bfr + new_data)
                 else:
                     # No output is available right now; flush the bfr
                     if bfr:
-                        print_line(bfr)
+                        self._print_line(bfr)
                         bfr = ""
-            # The process terminated; print any remaining output
-            if bfr:
-                print_line(bfr)
-            # Get the exit status, print it and send it to termination_func
-            status = self.get_status()
-            if status is None:
-                return
-            print_line("(Process terminated with status %s)" % status)
-            try:
-                params = self.termination_params + (status,)
-                self.termination_func(*params)
-            except TypeError:
-                pass
+            self._tail_terminated(bfr)
         finally:
             self.tail_thread = None
 
 
+    def _tail_step(self):
+        """
+        Report the output read by the multiplexer so far, without blocking.
+        Called by the Tail dispatcher (when there's new output, and while a
+        partial line is pending) instead of running _tail() in a thread.
+        Return False once the process terminated.
+        """
+        now = time.time()
+        if not self._wait_reader("tail", 0):
+            # No output is available right now; flush the bfr
+            if self._tail_bfr and now - self._tail_time >= 0.05:
+                self._print_line(self._tail_bfr)
+                self._tail_bfr = ""
+            return True
+        while self._wait_reader("tail", 0):
+            new_data = self._read_reader("tail", 16384)
+            if not new_data:
+                self._tail_terminated(self._tail_bfr)
+                return False
+            self._tail_bfr = self._tail_output(self._tail_bfr + new_data)
+        self._tail_time = now
+        return True
+
+
     def _start_thread(self):
+        if self._mux_session:
+            self._tail_bfr = ""
+            self._tail_time = time.time()
+            self._tail_done = threading.Event()
+            _tail_dispatcher.add(self)
+            return
         self.tail_thread = threading.Thread(target=self._tail,
                                             name="tail_thread_%s" % self.a_id)
         self.tail_thread.start()
@@ -858,10 +1570,340 @@ class Tail(Spawn):
         # (it's done this way because self.tail_thread may become None at any
         # time)
         t = self.tail_thread
-        if t:
+        if t and self._mux_session:
+            # The thread is the dispatcher; wait until it's done with self
+            if t is not threading.currentThread():
+                self._tail_done.wait()
+        elif t:
             t.join()
 
 
+class _TailDispatcher(object):
+    """
+    Reports the output of all multiplexed Tail instances from a single
+    thread, instead of a thread per instance.  The thread exits when there
+    are no instances left, or when kill_tail_threads() is called.
+    """
+    def __init__(self):
+        self.tails = []
+        self.thread = None
+        self._lock = threading.Lock()
+        self._wakeup_fds = None
+
+
+    def add(self, tail):
+        """
+        Start reporting the output of a Tail instance.
+        """
+        self._lock.acquire()
+        try:
+            if self._wakeup_fds is None:
+                self._wakeup_fds = _make_pipe()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               name="tail_thread_dispatcher")
+                self.thread.start()
+            tail.tail_thread = self.thread
+            self.tails.append(tail)
+        finally:
+            self._lock.release()
+        self.wakeup()
+
+
+    def wakeup(self):
+        """
+        Make the thread check its list of instances and kill requests.
+        """
+        if self._wakeup_fds is not None:
+            try:
+                os.write(self._wakeup_fds[1], "x")
+            except OSError:
+                pass
+
+
+    def _finish(self, tail):
+        self._lock.acquire()
+        try:
+            if tail in self.tails:
+                self.tails.remove(tail)
+        finally:
+            self._lock.release()
+        tail.tail_thread = None
+        tail._tail_done.set()
+
+
+    def _run(self):
+        while True:
+            self._lock.acquire()
+            try:
+                tails = list(self.tails)
+                if _thread_kill_requested or not tails:
+                    self.thread = None
+                    break
+            finally:
+                self._lock.release()
+            # Wait for output, for a process to terminate or for a partial
+            # line to be due (see Tail._tail_step())
+            fds = [self._wakeup_fds[0]]
+            timeout = None
+            for tail in tails:
+                try:
+                    running = tail._tail_step()
+                except Exception:
+                    logging.exception("Error reporting output of process %s",
+                                      tail.a_id)
+                    running = False
+                if not running:
+                    self._finish(tail)
+                    continue
+                fds.extend(tail._mux_session.get_wait_fds("tail"))
+                if tail._tail_bfr:
+                    timeout = 0.05
+            if len(fds) == 1:
+                # Every instance is done
+                continue
+            try:
+                readable = _select_readable(fds, timeout)
+            except select.error:
+                # A Tail was closed meanwhile
+                readable = []
+            if self._wakeup_fds[0] in readable:
+                _drain(self._wakeup_fds[0])
+        for tail in tails:
+            self._finish(tail)
+
+
+_tail_dispatcher = _TailDispatcher()
+
+
+def compile_patterns(patterns):
+    """
+    Compile a list of regular expression patterns for repeated matching.
+
+    None and empty strings (which are ignored when matching) become None.
+    Already compiled patterns are kept as they are, so the result can be
+    passed again to the read_until_*() functions of Expect.
+
+    @param patterns: List of strings (regular expression patterns) or
+            compiled pattern objects.
+    @return: List of compiled pattern objects (or None).
+    """
+    compiled = []
+    for pattern in patterns:
+        if not pattern:
+            compiled.append(None)
+        elif isinstance(pattern, basestring):
+            compiled.append(re.compile(pattern))
+        else:
+            compiled.append(pattern)
+    return compiled
+
+
+def _search_patterns(compiled_patterns, cont, pos=0):
+    """
+    Return the index of the first compiled pattern that matches a substring
+    of cont (starting at pos), or None.
+    """
+    for i, pattern in enumerate(compiled_patterns):
+        if pattern is not None and pattern.search(cont, pos):
+            return i
+
+
+class _FilterMatcher(object):
+    """
+    Match patterns against filter_func applied to all the output read so far.
+
+    Arbitrary filter functions can't be evaluated incrementally, so every
+    call to feed() filters and scans the whole output again.
+    """
+    def __init__(self, patterns, filter_func):
+        self.patterns = compile_patterns(patterns)
+        self.filter_func = filter_func
+        self._output = ""
+
+
+    def feed(self, data):
+        """
+        Add data to the output and return the index of the matching
+        pattern, or None.
+        """
+        self._output += data
+        return _search_patterns(self.patterns, self.filter_func(self._output))
+
+
+def _get_assertions_width(parsed):
+    """
+    Return the number of characters the assertions (lookaheads and
+    lookbehinds) of a parsed pattern may look at, on top of the match, or
+    None if there's no such maximum (or the pattern has backreferences).
+    """
+    width = 0
+    for op, av in parsed:
+        if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            extra = _get_assertions_width(av[1])
+            if extra is None:
+                return None
+            width += av[1].getwidth()[1] + extra
+        elif op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            return None
+        elif op == sre_constants.SUBPATTERN:
+            extra = _get_assertions_width(av[-1])
+            if extra is None:
+                return None
+            width += extra
+        elif op == sre_constants.BRANCH:
+            extras = [_get_assertions_width(p) for p in av[1]]
+            if None in extras:
+                return None
+            width += max(extras)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            extra = _get_assertions_width(av[2])
+            if extra is None:
+                return None
+            if extra:
+                width += extra * av[1]
+    if width >= sre_constants.MAXREPEAT:
+        return None
+    return width
+
+
+def _get_match_width(pattern):
+    """
+    Return the maximum number of characters a compiled pattern looks at to
+    find a match, or None if there's no such maximum.
+    """
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+        width = parsed.getwidth()[1]
+        extra = _get_assertions_width(parsed)
+    except Exception:
+        return None
+    if extra is None or width >= sre_constants.MAXREPEAT:
+        return None
+    return width + extra
+
+
+class _OutputMatcher(object):
+    """
+    Match patterns against all the output read so far.
+
+    A new match has to look at some of the new data, so a pattern whose
+    matches (including lookaheads and lookbehinds) have a maximum width is
+    only searched for in the new data plus that many characters of the
+    previous data.  Patterns without a maximum (e.g. r'\s*$') are searched
+    for in the whole output every time.
+    """
+    def __init__(self, patterns):
+        self.patterns = compile_patterns(patterns)
+        self._widths = []
+        for pattern in self.patterns:
+            if pattern is None:
+                self._widths.append(0)
+            else:
+                self._widths.append(_get_match_width(pattern))
+        # Characters of output kept for the next search, which also give
+        # context to the lookbehinds, '^' and \b of the patterns searched
+        # from a position inside them
+        if None in self._widths:
+            self._keep = None
+        else:
+            self._keep = 2 * (max(self._widths or [0]) + 2)
+        self._window = ""
+
+
+    def feed(self, data):
+        """
+        Add data to the output and return the index of the matching
+        pattern, or None.
+        """
+        window = self._window + data
+        start = len(self._window)
+        match = None
+        for i, pattern in enumerate(self.patterns):
+            if pattern is None:
+                continue
+            width = self._widths[i]
+            if width is None:
+                pos = 0
+            else:
+                # A match starting before pos would look at the same
+                # characters it looked at in the previous search
+                pos = max(0, start - width - 2)
+            if pattern.search(window, pos):
+                match = i
+                break
+        if self._keep is not None and len(window) > self._keep:
+            window = window[-self._keep:]
+        self._window = window
+        return match
+
+
+class _LastWordMatcher(object):
+    """
+    Match patterns against the last word of the output read so far, keeping
+    track of the last word as data arrives.
+    """
+    def __init__(self, patterns):
+        self.patterns = compile_patterns(patterns)
+        self._last_word = ""
+        self._in_word = False
+
+
+    def feed(self, data):
+        """
+        Add data to the output and return the index of the matching
+        pattern, or None.
+        """
+        words = data.split()
+        if words:
+            # A word may continue a word that ended the previous data
+            if len(words) == 1 and self._in_word and not data[0].isspace():
+                self._last_word += words[0]
+            else:
+                self._last_word = words[-1]
+        if data:
+            self._in_word = not data[-1].isspace()
+        return _search_patterns(self.patterns, self._last_word)
+
+
+class _LastLineMatcher(object):
+    """
+    Match patterns against the last non-empty line of the output read so
+    far, keeping track of the last line as data arrives.
+    """
+    def __init__(self, patterns):
+        self.patterns = compile_patterns(patterns)
+        # The last complete non-empty line and the (possibly empty) text
+        # following the last line break
+        self._last_line = ""
+        self._partial = ""
+
+
+    def feed(self, data):
+        """
+        Add data to the output and return the index of the matching
+        pattern, or None.
+        """
+        # Empty lines are ignored, so a '\r\n' split between two reads
+        # doesn't need special treatment
+        data = data.replace("\r", "\n")
+        index = data.rfind("\n")
+        if index < 0:
+            self._partial += data
+        else:
+            lines = (self._partial + data[:index]).split("\n")
+            for line in reversed(lines):
+                if line.strip():
+                    self._last_line = line
+                    break
+            self._partial = data[index + 1:]
+        if self._partial.strip():
+            line = self._partial
+        else:
+            line = self._last_line
+        return _search_patterns(self.patterns, line)
+
+
 class Expect(Tail):
     """
     This class runs a child process in the background and provides expect-like
@@ -872,7 +1914,8 @@ class Expect(Tail):
 
     def __init__(self, command=None, a_id=None, auto_close=True, echo=False,
                  linesep="\n", termination_func=None, termination_params=(),
-                 output_func=None, output_params=(), output_prefix=""):
+                 output_func=None, output_params=(), output_prefix="",
+                 multiplex=True):
         """
         Initialize the class and run command as a child process.
 
@@ -898,6 +1941,8 @@ class Expect(Tail):
         @param output_params: Parameters to send to output_func before the
                 output line.
         @param output_prefix: String to prepend to lines sent to output_func.
+        @param multiplex: Whether the child process may be run by the
+                multiplexer, if it's enabled (see Spawn.__init__()).
         """
         # Add a reader
         self._add_reader("expect")
@@ -905,7 +1950,7 @@ class Expect(Tail):
         # Init the superclass
         Tail.__init__(self, command, a_id, auto_close, echo, linesep,
                       termination_func, termination_params,
-                      output_func, output_params, output_prefix)
+                      output_func, output_params, output_prefix, multiplex)
 
 
     def __getinitargs__(self):
@@ -926,22 +1971,22 @@ class Expect(Tail):
         end_time = None
         if timeout:
             end_time = time.time() + timeout
-        fd = self._get_fd("expect")
-        data = ""
+        data = []
         while True:
             try:
-                r, w, x = select.select([fd], [], [], internal_timeout)
+                readable = self._wait_reader("expect", internal_timeout)
             except Exception:
-                return data
-            if fd in r:
-                new_data = os.read(fd, 1024)
+                break
+            if readable:
+                new_data = self._read_reader("expect", 16384)
                 if not new_data:
-                    return data
-                data += new_data
+                    break
+                data.append(new_data)
             else:
-                return data
+                break
             if end_time and time.time() > end_time:
-                return data
+                break
+        return "".join(data)
 
 
     def match_patterns(self, cont, patterns):
@@ -952,51 +1997,31 @@ class Expect(Tail):
         None and empty strings in patterns are ignored.
         If no match is found, return None.
 
-        @param patterns: List of strings (regular expression patterns).
+        @param patterns: List of strings (regular expression patterns) or
+                compiled patterns (see compile_patterns()).
         """
-        for i in range(len(patterns)):
-            if not patterns[i]:
-                continue
-            if re.search(patterns[i], cont):
-                return i
+        return _search_patterns(compile_patterns(patterns), cont)
 
 
-    def read_until_output_matches(self, patterns, filter_func=lambda x: x,
-                                  timeout=60, internal_timeout=None,
-                                  print_func=None):
+    def _read_until_matches(self, patterns, matcher, timeout,
+                            internal_timeout, print_func):
         """
-        Read using read_nonblocking until a match is found using match_patterns,
-        or until timeout expires. Before attempting to search for a match, the
-        data is filtered using the filter_func function provided.
+        Read using read_nonblocking and feed the data to matcher until it
+        reports a match, or until timeout expires.
 
-        @brief: Read from child using read_nonblocking until a pattern
-                matches.
-        @param patterns: List of strings (regular expression patterns)
-        @param filter_func: Function to apply to the data read from the child before
-                attempting to match it against the patterns (should take and
-                return a string)
-        @param timeout: The duration (in seconds) to wait until a match is
-                found
-        @param internal_timeout: The timeout to pass to read_nonblocking
-        @param print_func: A function to be used to print the data being read
-                (should take a string parameter)
-        @return: Tuple containing the match index and the data read so far
-        @raise ExpectTimeoutError: Raised if timeout expires
-        @raise ExpectProcessTerminatedError: Raised if the child process
-                terminates while waiting for output
-        @raise ExpectError: Raised if an unknown error occurs
+        See read_until_output_matches() for the parameters, return value
+        and exceptions.
         """
-        fd = self._get_fd("expect")
-        o = ""
+        o = []
         end_time = time.time() + timeout
         while True:
             try:
-                r, w, x = select.select([fd], [], [],
-                                        max(0, end_time - time.time()))
+                readable = self._wait_reader("expect",
+                                             max(0, end_time - time.time()))
             except (select.error, TypeError):
                 break
-            if not r:
-                raise ExpectTimeoutError(patterns, o)
+            if not readable:
+                raise ExpectTimeoutError(patterns, "".join(o))
             # Read data from child
             data = self.read_nonblocking(internal_timeout,
                                          end_time - time.time())
@@ -1007,11 +2032,12 @@ class Expect(Tail):
                 for line in data.splitlines():
                     print_func(line)
             # Look for patterns
-            o += data
-            match = self.match_patterns(filter_func(o), patterns)
+            o.append(data)
+            match = matcher.feed(data)
             if match is not None:
-                return match, o
+                return match, "".join(o)
 
+        o = "".join(o)
         # Check if the child has terminated
         if utils_misc.wait_for(lambda: not self.is_alive(), 5, 0, 0.1):
             raise ExpectProcessTerminatedError(patterns, self.get_status(), o)
@@ -1020,6 +2046,45 @@ class Expect(Tail):
             raise ExpectError(patterns, o)
 
 
+    def read_until_output_matches(self, patterns, filter_func=None,
+                                  timeout=60, internal_timeout=None,
+                                  print_func=None):
+        """
+        Read using read_nonblocking until a match is found using match_patterns,
+        or until timeout expires. Before attempting to search for a match, the
+        data is filtered using the filter_func function provided.
+
+        Without filter_func the output is matched incrementally: patterns
+        whose matches have a maximum width are only searched for near the
+        new data.  With filter_func the whole output is filtered and scanned
+        again on every read.
+
+        @brief: Read from child using read_nonblocking until a pattern
+                matches.
+        @param patterns: List of strings (regular expression patterns) or
+                compiled patterns (see compile_patterns())
+        @param filter_func: Function to apply to the data read from the child before
+                attempting to match it against the patterns (should take and
+                return a string), or None to match the output as it is
+        @param timeout: The duration (in seconds) to wait until a match is
+                found
+        @param internal_timeout: The timeout to pass to read_nonblocking
+        @param print_func: A function to be used to print the data being read
+                (should take a string parameter)
+        @return: Tuple containing the match index and the data read so far
+        @raise ExpectTimeoutError: Raised if timeout expires
+        @raise ExpectProcessTerminatedError: Raised if the child process
+                terminates while waiting for output
+        @raise ExpectError: Raised if an unknown error occurs
+        """
+        if filter_func is None:
+            matcher = _OutputMatcher(patterns)
+        else:
+            matcher = _FilterMatcher(patterns, filter_func)
+        return self._read_until_matches(patterns, matcher, timeout,
+                                        internal_timeout, print_func)
+
+
     def read_until_last_word_matches(self, patterns, timeout=60,
                                      internal_timeout=None, print_func=None):
         """
@@ -1038,15 +2103,8 @@ class Expect(Tail):
                 terminates while waiting for output
         @raise ExpectError: Raised if an unknown error occurs
         """
-        def get_last_word(cont):
-            if cont:
-                return cont.split()[-1]
-            else:
-                return ""
-
-        return self.read_until_output_matches(patterns, get_last_word,
-                                              timeout, internal_timeout,
-                                              print_func)
+        return self._read_until_matches(patterns, _LastWordMatcher(patterns),
+                                        timeout, internal_timeout, print_func)
 
 
     def read_until_last_line_matches(self, patterns, timeout=60,
@@ -1072,16 +2130,8 @@ class Expect(Tail):
                 terminates while waiting for output
         @raise ExpectError: Raised if an unknown error occurs
         """
-        def get_last_nonempty_line(cont):
-            nonempty_lines = [l for l in cont.splitlines() if l.strip()]
-            if nonempty_lines:
-                return nonempty_lines[-1]
-            else:
-                return ""
-
-        return self.read_until_output_matches(patterns, get_last_nonempty_line,
-                                              timeout, internal_timeout,
-                                              print_func)
+        return self._read_until_matches(patterns, _LastLineMatcher(patterns),
+                                        timeout, internal_timeout, print_func)
 
 
 class ShellSession(Expect):
@@ -1097,7 +2147,8 @@ class ShellSession(Expect):
     def __init__(self, command=None, a_id=None, auto_close=True, echo=False,
                  linesep="\n", termination_func=None, termination_params=(),
                  output_func=None, output_params=(), output_prefix="",
-                 prompt=r"[\#\$]\s*$", status_test_command="echo $?"):
+                 prompt=r"[\#\$]\s*$", status_test_command="echo $?",
+                 multiplex=True):
         """
         Initialize the class and run command as a child process.
 
@@ -1127,11 +2178,13 @@ class ShellSession(Expect):
         @param status_test_command: Command to be used for getting the last
                 exit status of commands run inside the shell (used by
                 cmd_status_output() and friends).
+        @param multiplex: Whether the child process may be run by the
+                multiplexer, if it's enabled (see Spawn.__init__()).
         """
         # Init the superclass
         Expect.__init__(self, command, a_id, auto_close, echo, linesep,
                         termination_func, termination_params,
-                        output_func, output_params, output_prefix)
+                        output_func, output_params, output_prefix, multiplex)
 
         # Remember some attributes
         self.prompt = prompt
@@ -0,0 +1,311 @@
+#!/usr/bin/python
+import unittest, re, time, pickle, os, shutil, tempfile
+import common
+import aexpect
+
+
+def feed_all(matcher, chunks):
+    """
+    Feed chunks to matcher, return the index of the chunk and of the pattern
+    of the first match, or None.
+    """
+    for i, chunk in enumerate(chunks):
+        match = matcher.feed(chunk)
+        if match is not None:
+            return i, match
+    return None
+
+
+class OutputMatcherTest(unittest.TestCase):
+    def test_match_width(self):
+        width = lambda p: aexpect._get_match_width(re.compile(p))
+        self.assertEqual(width(r"abc"), 3)
+        self.assertEqual(width(r"a{2,5}$"), 5)
+        self.assertEqual(width(r"(?<=ab)c(?!de)"), 5)
+        self.assertEqual(width(r"(x|yy(?=z))"), 3)
+        self.assertEqual(width(r"\s*$"), None)
+        self.assertEqual(width(r"(a)\1"), None)
+
+
+    def test_split_match(self):
+        matcher = aexpect._OutputMatcher([r"foo", r"login:"])
+        self.assertEqual(feed_all(matcher, ["xx lo", "g", "in", ": x"]),
+                         (3, 1))
+
+
+    def test_window_boundary(self):
+        # The part of the match read first is far behind the new data
+        chunks = ["a" * 100000 + "(?", "b" * 50000, ")"]
+        matcher = aexpect._OutputMatcher([r"\(\?b{50000}\)"])
+        self.assertEqual(feed_all(matcher, chunks), (2, 0))
+        matcher = aexpect._OutputMatcher([r"\(\?b{50001}\)"])
+        self.assertEqual(feed_all(matcher, chunks), None)
+
+
+    def test_long_match(self):
+        chunks = ["start\n"] + ["x" * 4096] * 10 + ["\nend"]
+        matcher = aexpect._OutputMatcher([r"^start\s+x+\s+end$"])
+        self.assertEqual(feed_all(matcher, chunks), (11, 0))
+
+
+    def test_context(self):
+        # The lookbehind, '^' and \b of a match starting in the new data
+        # look at the data read before it
+        chunks = ["y" * 10000 + "\nab", "c"]
+        matcher = aexpect._OutputMatcher([r"(?<=b)c", r"^c", r"\bc"])
+        self.assertEqual(feed_all(matcher, chunks), (1, 0))
+        matcher = aexpect._OutputMatcher([r"^c", r"\bc", r"(?m)^ab"])
+        self.assertEqual(feed_all(matcher, chunks), (0, 2))
+        matcher = aexpect._OutputMatcher([r"^c", r"\bc", r"y(?=\nabc)"])
+        self.assertEqual(feed_all(matcher, chunks), (1, 2))
+
+
+    def test_patterns_order(self):
+        matcher = aexpect._OutputMatcher(["", None, r"b", r"a"])
+        self.assertEqual(matcher.feed("ab"), 2)
+
+
+class LastLineMatcherTest(unittest.TestCase):
+    def test_split_lines(self):
+        matcher = aexpect._LastLineMatcher([r"^\$ $", r"done"])
+        self.assertEqual(feed_all(matcher, ["output\r", "\n$ ", "\n\n"]),
+                         (1, 0))
+        matcher = aexpect._LastLineMatcher([r"^\$ $", r"done"])
+        self.assertEqual(feed_all(matcher, ["do", "ne\nmore", "\n"]), None)
+        self.assertEqual(matcher.feed("\nall do"), None)
+        self.assertEqual(matcher.feed("ne"), 1)
+
+
+class LastWordMatcherTest(unittest.TestCase):
+    def test_split_words(self):
+        matcher = aexpect._LastWordMatcher([r"^password:$"])
+        self.assertEqual(feed_all(matcher, ["pass", "word", ": ", "\n"]),
+                         (2, 0))
+        matcher = aexpect._LastWordMatcher([r"^password:$"])
+        self.assertEqual(feed_all(matcher, ["password", " :"]), None)
+
+
+class FilterMatcherTest(unittest.TestCase):
+    def test_filter(self):
+        matcher = aexpect._FilterMatcher([r"^ab$"],
+                                         lambda s: s.replace("-", ""))
+        self.assertEqual(feed_all(matcher, ["a-", "-b"]), (1, 0))
+
+
+class RingBufferTest(unittest.TestCase):
+    def test_unbounded(self):
+        bfr = aexpect._RingBuffer(0)
+        for i in range(1000):
+            bfr.write("x" * 100)
+        self.assertEqual(len(bfr), 100000)
+        self.assertEqual(bfr.dropped, 0)
+        self.assertEqual(bfr.read(200000), "x" * 100000)
+        self.assertFalse(bfr)
+
+
+    def test_bounded(self):
+        bfr = aexpect._RingBuffer(10)
+        bfr.write("abcd")
+        bfr.write("efgh")
+        bfr.write("ijkl")
+        self.assertEqual(len(bfr), 10)
+        self.assertEqual(bfr.dropped, 2)
+        bfr.write("0123456789xyz")
+        self.assertEqual(bfr.dropped, 15)
+        self.assertEqual(bfr.read(4), "3456")
+        self.assertEqual(bfr.read(100), "789xyz")
+        self.assertEqual(len(bfr), 0)
+
+
+    def test_unread(self):
+        bfr = aexpect._RingBuffer(10)
+        bfr.write("abc")
+        bfr.write("def")
+        data = bfr.read(5)
+        self.assertEqual(data, "abcde")
+        bfr.unread(data[2:])
+        self.assertEqual(len(bfr), 4)
+        self.assertEqual(bfr.read(10), "cdef")
+
+
+class OutputFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "output")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def read(self, filename):
+        return open(filename).read()
+
+
+    def test_no_limit(self):
+        output = aexpect._OutputFile(self.filename)
+        output.write("a" * 1000)
+        output.write("b" * 1000)
+        output.close()
+        self.assertEqual(aexpect._get_output_filenames(self.filename),
+                         [self.filename])
+        self.assertEqual(self.read(self.filename), "a" * 1000 + "b" * 1000)
+
+
+    def test_rotation(self):
+        output = aexpect._OutputFile(self.filename, 4, 2)
+        output.write("abc")
+        output.write("defghijkl")
+        output.write("mn")
+        output.close()
+        filenames = aexpect._get_output_filenames(self.filename)
+        self.assertEqual(filenames, [self.filename + ".2",
+                                     self.filename + ".1", self.filename])
+        self.assertEqual([self.read(f) for f in filenames],
+                         ["efgh", "ijkl", "mn"])
+
+
+class GetOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.sessions = []
+
+
+    def tearDown(self):
+        aexpect.set_output_limits()
+        for session in self.sessions:
+            session.close()
+
+
+    def spawn(self, command, multiplex):
+        aexpect.use_multiplexer(multiplex)
+        try:
+            session = aexpect.Expect(command)
+        finally:
+            aexpect.use_multiplexer(False)
+        self.sessions.append(session)
+        session.get_status()
+        return session
+
+
+    def _test_last_n_bytes(self, multiplex):
+        aexpect.set_output_limits(1000, 3)
+        session = self.spawn("for i in `seq 1000 1999`; do echo $i; done",
+                             multiplex)
+        output = "".join("%d\n" % i for i in range(1000, 2000))
+        # Only the current file and the 3 backups are kept
+        kept = output[-(len(output) % 1000 + 3000):]
+        self.assertEqual(session.get_output(), kept)
+        self.assertEqual(session.get_output(last_n_bytes=10), output[-10:])
+        self.assertEqual(session.get_output(last_n_bytes=2500),
+                         output[-2500:])
+        self.assertEqual(session.get_output(last_n_bytes=10 ** 6), kept)
+
+
+    def test_last_n_bytes(self):
+        self._test_last_n_bytes(False)
+
+
+    def test_last_n_bytes_multiplexer(self):
+        self._test_last_n_bytes(True)
+
+
+    def _test_dropped_bytes(self, multiplex):
+        aexpect.set_output_limits(reader_buffer_size=100)
+        session = self.spawn("seq 1000 1999", multiplex)
+        dropped = session.get_dropped_bytes("expect")
+        self.assertTrue(dropped >= 100)
+        # Whatever wasn't dropped (including what the reader pipe already
+        # holds) can still be read, and the newest output is never dropped
+        output = session.read_nonblocking(timeout=0.1)
+        self.assertEqual(len(output), 5000 - dropped)
+        self.assertTrue(output.endswith("1998\n1999\n"))
+
+
+    def test_dropped_bytes(self):
+        self._test_dropped_bytes(False)
+
+
+    def test_dropped_bytes_multiplexer(self):
+        self._test_dropped_bytes(True)
+
+
+    def test_unbounded(self):
+        session = self.spawn("seq 1000 1999", False)
+        self.assertEqual(session.get_dropped_bytes("expect"), 0)
+        self.assertEqual(len(session.read_nonblocking(timeout=0.1)), 5000)
+
+
+class MultiplexerTest(unittest.TestCase):
+    def setUp(self):
+        aexpect.use_multiplexer()
+        self.sessions = []
+
+
+    def tearDown(self):
+        aexpect.use_multiplexer(False)
+        for session in self.sessions:
+            session.close()
+
+
+    def spawn(self, cls, command, **dargs):
+        session = cls(command, **dargs)
+        self.sessions.append(session)
+        return session
+
+
+    def test_shell(self):
+        session = self.spawn(aexpect.ShellSession, "PS1='$ ' /bin/sh")
+        self.assertTrue(session._mux_session)
+        session.read_up_to_prompt(timeout=10)
+        self.assertEqual(session.cmd_status_output("echo hello; false"),
+                         (1, "hello\n"))
+        self.assertEqual(session.cmd_output("echo 1; sleep 0.3; echo 2"),
+                         "1\n2\n")
+        session.sendline("exit 3")
+        self.assertEqual(session.get_status(), 3)
+        self.assertFalse(session.is_alive())
+
+
+    def test_wait_reader(self):
+        session = self.spawn(aexpect.Expect, "sleep 0.3; echo done; sleep 5")
+        start = time.time()
+        self.assertFalse(session._wait_reader("expect", 0.1))
+        self.assertTrue(session._wait_reader("expect", 5))
+        # Waiting ends as soon as the output is available
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(session._read_reader("expect", 100), "done\n")
+        session.close()
+        self.assertTrue(session._wait_reader("expect", None))
+        self.assertEqual(session._read_reader("expect", 100), "")
+
+
+    def test_tail(self):
+        lines = []
+        statuses = []
+        tail = self.spawn(aexpect.Tail, "echo a; echo b; exit 2",
+                          output_func=lines.append,
+                          termination_func=statuses.append)
+        self.assertEqual(tail.get_status(), 2)
+        tail.close()
+        self.assertEqual(lines, ["a", "b", "(Process terminated with "
+                                 "status 2)"])
+        self.assertEqual(statuses, [2])
+
+
+    def test_pickle(self):
+        session = self.spawn(aexpect.Expect, "sleep 5")
+        self.assertRaises(pickle.PicklingError, pickle.dumps, session)
+        # Sessions created with multiplex=False get a server, and are
+        # reattached when unpickled
+        session = self.spawn(aexpect.Expect, "echo ready; sleep 5",
+                             multiplex=False)
+        self.assertFalse(session._mux_session)
+        session.read_until_output_matches(["ready"])
+        copy = pickle.loads(pickle.dumps(session))
+        self.assertEqual(copy.get_pid(), session.get_pid())
+        copy.sendline("")
+        self.assertTrue(copy.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
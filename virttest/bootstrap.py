@@ -1,4 +1,5 @@
-import urllib2, logging, os, glob, shutil, ConfigParser
+import urllib2, logging, os, glob, shutil, ConfigParser, hashlib, sys
+import threading, Queue
 from autotest.client.shared import logging_manager
 from autotest.client import utils
 import utils_misc, data_dir
@@ -72,22 +73,131 @@ def get_asset_info(asset):
             'downloaded': asset_exists}
 
 
-def download_file(asset, interactive=False):
+# Suffix of the partially downloaded files, kept around to resume downloads
+PARTIAL_SUFFIX = ".part"
+
+
+def get_digest_cache():
     """
-    Verifies if file that can be find on url is on destination with right hash.
+    Return the file digest cache the SHA1 sums of the assets are kept in,
+    the one used to verify the ISO images of the VMs.
+    """
+    return utils_misc.FileDigestCache(os.path.join(data_dir.get_tmp_dir(),
+                                                   "file_digests"))
 
-    This function will verify the SHA1 hash of the file. If the file
-    appears to be missing or corrupted, let the user know.
 
-    @param asset: String describing an asset file inside the shared/download.d
-            directory. This asset file is a .ini file with information about
-            download and SHA1SUM url data.
+def _open_url(url, offset):
+    """
+    Open url, asking for its contents from offset onwards.
 
-    @return: True, if file had to be downloaded
-             False, if file didn't have to be downloaded
+    @return: Tuple (response, offset), offset being the one the contents
+            actually start at (0 if the server does not support ranges).
+    """
+    request = urllib2.Request(url)
+    if offset:
+        request.add_header("Range", "bytes=%d-" % offset)
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError, e:
+        if offset and e.code == 416:
+            # Range not satisfiable, the partial file is bogus
+            return _open_url(url, 0)
+        raise
+    if offset:
+        content_range = response.info().getheader("Content-Range", "")
+        if (response.getcode() != 206 or
+            not content_range.startswith("bytes %d-" % offset)):
+            offset = 0
+    return response, offset
+
+
+def download_url(url, destination, sha1=None, title="",
+                 chunk_size=100 * 1024):
+    """
+    Download url to destination, computing its SHA1 sum along the way.
+
+    The data is written to destination + PARTIAL_SUFFIX, which is renamed
+    to destination once complete and verified.  If that partial file is
+    already there (e.g. a previous download was interrupted), the download
+    is resumed where it stopped, using an HTTP range request.  The SHA1 sum
+    is recorded in the digest cache, so the file isn't read again to verify
+    it until it changes.
+
+    @param url: URL of the file.
+    @param destination: Path to save the file to.
+    @param sha1: Expected SHA1 sum of the file, None to not verify it.
+    @param title: Name of the download in the log messages.
+    @param chunk_size: Amount of data to read at a time.
+    @raise ValueError: If the SHA1 sum of the file is not the expected one.
+    @return: SHA1 sum of the file.
+    """
+    title = title or os.path.basename(destination)
+    partial = destination + PARTIAL_SUFFIX
+    hash_obj = hashlib.sha1()
+    offset = 0
+    if os.path.isfile(partial):
+        offset = os.path.getsize(partial)
+    response, offset = _open_url(url, offset)
+    try:
+        if offset:
+            # Hash what we already have, the rest is hashed while streaming
+            output_file = open(partial, "r+b")
+            data = output_file.read(chunk_size)
+            while data:
+                hash_obj.update(data)
+                data = output_file.read(chunk_size)
+            output_file.seek(offset)
+            logging.info("Resuming download of %s at %s", title,
+                         utils.display_data_size(offset))
+        else:
+            output_file = open(partial, "wb")
+        try:
+            try:
+                size = offset + int(response.info().getheader(
+                                                    "Content-Length"))
+            except (TypeError, ValueError):
+                size = None
+            done = offset
+            reported = 0
+            data = response.read(chunk_size)
+            while data:
+                output_file.write(data)
+                hash_obj.update(data)
+                done += len(data)
+                if size and done * 10 / size > reported:
+                    reported = done * 10 / size
+                    logging.info("%s: %d%% of %s downloaded", title,
+                                 reported * 10, utils.display_data_size(size))
+                data = response.read(chunk_size)
+        finally:
+            output_file.close()
+    finally:
+        response.close()
+
+    actual_sha1 = hash_obj.hexdigest()
+    if sha1 is not None and actual_sha1 != sha1:
+        os.unlink(partial)
+        if offset:
+            logging.warning("SHA1 sum of resumed download of %s is %s, "
+                            "expected %s. Downloading it again", title,
+                            actual_sha1, sha1)
+            return download_url(url, destination, sha1, title, chunk_size)
+        raise ValueError("SHA1 sum of %s is %s, expected %s" %
+                         (url, actual_sha1, sha1))
+    os.rename(partial, destination)
+    get_digest_cache().record_digests(destination,
+                                      {("sha1", None): actual_sha1})
+    return actual_sha1
+
+
+def _check_file(asset, interactive=False):
+    """
+    Verify if an asset is at its destination with the right hash, and ask
+    whether to download it otherwise.
+
+    @return: Tuple (asset_info, expected SHA1 sum), the asset info being
+            None if the asset does not have to be downloaded.
     """
-    file_ok = False
-    had_to_download = False
     sha1 = None
 
     asset_info = get_asset_info(asset)
@@ -95,7 +205,6 @@ def download_file(asset, interactive=False):
     url = asset_info['url']
     sha1_url = asset_info['sha1_url']
     destination = asset_info['destination']
-    title = asset_info['title']
 
     if sha1_url is not None:
         try:
@@ -106,8 +215,6 @@ def download_file(asset, interactive=False):
             logging.info("Expected SHA1 sum: %s", sha1)
         except Exception, e:
             logging.error("Failed to get SHA1 from file: %s", e)
-    else:
-        sha1 = None
 
     destination_dir = os.path.dirname(destination)
     if not os.path.isdir(destination_dir):
@@ -120,19 +227,15 @@ def download_file(asset, interactive=False):
         else:
             answer = 'y'
         if answer == 'y':
-            utils.interactive_download(url, destination, "Downloading %s" % title)
-            had_to_download = True
-        else:
-            logging.warning("Missing file %s", destination)
+            return asset_info, sha1
+        logging.warning("Missing file %s", destination)
     else:
         logging.info("Found %s", destination)
         if sha1 is None:
-            answer = 'n'
+            logging.info("File %s present, but did not verify integrity",
+                         destination)
         else:
-            answer = 'y'
-
-        if answer == 'y':
-            actual_sha1 = utils.hash_file(destination, method='sha1')
+            actual_sha1 = get_digest_cache().get_digest(destination, "sha1")
             if actual_sha1 != sha1:
                 logging.error("Actual SHA1 sum: %s", actual_sha1)
                 if interactive:
@@ -142,22 +245,80 @@ def download_file(asset, interactive=False):
                     answer = 'y'
                 if answer == 'y':
                     logging.info("Updating image to the latest available...")
-                    utils.interactive_download(url, destination, title)
-                    had_to_download = True
-                    file_ok = True
+                    return asset_info, sha1
             else:
-                file_ok = True
                 logging.info("SHA1 sum check OK")
-        else:
-            logging.info("File %s present, but did not verify integrity",
-                         destination)
+                logging.info("%s present, with proper checksum", destination)
+    return None, sha1
 
-    if file_ok:
-        logging.info("%s present, with proper checksum", destination)
 
+def download_files(assets, interactive=False, jobs=4):
+    """
+    Verify a list of assets (see download_file()) and download the missing,
+    corrupted or outdated ones, jobs of them at a time.
+
+    @param assets: List of asset names.
+    @param interactive: Whether to ask the user before downloading a file.
+    @param jobs: Maximum number of concurrent downloads.
+    @return: Dict mapping each asset name to True if the file had to be
+            downloaded, False otherwise.
+    """
+    had_to_download = {}
+    pending = Queue.Queue()
+    for asset in assets:
+        asset_info, sha1 = _check_file(asset, interactive)
+        had_to_download[asset] = asset_info is not None
+        if asset_info is not None:
+            pending.put((asset_info, sha1))
+
+    errors = []
+
+    def worker():
+        while True:
+            try:
+                asset_info, sha1 = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                download_url(asset_info['url'], asset_info['destination'],
+                             sha1, asset_info['title'])
+                logging.info("%s downloaded to %s", asset_info['title'],
+                             asset_info['destination'])
+            except Exception, e:
+                logging.error("Failed to download %s: %s",
+                              asset_info['title'], e)
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(jobs, pending.qsize()))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
     return had_to_download
 
 
+def download_file(asset, interactive=False):
+    """
+    Verifies if file that can be find on url is on destination with right hash.
+
+    This function will verify the SHA1 hash of the file. If the file
+    appears to be missing or corrupted, let the user know.  The SHA1 sum
+    of a verified file is recorded, so that it is only computed again if
+    the file changes.
+
+    @param asset: String describing an asset file inside the shared/download.d
+            directory. This asset file is a .ini file with information about
+            download and SHA1SUM url data.
+
+    @return: True, if file had to be downloaded
+             False, if file didn't have to be downloaded
+    """
+    return download_files([asset], interactive=interactive)[asset]
+
+
 def download_asset(asset, interactive=True, restore_image=False):
     """
     Download an asset defined on an asset file.
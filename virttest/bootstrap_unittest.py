@@ -0,0 +1,113 @@
+#!/usr/bin/python
+import unittest, os, tempfile, shutil, threading, hashlib, time
+import BaseHTTPServer
+import common
+import bootstrap, utils_misc
+
+
+DATA = "".join([chr(i % 251) for i in range(300 * 1024)])
+
+
+class RangeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves DATA, honouring "bytes=N-" range requests.
+    """
+    def do_GET(self):
+        self.server.requests.append(self.headers.getheader("Range"))
+        start = 0
+        range_header = self.headers.getheader("Range")
+        if range_header:
+            start = int(range_header[len("bytes="):].rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" %
+                             (start, len(DATA) - 1, len(DATA)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(DATA) - start))
+        self.end_headers()
+        self.wfile.write(DATA[start:])
+
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.destination = os.path.join(self.tmpdir, "image.qcow2")
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0),
+                                                RangeRequestHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/image.qcow2" % self.server.server_port
+        self.sha1 = hashlib.sha1(DATA).hexdigest()
+        self.digest_cache = utils_misc.FileDigestCache(
+                                os.path.join(self.tmpdir, "file_digests"))
+        self.get_digest_cache = bootstrap.get_digest_cache
+        bootstrap.get_digest_cache = lambda: self.digest_cache
+
+
+    def tearDown(self):
+        bootstrap.get_digest_cache = self.get_digest_cache
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+
+    def test_download(self):
+        self.assertEqual(bootstrap.download_url(self.url, self.destination,
+                                                self.sha1), self.sha1)
+        self.assertEqual(open(self.destination).read(), DATA)
+        self.assertFalse(os.path.exists(self.destination +
+                                        bootstrap.PARTIAL_SUFFIX))
+        self.assertEqual(self.server.requests, [None])
+
+
+    def test_resume(self):
+        partial = open(self.destination + bootstrap.PARTIAL_SUFFIX, "w")
+        partial.write(DATA[:1000])
+        partial.close()
+        bootstrap.download_url(self.url, self.destination, self.sha1)
+        self.assertEqual(open(self.destination).read(), DATA)
+        self.assertEqual(self.server.requests, ["bytes=1000-"])
+
+
+    def test_resume_corrupted(self):
+        partial = open(self.destination + bootstrap.PARTIAL_SUFFIX, "w")
+        partial.write("x" * 1000)
+        partial.close()
+        bootstrap.download_url(self.url, self.destination, self.sha1)
+        self.assertEqual(open(self.destination).read(), DATA)
+        self.assertEqual(self.server.requests, ["bytes=1000-", None])
+
+
+    def test_wrong_sha1(self):
+        self.assertRaises(ValueError, bootstrap.download_url, self.url,
+                          self.destination, "0" * 40)
+        self.assertFalse(os.path.exists(self.destination))
+
+
+    def test_recorded_sha1(self):
+        bootstrap.download_url(self.url, self.destination)
+        # No other file than the image and the cache are left around
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ["file_digests", "file_digests.lock", "image.qcow2"])
+        entry = self.digest_cache._load()[os.path.realpath(self.destination)]
+        self.assertEqual(entry["digests"], {"sha1": self.sha1})
+        self.assertEqual(self.digest_cache.get_digest(self.destination,
+                                                      "sha1"), self.sha1)
+        # Changing the file invalidates the record
+        output_file = open(self.destination, "a")
+        output_file.write("x")
+        output_file.close()
+        os.utime(self.destination, (time.time(), time.time() + 10))
+        self.assertEqual(self.digest_cache.get_digest(self.destination,
+                                                      "sha1"),
+                         hashlib.sha1(DATA + "x").hexdigest())
+
+
+if __name__ == '__main__':
+    unittest.main()
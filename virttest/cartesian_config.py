@@ -28,7 +28,9 @@ Cartesian configuration format file parser.
 @copyright: Red Hat 2008-2011
 """
 
-import re, os, optparse, collections, string
+import re, os, sys, optparse, collections, string, hashlib, cPickle, tempfile
+import multiprocessing
+from utils_params import LayeredDict, _deleted
 
 class ParserError:
     def __init__(self, msg, line=None, filename=None, linenum=None):
@@ -58,6 +60,10 @@ class MissingIncludeError:
 
 num_failed_cases = 5
 
+# Bump this whenever a change to Node, the filters or Op makes previously
+# pickled trees or dicts unusable
+_cache_version = 2
+
 
 class Node(object):
     def __init__(self):
@@ -206,15 +212,35 @@ class Parser(object):
     @see: https://github.com/autotest/autotest/wiki/KVMAutotest-CartesianConfigParametersIntro
     """
 
-    def __init__(self, filename=None, debug=False):
+    def __init__(self, filename=None, debug=False, cache_dir=None,
+                 cache_dicts=False, jobs=1, cache_size=None):
         """
         Initialize the parser and optionally parse a file.
 
         @param filename: Path of the file to parse.
         @param debug: Whether to turn on debugging output.
+        @param cache_dir: Directory where parsed trees are cached between
+                runs.  Caching is disabled if None.
+        @param cache_dicts: Whether to also cache the dicts generated by
+                get_dicts() (requires cache_dir).
+        @param jobs: Number of processes get_dicts() expands the tree with.
+        @param cache_size: Maximum size in bytes of the cache dir.  The least
+                recently used entries are removed when it grows larger.
+                Defaults to _default_cache_size.
         """
         self.node = Node()
         self.debug = debug
+        self.cache_dir = cache_dir
+        self.cache_dicts = cache_dicts
+        self.jobs = jobs
+        if cache_size is None:
+            cache_size = _default_cache_size
+        self.cache_size = cache_size
+        # The cache key identifies the sequence of parse steps (and the
+        # contents of the files they read) that produced self.node
+        self._cache_key = _digest(str(_cache_version), __name__)
+        self._file_digests = {}
+        self._dicts = None
         if filename:
             self.parse_file(filename)
         self.filename = filename
@@ -224,9 +250,22 @@ class Parser(object):
         """
         Parse a file.
 
+        If a cache dir was given, the resulting tree is loaded from the cache
+        when none of the files involved (including the ones pulled in by
+        'include' statements) have changed since it was stored.
+
         @param filename: Path of the configuration file.
         """
-        self.node = self._parse(FileReader(filename), self.node)
+        key = _digest(self._cache_key, "file", os.path.abspath(filename))
+        cached = self._load_tree(key)
+        if cached:
+            file_digests, self.node = cached
+        else:
+            self._file_digests = {}
+            self.node = self._parse(self._open_file(filename), self.node)
+            file_digests = self._file_digests
+            self._save_cache("tree", key, (file_digests, self.node))
+        self._update_cache_key(key, file_digests)
         self.filename = filename
 
 
@@ -236,7 +275,142 @@ class Parser(object):
 
         @param s: String to parse.
         """
+        self._file_digests = {}
         self.node = self._parse(StrReader(s), self.node)
+        self._update_cache_key(_digest(self._cache_key, "string", s),
+                               self._file_digests)
+
+
+    def _open_file(self, filename):
+        """
+        Return a FileReader for filename, recording its digest so that it
+        becomes part of the cache key.
+        """
+        cr = FileReader(filename)
+        self._file_digests[os.path.abspath(filename)] = cr.digest
+        return cr
+
+
+    def _update_cache_key(self, key, file_digests):
+        args = [key]
+        for filename in sorted(file_digests):
+            args += [filename, file_digests[filename]]
+        self._cache_key = _digest(*args)
+
+
+    def _cache_filename(self, kind, key):
+        return os.path.join(self.cache_dir, "%s-%s.pickle" % (kind, key))
+
+
+    def _load_cache(self, kind, key):
+        """
+        Return the object stored in the cache under (kind, key), or None if
+        there's no usable entry.
+        """
+        if not self.cache_dir:
+            return None
+        filename = self._cache_filename(kind, key)
+        if not os.path.isfile(filename):
+            return None
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, _cache_recursion_limit))
+        try:
+            try:
+                f = open(filename, "rb")
+                try:
+                    obj = cPickle.load(f)
+                finally:
+                    f.close()
+                # The mtime of entries tells how recently they were used
+                try:
+                    os.utime(filename, None)
+                except OSError:
+                    pass
+                return obj
+            # A truncated or otherwise broken entry is just a cache miss
+            except Exception, e:
+                self._debug("ignoring unusable cache file %s: %s",
+                            filename, e)
+                return None
+        finally:
+            sys.setrecursionlimit(limit)
+
+
+    def _save_cache(self, kind, key, obj):
+        """
+        Store obj in the cache under (kind, key).  The file is written to a
+        temporary name and renamed, so concurrent readers never see a
+        partially written entry.
+        """
+        if not self.cache_dir:
+            return
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, _cache_recursion_limit))
+        try:
+            try:
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                fd, tmp_filename = tempfile.mkstemp(dir=self.cache_dir,
+                                                    prefix=".%s-" % kind)
+                f = os.fdopen(fd, "wb")
+                try:
+                    cPickle.dump(obj, f, cPickle.HIGHEST_PROTOCOL)
+                finally:
+                    f.close()
+                os.rename(tmp_filename, self._cache_filename(kind, key))
+            except Exception, e:
+                self._warn("could not write cache file for %s: %s", kind, e)
+        finally:
+            sys.setrecursionlimit(limit)
+        self._prune_cache()
+
+
+    def _prune_cache(self):
+        """
+        Remove the least recently used entries of the cache dir until its
+        size is within self.cache_size.  The most recent entry is always
+        kept.
+        """
+        entries = []
+        try:
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".pickle") or name.startswith("."):
+                    continue
+                filename = os.path.join(self.cache_dir, name)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, filename))
+        except OSError, e:
+            self._warn("could not list cache dir %s: %s", self.cache_dir, e)
+            return
+        entries.sort(reverse=True)
+        total = 0
+        for i, (_, size, filename) in enumerate(entries):
+            total += size
+            if i > 0 and total > self.cache_size:
+                self._debug("removing cache file %s", filename)
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+
+
+    def _load_tree(self, key):
+        """
+        Return (file_digests, node) from the cache if every file the tree
+        was built from is still unchanged, None otherwise.
+        """
+        cached = self._load_cache("tree", key)
+        if not cached:
+            return None
+        file_digests, _ = cached
+        for filename, digest in file_digests.items():
+            if _file_digest(filename) != digest:
+                self._debug("cached tree is stale (%s changed)", filename)
+                return None
+        return cached
 
 
     def get_dicts(self, node=None, ctx=[], content=[], shortname=[], dep=[]):
@@ -244,8 +418,193 @@ class Parser(object):
         Generate dictionaries from the code parsed so far.  This should
         be called after parsing something.
 
+        If the parser was created with cache_dicts, the complete list of
+        dicts is stored in (and later loaded from) the cache dir, keyed by
+        everything parsed so far, including 'only' and 'no' filters.
+
+        If the parser was created with more than one job, the subtrees of
+        the top level variants are expanded by a pool of processes and the
+        dicts are yielded in the same order as a serial expansion would.
+
+        @return: A dict generator.
+        """
+        if node is None and self.cache_dir and self.cache_dicts:
+            return self._get_cached_dicts()
+        if node is None and self.jobs > 1:
+            return self._get_parallel_dicts()
+        return self._get_dicts(node, ctx, content, shortname, dep)
+
+
+    def _get_dicts(self, node=None, ctx=[], content=[], shortname=[],
+                   dep=[], path=()):
+        builder = _DictBuilder()
+        for name, leaf_dep, leaf_shortname, ops, _ in self._get_leaves(
+                                node, ctx, content, shortname, dep, path):
+            yield builder.get_dict(name, leaf_dep, leaf_shortname, ops)
+
+
+    def _get_subtree_paths(self, count):
+        """
+        Split the tree into at least count subtrees that have leaves passing
+        the filters (if there are that many), returning the paths that lead
+        to them.  A path is a tuple of child indexes, and the paths are
+        sorted in the order the subtrees are walked.
+
+        @param count: Desired number of subtrees.
+        """
+        paths = [((), self.node)]
+        leaves = False
+        while len(paths) < count and not leaves:
+            new_paths = []
+            leaves = True
+            for path, node in paths:
+                if node.children:
+                    leaves = False
+                    for i, child in enumerate(node.children):
+                        # Leave out the subtrees the filters remove entirely
+                        for _ in self._get_leaves(path=path + (i,),
+                                                  with_ops=False):
+                            new_paths.append((path + (i,), child))
+                            break
+                else:
+                    new_paths.append((path, node))
+            paths = new_paths
+        return [path for path, _ in paths]
+
+
+    def _get_parallel_dicts(self):
+        """
+        Expand the subtrees returned by _get_subtree_paths() in a pool of
+        self.jobs processes, yielding their dicts in order.
+
+        Each worker process has its own copy of the tree, so the failed
+        filters remembered by its nodes only prune the subtrees that worker
+        expands.  The dicts of a subtree are sent back all at once, so the
+        values they share are pickled only once.
+        """
+        paths = self._get_subtree_paths(self.jobs * _subtrees_per_job)
+        pool = multiprocessing.Pool(self.jobs, _init_worker, (self,))
+        try:
+            for dicts in pool.imap(_expand_subtree, paths):
+                for d in dicts:
+                    yield d
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    def query(self, filters=None, keys=(), paths=False):
+        """
+        Generate a small dict for each leaf, without building the complete
+        dicts get_dicts() would return.
+
+        The dicts have the name, shortname and dep of the leaf, plus the
+        given keys (if the leaf has them).  Only the operators those keys
+        depend on are applied, so without keys the tree is merely walked.
+
+        @param filters: 'only' and 'no' statements (in the config format)
+                restricting the leaves further, without changing the parser.
+        @param keys: List of keys to compute.
+        @param paths: Whether to generate (path, dict) tuples instead, path
+                locating the leaf for get_leaf_dict().
         @return: A dict generator.
         """
+        content = self._parse_filters(filters)
+        keys = set(keys)
+        for name, dep, shortname, ops, path in self._get_leaves(
+                                content=content, with_ops=bool(keys)):
+            d = {"name": name, "dep": dep, "shortname": shortname}
+            if keys:
+                for op in _get_needed_ops(ops, keys):
+                    op.apply_to_dict(d)
+                for key in d.keys():
+                    if key not in keys and key not in _reserved_keys:
+                        del d[key]
+            if paths:
+                yield path, d
+            else:
+                yield d
+
+
+    def get_leaf_dict(self, path):
+        """
+        Return the dict get_dicts() generates for a single leaf, or None if
+        the leaf doesn't pass the filters.
+
+        @param path: Path of the leaf, as generated by query().
+        """
+        for d in self._get_dicts(path=path):
+            return d
+        return None
+
+
+    def count(self, filters=None):
+        """
+        Return the number of dicts get_dicts() would generate.
+
+        @param filters: See query().
+        """
+        count = 0
+        for _ in self._get_leaves(content=self._parse_filters(filters),
+                                  with_ops=False):
+            count += 1
+        return count
+
+
+    def matches(self, filters):
+        """
+        Return True if any of the leaves passes filters.
+
+        @param filters: See query().
+        """
+        for _ in self._get_leaves(content=self._parse_filters(filters),
+                                  with_ops=False):
+            return True
+        return False
+
+
+    def _parse_filters(self, filters):
+        """
+        Return the content of a node parsed from filters, to be applied to
+        the leaves of the tree as if it was part of the root node.
+        """
+        if not filters:
+            return []
+        return self._parse(StrReader(filters), Node()).content
+
+
+    def _get_cached_dicts(self):
+        key = _digest(self._cache_key, "dicts")
+        if self._dicts is None or self._dicts[0] != key:
+            dicts = self._load_cache("dicts", key)
+            if dicts is None:
+                if self.jobs > 1:
+                    dicts = list(self._get_parallel_dicts())
+                else:
+                    dicts = list(self._get_dicts())
+                self._save_cache("dicts", key, dicts)
+            self._dicts = key, dicts
+        # Callers are free to modify the dicts they get, so hand out copies
+        for d in self._dicts[1]:
+            d = d.copy()
+            d["dep"] = list(d["dep"])
+            yield d
+
+
+    def _get_leaves(self, node=None, ctx=[], content=[], shortname=[],
+                    dep=[], path=(), with_ops=True, prefix=()):
+        """
+        Walk the tree, yielding a (name, dep, shortname, ops, path) tuple for
+        each leaf that passes the filters, ops being the list of Op objects
+        to apply to its dict, in order, and path the tuple of child indexes
+        that leads to the leaf (prefix being the path of node).
+
+        If path (a tuple of child indexes) is given, only the subtree it
+        leads to is walked.  If with_ops is False, the operators are left
+        behind as soon as they are found, which makes the walk considerably
+        cheaper, and ops is always empty.
+        """
         def process_content(content, failed_filters):
             # 1. Check that the filters in content are OK with the current
             #    context (ctx).
@@ -260,8 +619,10 @@ class Parser(object):
             #    filters first.
             for t in content:
                 filename, linenum, obj = t
-                if type(obj) is Op:
-                    new_content.append(t)
+                if type(obj) is list:
+                    # A list of operators
+                    if with_ops:
+                        new_content.append(t)
                     continue
                 # obj is an OnlyFilter/NoFilter/Condition/NegativeCondition
                 if obj.requires_action(ctx, ctx_set, labels):
@@ -349,20 +710,25 @@ class Parser(object):
             shortname = shortname + node.name
         # Recurse into children
         count = 0
-        for n in node.children:
-            for d in self.get_dicts(n, ctx, new_content, shortname, dep):
+        if path:
+            children = [(path[0], node.children[path[0]])]
+        else:
+            children = enumerate(node.children)
+        for i, n in children:
+            for leaf in self._get_leaves(n, ctx, new_content, shortname, dep,
+                                         path[1:], with_ops, prefix + (i,)):
                 count += 1
-                yield d
+                yield leaf
         # Reached leaf?
         if not node.children:
             self._debug("    reached leaf, returning it")
-            d = {"name": name, "dep": dep, "shortname": ".".join(shortname)}
-            for _, _, op in new_content:
-                op.apply_to_dict(d)
-            yield d
+            ops = []
+            for _, _, op_list in new_content:
+                ops.extend(op_list)
+            yield name, dep, ".".join(shortname), ops, prefix
         # If this node did not produce any dicts, remember the failed filters
-        # of its descendants
-        elif not count:
+        # of its descendants (unless only some of them were walked)
+        elif not count and not path:
             new_external_filters = []
             new_internal_filters = []
             for n in node.children:
@@ -481,7 +847,7 @@ class Parser(object):
                 if not os.path.isfile(filename):
                     raise MissingIncludeError(line, cr.filename, linenum)
                     continue
-                node = self._parse(FileReader(filename), node)
+                node = self._parse(self._open_file(filename), node)
                 continue
 
             # Parse 'only' and 'no' filters
@@ -529,62 +895,99 @@ class Parser(object):
             # Parse regular operators
             if not op_match:
                 raise ParserError("Syntax error", line, cr.filename, linenum)
-            node.content += [(cr.filename, linenum, Op(line, op_match))]
+            op = Op(line, op_match)
+            # Consecutive operators are kept in a single list, passed down
+            # the tree as a whole
+            if node.content and type(node.content[-1][2]) is list:
+                node.content[-1][2].append(op)
+            else:
+                node.content += [(cr.filename, linenum, [op])]
 
         return node
 
 
+# Helpers for the parse cache
+
+# Default maximum size in bytes of a cache dir
+_default_cache_size = 256 * 1024 * 1024
+
+# Parsed trees are deeply nested, so (un)pickling them needs more stack than
+# the interpreter allows by default
+_cache_recursion_limit = 20000
+
+# How many subtrees get_dicts() splits the tree into per job, so that the
+# jobs stay busy even when some subtrees are filtered out
+_subtrees_per_job = 8
+
+# The parser expanded by the worker processes of get_dicts()
+_worker_parser = None
+
+
+def _init_worker(parser):
+    global _worker_parser
+    _worker_parser = parser
+
+
+def _expand_subtree(path):
+    return list(_worker_parser._get_dicts(path=path))
+
+
+def _digest(*args):
+    h = hashlib.sha1()
+    for arg in args:
+        h.update(arg)
+        h.update("\0")
+    return h.hexdigest()
+
+
+def _file_digest(filename):
+    try:
+        return hashlib.sha1(open(filename).read()).hexdigest()
+    except IOError:
+        return None
+
+
 # Assignment operators
 
 _reserved_keys = set(("name", "shortname", "dep"))
 
 
-def _op_set(d, key, value):
-    if key not in _reserved_keys:
-        st = string.Template(value)
-        d[key] = st.safe_substitute(d)
+def _op_set(d, op):
+    if op.key not in _reserved_keys:
+        d[op.key] = op.substitute(d)
 
 
-def _op_append(d, key, value):
-    if key not in _reserved_keys:
-        st = string.Template(value)
-        d[key] = d.get(key, "") + st.safe_substitute(d)
+def _op_append(d, op):
+    if op.key not in _reserved_keys:
+        d[op.key] = d.get(op.key, "") + op.substitute(d)
 
 
-def _op_prepend(d, key, value):
-    if key not in _reserved_keys:
-        st = string.Template(value)
-        d[key] = st.safe_substitute(d) + d.get(key, "")
+def _op_prepend(d, op):
+    if op.key not in _reserved_keys:
+        d[op.key] = op.substitute(d) + d.get(op.key, "")
 
 
-def _op_regex_set(d, exp, value):
-    exp = re.compile("%s$" % exp)
-    st = string.Template(value)
-    for key in d:
-        if key not in _reserved_keys and exp.match(key):
-            d[key] = st.safe_substitute(d)
+def _op_regex_set(d, op):
+    for key in d.keys():
+        if key not in _reserved_keys and op.exp.match(key):
+            d[key] = op.substitute(d)
 
 
-def _op_regex_append(d, exp, value):
-    exp = re.compile("%s$" % exp)
-    st = string.Template(value)
-    for key in d:
-        if key not in _reserved_keys and exp.match(key):
-            d[key] += st.safe_substitute(d)
+def _op_regex_append(d, op):
+    for key in d.keys():
+        if key not in _reserved_keys and op.exp.match(key):
+            d[key] += op.substitute(d)
 
 
-def _op_regex_prepend(d, exp, value):
-    exp = re.compile("%s$" % exp)
-    st = string.Template(value)
-    for key in d:
-        if key not in _reserved_keys and exp.match(key):
-            d[key] = st.safe_substitute(d) + d[key]
+def _op_regex_prepend(d, op):
+    for key in d.keys():
+        if key not in _reserved_keys and op.exp.match(key):
+            d[key] = op.substitute(d) + d[key]
 
 
-def _op_regex_del(d, empty, exp):
-    exp = re.compile("%s$" % exp)
+def _op_regex_del(d, op):
     for key in d.keys():
-        if key not in _reserved_keys and exp.match(key):
+        if key not in _reserved_keys and op.exp.match(key):
             del d[key]
 
 
@@ -599,6 +1002,30 @@ _ops = {"=": (r"\=", _op_set),
 _ops_exp = re.compile("|".join([op[0] for op in _ops.values()]))
 
 
+def _get_needed_ops(ops, keys):
+    """
+    Return the operators in ops (in order) that the values of keys depend
+    on, including the ones setting keys referred to by the values of other
+    needed operators.
+    """
+    keys = set(keys)
+    needed_ops = []
+    for op in reversed(ops):
+        if op.exp is None:
+            needed = op.key in keys
+        else:
+            needed = [key for key in keys if op.exp.match(key)]
+        if not needed:
+            continue
+        needed_ops.append(op)
+        # Whatever the key was set to before does not matter anymore
+        if op.func is _op_set:
+            keys.discard(op.key)
+        keys.update(op.names)
+    needed_ops.reverse()
+    return needed_ops
+
+
 class Op(object):
     def __init__(self, line, m):
         self.func = _ops[m.group()][1]
@@ -608,10 +1035,149 @@ class Op(object):
                       value[0] == value[-1] == "'"):
             value = value[1:-1]
         self.value = value
+        # Compile the key expression of the regex operators once
+        self.exp = None
+        if self.func is _op_regex_del:
+            self.exp = re.compile("%s$" % value)
+        elif self.func in (_op_regex_set, _op_regex_append,
+                           _op_regex_prepend):
+            self.exp = re.compile("%s$" % self.key)
+        # Values without placeholders do not depend on the dict, substitute
+        # them (which only unescapes '$$') once
+        template = string.Template(value)
+        names = set()
+        for match in template.pattern.finditer(value):
+            names.add(match.group("named") or match.group("braced"))
+        names.discard(None)
+        self.names = tuple(sorted(names))
+        self.substituted = None
+        if not names:
+            self.substituted = template.safe_substitute({})
+        # Whether the value refers to the per leaf name, shortname or dep
+        self.uses_reserved = bool(names & _reserved_keys)
+
+
+    def substitute(self, d):
+        """
+        Return the value of the operator, with the placeholders replaced by
+        the values of d.
+        """
+        if self.substituted is not None:
+            return self.substituted
+        return string.Template(self.value).safe_substitute(d)
 
 
     def apply_to_dict(self, d):
-        self.func(d, self.key, self.value)
+        self.func(d, self)
+
+
+# Dicts generated by the parser
+
+class _UndoDict(dict):
+    """
+    A dict that logs the previous value of the keys set or deleted, to the
+    list in its 'log' attribute.
+    """
+    log = None
+
+    def __setitem__(self, key, value):
+        if self.log is not None:
+            self.log.append((key, dict.get(self, key, _deleted)))
+        dict.__setitem__(self, key, value)
+
+
+    def __delitem__(self, key):
+        if self.log is not None:
+            self.log.append((key, dict.get(self, key, _deleted)))
+        dict.__delitem__(self, key)
+
+
+def _common_prefix_length(list1, list2):
+    # Bisect on slice comparisons, which run at C speed
+    low, high = 0, min(len(list1), len(list2))
+    while low < high:
+        middle = (low + high + 1) / 2
+        if list1[low:middle] == list2[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+class _DictBuilder(object):
+    """
+    Build the dicts of consecutive leaves.
+
+    Neighbouring leaves share most of their operators, usually a long prefix
+    of them (e.g. the ones coming from base.cfg).  The operators are applied
+    to a single working dict, undoing and redoing only the ones after the
+    prefix shared with the previous leaf, and the dicts are LayeredDicts
+    sharing a snapshot of the working dict at a shared prefix.
+    """
+    # How many operators the shared prefix may grow past the snapshot before
+    # taking a new one
+    snapshot_distance = 16
+
+    def __init__(self):
+        self.d = _UndoDict()
+        # The operators applied to self.d (with the leaf specific values
+        # they depend on, if any), and the values they replaced
+        self.path = []
+        self.undo = []
+        # A copy of self.d when only the first base_len operators of path
+        # were applied
+        self.base = {}
+        self.base_len = 0
+
+
+    def get_dict(self, name, dep, shortname, ops):
+        """
+        Return the dict of a leaf.
+
+        @param name: Full name of the leaf.
+        @param dep: List of dependencies of the leaf.
+        @param shortname: Short name of the leaf.
+        @param ops: List of Op objects to apply, in order.
+        """
+        reserved = {"name": name, "dep": dep, "shortname": shortname}
+        path = ops
+        for i, op in enumerate(ops):
+            if op.uses_reserved:
+                if path is ops:
+                    path = list(ops)
+                path[i] = (op, name, shortname, tuple(dep))
+        # Undo the operators not shared with the previous leaf
+        shared = _common_prefix_length(path, self.path)
+        while len(self.path) > shared:
+            self.path.pop()
+            for key, value in reversed(self.undo.pop()):
+                if value is _deleted:
+                    dict.__delitem__(self.d, key)
+                else:
+                    dict.__setitem__(self.d, key, value)
+        dict.update(self.d, reserved)
+        if (self.base_len > shared or
+            shared - self.base_len > self.snapshot_distance):
+            self.base = dict(self.d)
+            self.base_len = shared
+        # Apply the remaining ones
+        for i in range(shared, len(path)):
+            self.d.log = []
+            ops[i].apply_to_dict(self.d)
+            self.path.append(path[i])
+            self.undo.append(self.d.log)
+        self.d.log = None
+        # Collect the changes made since the snapshot
+        local = dict(reserved)
+        for log in self.undo[self.base_len:]:
+            for key, _ in log:
+                if key in self.d:
+                    local[key] = self.d[key]
+                elif key in self.base:
+                    local[key] = _deleted
+                else:
+                    local.pop(key, None)
+        return LayeredDict(self.base, local)
 
 
 # StrReader and FileReader
@@ -683,8 +1249,10 @@ class FileReader(StrReader):
 
         @parse filename: The name of the input file.
         """
-        StrReader.__init__(self, open(filename).read())
+        s = open(filename).read()
+        StrReader.__init__(self, s)
         self.filename = filename
+        self.digest = hashlib.sha1(s).hexdigest()
 
 
 if __name__ == "__main__":
@@ -697,16 +1265,35 @@ if __name__ == "__main__":
                       help="show full dict names instead of short names")
     parser.add_option("-c", "--contents", dest="contents", action="store_true",
                       help="show dict contents")
+    parser.add_option("--cache-dir", dest="cache_dir",
+                      help="cache parsed trees and dicts in this directory")
+    parser.add_option("-q", "--query", dest="query", action="store_true",
+                      help="only walk the names of the dicts, without "
+                      "applying their operators")
+    parser.add_option("--count", dest="count", action="store_true",
+                      help="only show the number of dicts")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="number of processes used to generate the dicts "
+                      "(default: %default)")
 
     options, args = parser.parse_args()
     if not args:
         parser.error("filename required")
 
-    c = Parser(args[0], debug=options.debug)
+    c = Parser(args[0], debug=options.debug, cache_dir=options.cache_dir,
+               cache_dicts=bool(options.cache_dir), jobs=options.jobs)
     for s in args[1:]:
         c.parse_string(s)
 
-    for i, d in enumerate(c.get_dicts()):
+    if options.count:
+        print c.count()
+        sys.exit(0)
+
+    if options.query:
+        dicts = c.query()
+    else:
+        dicts = c.get_dicts()
+    for i, d in enumerate(dicts):
         if options.fullname:
             print "dict %4d:  %s" % (i + 1, d["name"])
         else:
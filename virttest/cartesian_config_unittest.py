@@ -0,0 +1,173 @@
+#!/usr/bin/python
+import unittest, os, shutil, tempfile
+import cartesian_config
+
+
+mainfile_content = """
+a = 1
+include included.cfg
+variants:
+    - x:
+        b = x
+    - y:
+        b = y
+        variants:
+            - y1:
+            - y2:
+                c = $b
+"""
+
+includedfile_content = """
+variants:
+    - p:
+    - q:
+        a += 2
+"""
+
+
+class CartesianConfigCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+        self.mainfile = os.path.join(self.tmpdir, "main.cfg")
+        self.includedfile = os.path.join(self.tmpdir, "included.cfg")
+        open(self.mainfile, "w").write(mainfile_content)
+        open(self.includedfile, "w").write(includedfile_content)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def _get_dicts(self, cache_dir, *extra):
+        parser = cartesian_config.Parser(self.mainfile, cache_dir=cache_dir,
+                                         cache_dicts=True)
+        for s in extra:
+            parser.parse_string(s)
+        return list(parser.get_dicts())
+
+
+    def test_cached_dicts_match_uncached(self):
+        reference = self._get_dicts(None, "no y1")
+        self.assertEqual(self._get_dicts(self.cache_dir, "no y1"), reference)
+        self.assertTrue(os.listdir(self.cache_dir))
+        # Second run is served from the cache
+        self.assertEqual(self._get_dicts(self.cache_dir, "no y1"), reference)
+        self.assertEqual(len(reference), 4)
+
+
+    def test_filters_are_part_of_the_key(self):
+        self._get_dicts(self.cache_dir)
+        self.assertEqual(len(self._get_dicts(self.cache_dir)), 6)
+        self.assertEqual(len(self._get_dicts(self.cache_dir, "only x")), 2)
+
+
+    def test_included_file_change_invalidates_cache(self):
+        self.assertEqual(len(self._get_dicts(self.cache_dir)), 6)
+        open(self.includedfile, "a").write("    - r:\n")
+        self.assertEqual(len(self._get_dicts(self.cache_dir)), 9)
+
+
+    def test_cached_dicts_are_copies(self):
+        dicts = self._get_dicts(self.cache_dir)
+        dicts[0]["a"] = "changed"
+        dicts[0]["dep"].append("changed")
+        dicts = self._get_dicts(self.cache_dir)
+        self.assertEqual(dicts[0]["a"], "1")
+        self.assertEqual(dicts[0]["dep"], [])
+
+
+    def test_cache_size(self):
+        parser = cartesian_config.Parser(self.mainfile,
+                                         cache_dir=self.cache_dir,
+                                         cache_dicts=True, cache_size=1)
+        list(parser.get_dicts())
+        # Only the latest entry (the dicts) is kept
+        self.assertEqual([f.split("-")[0] for f in os.listdir(self.cache_dir)],
+                         ["dicts"])
+        self.assertEqual(len(self._get_dicts(self.cache_dir)), 6)
+
+
+    def test_broken_cache_file(self):
+        self._get_dicts(self.cache_dir)
+        for filename in os.listdir(self.cache_dir):
+            open(os.path.join(self.cache_dir, filename), "w").write("junk")
+        self.assertEqual(len(self._get_dicts(self.cache_dir)), 6)
+
+
+class CartesianConfigDictsTest(unittest.TestCase):
+    content = """
+a = 1
+b_x = 2
+b_y = 3
+tag = ${name}-end
+variants:
+    - one:
+        a += 1
+        del b_y
+        c = $a/$shortname
+    - two:
+        b_.* ?= reset
+        b_z = new
+variants:
+    - p:
+        x = ${a}p
+    - q:
+        b_. ?<= $a
+        del a
+"""
+
+    def test_operators(self):
+        parser = cartesian_config.Parser()
+        parser.parse_string(self.content)
+        dicts = dict([(d["shortname"], d) for d in parser.get_dicts()])
+        self.assertEqual(dicts["p.one"],
+                         {"name": "p.one", "shortname": "p.one", "dep": [],
+                          "a": "11", "b_x": "2", "c": "11/p.one",
+                          "tag": "p.one-end", "x": "11p"})
+        self.assertEqual(dicts["q.one"],
+                         {"name": "q.one", "shortname": "q.one", "dep": [],
+                          "b_x": "112", "c": "11/q.one", "tag": "q.one-end"})
+        self.assertEqual(dicts["p.two"]["b_y"], "reset")
+        self.assertEqual(dicts["q.two"]["b_z"], "1new")
+
+
+    def test_query(self):
+        parser = cartesian_config.Parser()
+        parser.parse_string(self.content)
+        self.assertEqual(parser.count(), 4)
+        self.assertEqual(parser.count("only one"), 2)
+        self.assertTrue(parser.matches("only q\nno one"))
+        self.assertFalse(parser.matches("only three"))
+        self.assertEqual(list(parser.query("only q")),
+                         [{"name": "q.one", "shortname": "q.one", "dep": []},
+                          {"name": "q.two", "shortname": "q.two", "dep": []}])
+        keys = ["b_x", "c", "x"]
+        self.assertEqual(list(parser.query(keys=keys)),
+                         [dict([(key, d[key]) for key in d
+                                if key in keys + ["name", "shortname", "dep"]])
+                          for d in parser.get_dicts()])
+        # The filters are not kept
+        self.assertEqual(parser.count(), 4)
+        parser.parse_string("no p.two")
+        dicts = list(parser.get_dicts())
+        paths = [path for path, _ in parser.query(paths=True)]
+        self.assertEqual(len(paths), 3)
+        self.assertEqual([parser.get_leaf_dict(path) for path in paths],
+                         dicts)
+
+
+    def test_parallel(self):
+        serial = cartesian_config.Parser()
+        serial.parse_string(self.content)
+        parallel = cartesian_config.Parser(jobs=2)
+        parallel.parse_string(self.content)
+        parallel.parse_string("no q.two")
+        self.assertEqual(len(parallel._get_subtree_paths(4)), 3)
+        self.assertEqual([dict(d) for d in parallel.get_dicts()],
+                         [dict(d) for d in serial.get_dicts()
+                          if d["shortname"] != "q.two"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,10 @@
-import os, time, commands, re, logging, glob, threading, shutil, sys
+import os, time, commands, re, logging, glob, threading, shutil, sys, Queue
+import StringIO
 from autotest.client import utils
 from autotest.client.shared import error
 import aexpect, qemu_monitor, ppm_utils, test_setup, virt_vm, qemu_vm
 import libvirt_vm, video_maker, utils_misc, storage, qemu_storage
-import remote, ovirt, data_dir, utils_test
+import remote, ovirt, data_dir, utils_test, screendump_archive
 
 try:
     import PIL.Image
@@ -15,6 +16,11 @@ except ImportError:
 
 _screendump_thread = None
 _screendump_thread_termination_event = None
+# Time (in seconds) the screendump thread waits for the pending screendumps
+# to be encoded once told to terminate, and the extra time postprocess()
+# waits for it to take its last screendumps and close the archives
+_screendump_encoding_timeout = 60
+_screendump_termination_margin = 30
 
 
 def preprocess_image(test, params, image_name):
@@ -192,7 +198,7 @@ def postprocess_vm(test, params, env, name):
     # Encode an HTML 5 compatible video from the screenshots produced?
     screendump_dir = os.path.join(test.debugdir, "screendumps_%s" % vm.name)
     if (params.get("encode_video_files", "yes") == "yes" and
-        glob.glob("%s/*" % screendump_dir)):
+        screendump_archive.is_archive(screendump_dir)):
         try:
             video = video_maker.GstPythonVideoMaker()
             if (video.has_element('vp8enc') and video.has_element('webmmux')):
@@ -238,11 +244,116 @@ def process_command(test, params, env, command, command_timeout,
             raise
 
 
+_image_locks = {}
+_image_locks_lock = threading.Lock()
+
+
+def _get_image_lock(image_params):
+    """
+    Return the lock serializing the processing of an image file, for VMs
+    processed in parallel that share an image.
+    """
+    filename = storage.get_image_filename(image_params,
+                                          data_dir.get_data_dir())
+    _image_locks_lock.acquire()
+    try:
+        return _image_locks.setdefault(filename, threading.Lock())
+    finally:
+        _image_locks_lock.release()
+
+
+def _run_parallel(names, deps, func, workers):
+    """
+    Call func(name) for each name in names from up to workers threads.
+    A name is only started after all the names it depends on are done.
+
+    @param names: List of names, in the preferred starting order.
+    @param deps: Dict mapping names to lists of names they depend on (names
+            not in names are ignored).
+    @param func: Function to call for each name.
+    @param workers: Maximum number of concurrent calls.
+    @return: Dict mapping each name whose call raised an exception to its
+            exc_info, and list of the names skipped because of a failed (or
+            circular) dependency.
+    """
+    cond = threading.Condition()
+    pending = list(names)
+    finished = set()
+    failed = {}
+    skipped = []
+    running = [0]
+
+    def get_next():
+        # Return the next name to process, or None if there's nothing left
+        cond.acquire()
+        try:
+            while pending:
+                for name in pending:
+                    name_deps = [d for d in deps.get(name, []) if d in names]
+                    if [d for d in name_deps if d in failed or d in skipped]:
+                        pending.remove(name)
+                        skipped.append(name)
+                        cond.notifyAll()
+                        break
+                    if not [d for d in name_deps if d not in finished]:
+                        pending.remove(name)
+                        running[0] += 1
+                        return name
+                else:
+                    if not running[0]:
+                        # Nothing can run any more: circular dependencies
+                        skipped.extend(pending)
+                        del pending[:]
+                        cond.notifyAll()
+                        return None
+                    cond.wait()
+            return None
+        finally:
+            cond.release()
+
+    def worker():
+        while True:
+            name = get_next()
+            if name is None:
+                return
+            try:
+                func(name)
+                exc_info = None
+            except Exception:
+                exc_info = sys.exc_info()
+                logging.error("Error processing %s", name, exc_info=exc_info)
+            cond.acquire()
+            try:
+                running[0] -= 1
+                if exc_info:
+                    failed[name] = exc_info
+                else:
+                    finished.add(name)
+                cond.notifyAll()
+            finally:
+                cond.release()
+
+    threads = [threading.Thread(target=worker, name="process_worker_%d" % i)
+               for i in range(min(workers, len(names)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return failed, skipped
+
+
 def process(test, params, env, image_func, vm_func, vm_first=False):
     """
     Pre- or post-process VMs and images according to the instructions in params.
     Call image_func for each image listed in params and vm_func for each VM.
 
+    If the process_workers param is greater than 1, the VMs (each one
+    together with its images) are processed concurrently by up to that many
+    threads.  A VM is processed after the VMs listed in its process_after
+    param (or before them, when vm_first is set, as in postprocessing).
+    Errors are collected for all VMs: a single error is re-raised as is,
+    several errors are reported together as an error.TestError.
+
     @param test: An Autotest test object.
     @param params: A dict containing all VM and image parameters.
     @param env: The environment (a dict-like object).
@@ -250,38 +361,75 @@ def process(test, params, env, image_func, vm_func, vm_first=False):
     @param vm_func: A function to call for each VM.
     @param vm_first: Call vm_func first or not.
     """
-    def _call_vm_func():
-        for vm_name in params.objects("vms"):
-            vm_params = params.object_params(vm_name)
-            vm_func(test, vm_params, env, vm_name)
-
-    def _call_image_func():
-        if params.objects("vms"):
-            for vm_name in params.objects("vms"):
-                vm_params = params.object_params(vm_name)
-                vm = env.get_vm(vm_name)
-                for image_name in vm_params.objects("images"):
-                    image_params = vm_params.object_params(image_name)
-                    # Call image_func for each image
-                    if vm is not None and vm.is_alive():
-                        vm.pause()
-                    try:
-                        image_func(test, image_params, image_name)
-                    finally:
-                        if vm is not None and vm.is_alive():
-                            vm.resume()
-        else:
-            for image_name in params.objects("images"):
-                image_params = params.object_params(image_name)
+    def _call_vm_func(vm_name):
+        vm_params = params.object_params(vm_name)
+        vm_func(test, vm_params, env, vm_name)
+
+    def _call_image_func(vm_name):
+        vm_params = params.object_params(vm_name)
+        vm = env.get_vm(vm_name)
+        for image_name in vm_params.objects("images"):
+            image_params = vm_params.object_params(image_name)
+            # Call image_func for each image
+            if vm is not None and vm.is_alive():
+                vm.pause()
+            if parallel:
+                image_lock = _get_image_lock(image_params)
+                image_lock.acquire()
+            try:
                 image_func(test, image_params, image_name)
+            finally:
+                if parallel:
+                    image_lock.release()
+                if vm is not None and vm.is_alive():
+                    vm.resume()
+
+    def _call_funcs(vm_name):
+        if not vm_first:
+            _call_image_func(vm_name)
+        _call_vm_func(vm_name)
+        if vm_first:
+            _call_image_func(vm_name)
+
+    vm_names = params.objects("vms")
+    if not vm_names:
+        for image_name in params.objects("images"):
+            image_params = params.object_params(image_name)
+            image_func(test, image_params, image_name)
+        return
 
-    if not vm_first:
-        _call_image_func()
-
-    _call_vm_func()
+    workers = int(params.get("process_workers", 1))
+    parallel = workers > 1 and len(vm_names) > 1
+    if not parallel:
+        if not vm_first:
+            for vm_name in vm_names:
+                _call_image_func(vm_name)
+        for vm_name in vm_names:
+            _call_vm_func(vm_name)
+        if vm_first:
+            for vm_name in vm_names:
+                _call_image_func(vm_name)
+        return
 
-    if vm_first:
-        _call_image_func()
+    deps = {}
+    for vm_name in vm_names:
+        for dep in params.object_params(vm_name).objects("process_after"):
+            if vm_first:
+                deps.setdefault(dep, []).append(vm_name)
+            else:
+                deps.setdefault(vm_name, []).append(dep)
+    failed, skipped = _run_parallel(vm_names, deps, _call_funcs, workers)
+    if skipped:
+        logging.error("VMs not processed because of failed or circular "
+                      "process_after dependencies: %s", " ".join(skipped))
+    if len(failed) == 1 and not skipped:
+        exc_type, exc_value, exc_tb = failed.values()[0]
+        raise exc_type, exc_value, exc_tb
+    if failed or skipped:
+        msgs = ["%s: %s" % (vm_name, failed[vm_name][1])
+                for vm_name in vm_names if vm_name in failed]
+        msgs += ["%s: not processed" % vm_name for vm_name in skipped]
+        raise error.TestError("Error processing VMs (%s)" % "; ".join(msgs))
 
 
 @error.context_aware
@@ -301,6 +449,13 @@ def preprocess(test, params, env):
     if params.get('requires_root', 'no') == 'yes':
         utils_test.verify_running_as_root()
 
+    aexpect.use_multiplexer(params.get("aexpect_multiplexer") == "yes")
+    aexpect.set_output_limits(
+        int(params.get("aexpect_output_size", 0)),
+        int(params.get("aexpect_output_backups", 1)),
+        int(params.get("aexpect_reader_buffer_size",
+                       aexpect.READER_BUFFER_SIZE)))
+
     port = params.get('shell_port')
     prompt = params.get('shell_prompt')
     address = params.get('ovirt_node_address')
@@ -322,14 +477,16 @@ def preprocess(test, params, env):
             env["tcpdump"] = aexpect.ShellSession(
                 login_cmd,
                 output_func=_update_address_cache,
-                output_params=(env["address_cache"],))
+                output_params=(env["address_cache"],),
+                multiplex=False)
             remote._remote_login(env["tcpdump"], username, password, prompt)
             env["tcpdump"].sendline(cmd)
         else:
             env["tcpdump"] = aexpect.Tail(
                 command=cmd,
                 output_func=_update_address_cache,
-                output_params=(env["address_cache"],))
+                output_params=(env["address_cache"],),
+                multiplex=False)
 
         if utils_misc.wait_for(lambda: not env["tcpdump"].is_alive(),
                               0.1, 0.1, 1.0):
@@ -457,9 +614,16 @@ def postprocess(test, params, env):
 
     # Terminate the screendump thread
     global _screendump_thread, _screendump_thread_termination_event
+    screendumps_busy = False
     if _screendump_thread is not None:
         _screendump_thread_termination_event.set()
-        _screendump_thread.join(10)
+        _screendump_thread.join(_screendump_encoding_timeout +
+                                _screendump_termination_margin)
+        if _screendump_thread.isAlive():
+            logging.warning("The screendump thread did not terminate, "
+                            "keeping the screendump dirs it may still be "
+                            "writing")
+            screendumps_busy = True
         _screendump_thread = None
 
     # Warn about corrupt PPM files
@@ -484,7 +648,7 @@ def postprocess(test, params, env):
             os.unlink(f)
 
     # Should we keep the screendump dirs?
-    if params.get("keep_screendumps", "no") != "yes":
+    if params.get("keep_screendumps", "no") != "yes" and not screendumps_busy:
         for d in glob.glob(os.path.join(test.debugdir, "screendumps_*")):
             if os.path.isdir(d) and not os.path.islink(d):
                 shutil.rmtree(d, ignore_errors=True)
@@ -560,6 +724,95 @@ def _update_address_cache(address_cache, line):
             del address_cache["last_seen"]
 
 
+class _ScreendumpEncoder(object):
+    """
+    Encodes screendumps to JPEG on a pool of threads and stores them in
+    their screendump archive, so that taking screendumps does not wait for
+    the encoding.
+    """
+
+    def __init__(self, workers, quality, max_pending):
+        """
+        @param workers: Number of encoding threads.
+        @param quality: JPEG quality.
+        @param max_pending: Maximum number of screendumps waiting to be
+                encoded; further screendumps are dropped.
+        """
+        self.quality = quality
+        self._queue = Queue.Queue(max_pending)
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._encode,
+                                      name="screendump_encoder_%d" % i)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+
+    def _encode(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            archive, image_hash, image = job
+            # Whatever goes wrong with a screendump, keep encoding the
+            # following ones
+            try:
+                size = (image.width, image.height)
+                data = image.tostring()
+                try:
+                    pil_image = PIL.Image.frombytes("RGB", size, data)
+                except AttributeError:
+                    pil_image = PIL.Image.fromstring("RGB", size, data)
+                output = StringIO.StringIO()
+                pil_image.save(output, format="JPEG", quality=self.quality)
+                archive.store(image_hash, output.getvalue())
+            except NameError:
+                # No python imaging library
+                archive.forget(image_hash)
+            except Exception, error_detail:
+                logging.warning("Failed to encode screendump: %s",
+                                error_detail)
+                archive.forget(image_hash)
+
+
+    def add(self, archive, image_hash, image):
+        """
+        Encode a screendump and store it in a screendump archive.
+
+        @param archive: screendump_archive.ScreendumpArchive object.
+        @param image_hash: md5sum of the screendump.
+        @param image: ppm_utils.PPMImage of the screendump.
+        @return: False if the screendump was dropped because too many are
+                waiting to be encoded, True otherwise.
+        """
+        try:
+            self._queue.put_nowait((archive, image_hash, image))
+        except Queue.Full:
+            return False
+        return True
+
+
+    def close(self, timeout=60):
+        """
+        Encode the pending screendumps and stop the encoding threads.
+
+        @param timeout: Time (in seconds) to wait for the threads; the
+                screendumps not encoded by then are lost.
+        """
+        end_time = time.time() + timeout
+        for thread in self._threads:
+            try:
+                self._queue.put(None, timeout=max(0, end_time - time.time()))
+            except Queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(max(0, end_time - time.time()))
+        if [thread for thread in self._threads if thread.isAlive()]:
+            logging.warning("Screendump encoding did not finish in %s s, "
+                            "some screendumps may be lost", timeout)
+
+
 def _take_screendumps(test, params, env):
     global _screendump_thread_termination_event
     temp_dir = test.debugdir
@@ -576,84 +829,88 @@ def _take_screendumps(test, params, env):
     quality = int(params.get("screendump_quality", 30))
     inactivity_treshold = float(params.get("inactivity_treshold", 1800))
     inactivity_watcher = params.get("inactivity_watcher", "log")
+    workers = int(params.get("screendump_encoders", 2))
+    encoder = _ScreendumpEncoder(workers, quality, workers * 4)
 
-    cache = {}
-    counter = {}
+    cache_size = int(params.get("screendump_cache_size", 1024))
+    archives = {}
     inactivity = {}
 
-    while True:
-        for vm in env.get_all_vms():
-            if vm not in counter.keys():
-                counter[vm] = 0
-            if vm not in inactivity.keys():
-                inactivity[vm] = time.time()
-            if not vm.is_alive():
-                continue
-            try:
-                vm.screendump(filename=temp_filename, debug=False)
-            except qemu_monitor.MonitorError, e:
-                logging.warn(e)
-                continue
-            except AttributeError, e:
-                logging.warn(e)
-                continue
-            if not os.path.exists(temp_filename):
-                logging.warn("VM '%s' failed to produce a screendump", vm.name)
-                continue
-            if not ppm_utils.image_verify_ppm_file(temp_filename):
-                logging.warn("VM '%s' produced an invalid screendump", vm.name)
-                os.unlink(temp_filename)
-                continue
-            screendump_dir = os.path.join(test.debugdir,
-                                          "screendumps_%s" % vm.name)
-            try:
-                os.makedirs(screendump_dir)
-            except OSError:
-                pass
-            counter[vm] += 1
-            screendump_filename = os.path.join(screendump_dir, "%04d.jpg" %
-                                               counter[vm])
-            image_hash = utils.hash_file(temp_filename)
-            if image_hash in cache:
-                time_inactive = time.time() - inactivity[vm]
-                if time_inactive > inactivity_treshold:
-                    msg = ("%s screen is inactive for more than %d s (%d min)" %
-                           (vm.name, time_inactive, time_inactive/60))
-                    if inactivity_watcher == "error":
-                        try:
-                            raise virt_vm.VMScreenInactiveError(vm,
-                                                                time_inactive)
-                        except virt_vm.VMScreenInactiveError:
-                            logging.error(msg)
-                            # Let's reset the counter
-                            inactivity[vm] = time.time()
-                            test.background_errors.put(sys.exc_info())
-                    elif inactivity_watcher == 'log':
-                        logging.debug(msg)
+    try:
+        while True:
+            start_time = time.time()
+            for vm in env.get_all_vms():
+                if vm.name not in archives:
+                    screendump_dir = os.path.join(test.debugdir,
+                                                  "screendumps_%s" % vm.name)
+                    archives[vm.name] = screendump_archive.ScreendumpArchive(
+                                                    screendump_dir, cache_size)
+                    inactivity[vm.name] = time.time()
+                archive = archives[vm.name]
+                if not vm.is_alive():
+                    continue
                 try:
-                    os.link(cache[image_hash], screendump_filename)
-                except OSError:
-                    pass
-            else:
-                inactivity[vm] = time.time()
+                    vm.screendump(filename=temp_filename, debug=False)
+                except qemu_monitor.MonitorError, e:
+                    logging.warn(e)
+                    continue
+                except AttributeError, e:
+                    logging.warn(e)
+                    continue
+                # Read the screendump once, then work on it in memory
                 try:
                     try:
-                        image = PIL.Image.open(temp_filename)
-                        image.save(screendump_filename, format="JPEG",
-                                   quality=quality)
-                        cache[image_hash] = screendump_filename
-                    except IOError, error_detail:
-                        logging.warning("VM '%s' failed to produce a "
-                                        "screendump: %s", vm.name, error_detail)
-                        # Decrement the counter as we in fact failed to
-                        # produce a converted screendump
-                        counter[vm] -= 1
-                except NameError:
-                    pass
-            os.unlink(temp_filename)
-
-        if _screendump_thread_termination_event is not None:
-            if _screendump_thread_termination_event.isSet():
-                _screendump_thread_termination_event = None
-                break
-            _screendump_thread_termination_event.wait(delay)
+                        image = ppm_utils.PPMImage.from_file(temp_filename)
+                    finally:
+                        os.unlink(temp_filename)
+                except (IOError, OSError):
+                    logging.warn("VM '%s' failed to produce a screendump",
+                                 vm.name)
+                    continue
+                except ValueError:
+                    logging.warn("VM '%s' produced an invalid screendump",
+                                 vm.name)
+                    continue
+                timestamp = time.time()
+                image_hash = image.md5sum()
+                if archive.has_frame(image_hash):
+                    last_change = max(archive.last_change,
+                                      inactivity[vm.name])
+                    time_inactive = timestamp - last_change
+                    if time_inactive > inactivity_treshold:
+                        msg = ("%s screen is inactive for more than %d s "
+                               "(%d min)" % (vm.name, time_inactive,
+                                             time_inactive/60))
+                        if inactivity_watcher == "error":
+                            try:
+                                raise virt_vm.VMScreenInactiveError(vm,
+                                                                time_inactive)
+                            except virt_vm.VMScreenInactiveError:
+                                logging.error(msg)
+                                # Let's reset the counter
+                                inactivity[vm.name] = time.time()
+                                test.background_errors.put(sys.exc_info())
+                        elif inactivity_watcher == 'log':
+                            logging.debug(msg)
+                    archive.add(image_hash, timestamp)
+                else:
+                    archive.add(image_hash, timestamp)
+                    if not encoder.add(archive, image_hash, image):
+                        logging.debug("Too many screendumps waiting to be "
+                                      "encoded, dropping screendump of VM "
+                                      "'%s'", vm.name)
+                        archive.forget(image_hash)
+
+            if _screendump_thread_termination_event is not None:
+                if _screendump_thread_termination_event.isSet():
+                    _screendump_thread_termination_event = None
+                    break
+                # Keep the configured interval between screendumps,
+                # however long taking them took
+                elapsed = time.time() - start_time
+                _screendump_thread_termination_event.wait(max(delay - elapsed,
+                                                              0))
+    finally:
+        encoder.close(_screendump_encoding_timeout)
+        for archive in archives.values():
+            archive.close()
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+import unittest, threading, time, os, shutil, tempfile
+import common
+import env_process, utils_env, utils_params
+
+
+class RunParallelTest(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.calls = []
+
+
+    def func(self, fail=(), delay=0):
+        def _func(name):
+            self.lock.acquire()
+            try:
+                self.calls.append(("start", name))
+            finally:
+                self.lock.release()
+            time.sleep(delay)
+            self.lock.acquire()
+            try:
+                self.calls.append(("end", name))
+            finally:
+                self.lock.release()
+            if name in fail:
+                raise ValueError(name)
+        return _func
+
+
+    def index(self, event, name):
+        return self.calls.index((event, name))
+
+
+    def test_no_deps(self):
+        failed, skipped = env_process._run_parallel(
+            ["vm1", "vm2", "vm3"], {}, self.func(delay=0.2), 3)
+        self.assertEqual((failed, skipped), ({}, []))
+        # All names run at the same time
+        starts = [self.index("start", n) for n in ("vm1", "vm2", "vm3")]
+        ends = [self.index("end", n) for n in ("vm1", "vm2", "vm3")]
+        self.assertTrue(max(starts) < min(ends))
+
+
+    def test_workers(self):
+        failed, skipped = env_process._run_parallel(
+            ["vm1", "vm2", "vm3"], {}, self.func(delay=0.1), 1)
+        self.assertEqual((failed, skipped), ({}, []))
+        self.assertEqual(self.calls,
+                         [("start", "vm1"), ("end", "vm1"),
+                          ("start", "vm2"), ("end", "vm2"),
+                          ("start", "vm3"), ("end", "vm3")])
+
+
+    def test_deps(self):
+        deps = {"vm2": ["vm1"], "vm3": ["vm2", "image1"]}
+        failed, skipped = env_process._run_parallel(
+            ["vm3", "vm2", "vm1", "vm4"], deps, self.func(delay=0.1), 4)
+        self.assertEqual((failed, skipped), ({}, []))
+        self.assertTrue(self.index("end", "vm1") <
+                        self.index("start", "vm2"))
+        self.assertTrue(self.index("end", "vm2") <
+                        self.index("start", "vm3"))
+        # vm4 doesn't wait for anything
+        self.assertTrue(self.index("start", "vm4") <
+                        self.index("end", "vm1"))
+
+
+    def test_failure(self):
+        deps = {"vm2": ["vm1"], "vm3": ["vm2"]}
+        failed, skipped = env_process._run_parallel(
+            ["vm1", "vm2", "vm3", "vm4"], deps, self.func(fail=["vm1"]), 2)
+        self.assertEqual(failed.keys(), ["vm1"])
+        self.assertEqual(failed["vm1"][0], ValueError)
+        # The names depending on vm1 (directly or not) are skipped, the
+        # others still run
+        self.assertEqual(sorted(skipped), ["vm2", "vm3"])
+        self.assertEqual(sorted(n for e, n in self.calls if e == "start"),
+                         ["vm1", "vm4"])
+
+
+    def test_cycle(self):
+        deps = {"vm1": ["vm2"], "vm2": ["vm1"], "vm3": ["vm2"]}
+        failed, skipped = env_process._run_parallel(
+            ["vm1", "vm2", "vm3", "vm4"], deps, self.func(), 2)
+        self.assertEqual(failed, {})
+        self.assertEqual(sorted(skipped), ["vm1", "vm2", "vm3"])
+        self.assertEqual(self.calls, [("start", "vm4"), ("end", "vm4")])
+
+
+class FakeArchive(object):
+    def __init__(self):
+        self.stored = []
+        self.forgotten = []
+
+
+    def store(self, image_hash, data):
+        self.stored.append(image_hash)
+
+
+    def forget(self, image_hash):
+        self.forgotten.append(image_hash)
+
+
+class FakeImage(object):
+    width = 1
+    height = 1
+
+    def __init__(self, error=None, event=None):
+        self.error = error
+        self.event = event
+
+
+    def tostring(self):
+        if self.event:
+            self.event.wait()
+        if self.error:
+            raise self.error
+        return "\0\0\0"
+
+
+class ScreendumpEncoderTest(unittest.TestCase):
+    def test_errors(self):
+        encoder = env_process._ScreendumpEncoder(1, 30, 10)
+        archive = FakeArchive()
+        encoder.add(archive, "a", FakeImage(RuntimeError("a")))
+        encoder.add(archive, "b", FakeImage(MemoryError()))
+        encoder.add(archive, "c", FakeImage())
+        encoder.close()
+        # Failed screendumps are forgotten, and don't stop the encoder
+        self.assertEqual(archive.forgotten[:2], ["a", "b"])
+        self.assertEqual(len(archive.stored) + len(archive.forgotten), 3)
+
+
+    def test_close_timeout(self):
+        encoder = env_process._ScreendumpEncoder(1, 30, 1)
+        archive = FakeArchive()
+        event = threading.Event()
+        encoder.add(archive, "a", FakeImage(event=event))
+        time.sleep(0.1)
+        self.assertTrue(encoder.add(archive, "b", FakeImage()))
+        self.assertFalse(encoder.add(archive, "c", FakeImage()))
+        start = time.time()
+        encoder.close(timeout=0.3)
+        self.assertTrue(time.time() - start < 1)
+        event.set()
+
+
+
+class FakeTest(object):
+    def __init__(self, debugdir):
+        self.debugdir = debugdir
+
+
+class PostprocessTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.timeout = env_process._screendump_encoding_timeout
+        self.margin = env_process._screendump_termination_margin
+
+
+    def tearDown(self):
+        env_process._screendump_encoding_timeout = self.timeout
+        env_process._screendump_termination_margin = self.margin
+        shutil.rmtree(self.tmpdir)
+
+
+    def test_screendump_thread_alive(self):
+        # The screendump dirs are kept while the thread may write them
+        screendump_dir = os.path.join(self.tmpdir, "screendumps_vm1")
+        os.mkdir(screendump_dir)
+        release = threading.Event()
+        env_process._screendump_encoding_timeout = 0
+        env_process._screendump_termination_margin = 0.1
+        env_process._screendump_thread_termination_event = threading.Event()
+        env_process._screendump_thread = threading.Thread(target=release.wait)
+        env_process._screendump_thread.start()
+        try:
+            env_process.postprocess(FakeTest(self.tmpdir),
+                                    utils_params.Params(), utils_env.Env())
+            self.assertTrue(os.path.isdir(screendump_dir))
+        finally:
+            release.set()
+        env_process._screendump_thread_termination_event = None
+        env_process.postprocess(FakeTest(self.tmpdir), utils_params.Params(),
+                                utils_env.Env())
+        self.assertFalse(os.path.isdir(screendump_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,16 @@ Utility classes and functions to handle Virtual Machine creation using libvirt.
 @copyright: 2011 Red Hat Inc.
 """
 
-import time, os, logging, fcntl, re, shutil, tempfile
+import time, os, logging, fcntl, re, shutil, tempfile, threading
 from autotest.client.shared import error
 from autotest.client import utils
 import utils_misc, virt_vm, storage, aexpect, remote, virsh, libvirt_xml
 import data_dir, xml_utils
 
+# The lock file used by VM.create() only excludes other processes, this lock
+# excludes other threads of this process (see env_process.process())
+_create_lock = threading.Lock()
+
 
 def libvirtd_restart():
     """
@@ -169,22 +173,25 @@ class VM(virt_vm.BaseVM):
         """
         if not self.is_alive():
             raise virt_vm.VMDeadError("Domain %s is inactive" % self.name,
-                                      virsh.domstate(self.name,
-                                                     uri=self.connect_uri))
+                                      self.state())
 
 
     def is_alive(self):
         """
         Return True if VM is alive.
         """
-        return virsh.is_alive(self.name, uri=self.connect_uri)
+        # Read-only queries polled often (also state(), get_id() and
+        # get_xml()) run through the virsh session pool
+        return virsh.is_alive(self.name, uri=self.connect_uri,
+                              session_pool=True)
 
 
     def is_dead(self):
         """
         Return True if VM is dead.
         """
-        return virsh.is_dead(self.name, uri=self.connect_uri)
+        return virsh.is_dead(self.name, uri=self.connect_uri,
+                             session_pool=True)
 
 
     def is_persistent(self):
@@ -231,21 +238,24 @@ class VM(virt_vm.BaseVM):
         """
         Return domain state.
         """
-        return virsh.domstate(self.name, uri=self.connect_uri)
+        return virsh.domstate(self.name, uri=self.connect_uri,
+                              session_pool=True)
 
 
     def get_id(self):
         """
         Return VM's ID.
         """
-        return virsh.domid(self.name, uri=self.connect_uri)
+        return virsh.domid(self.name, uri=self.connect_uri,
+                           session_pool=True)
 
 
     def get_xml(self):
         """
         Return VM's xml file.
         """
-        return virsh.dumpxml(self.name, uri=self.connect_uri)
+        return virsh.dumpxml(self.name, uri=self.connect_uri,
+                             session_pool=True)
 
 
     def backup_xml(self):
@@ -839,7 +849,10 @@ class VM(virt_vm.BaseVM):
         params = self.params
         root_dir = self.root_dir
 
-        # Verify the md5sum of the ISO images
+        # Verify the md5sum of the ISO images, reusing the digests computed
+        # by previous runs as long as the files did not change
+        digest_cache = utils_misc.FileDigestCache(os.path.join(
+                                data_dir.get_tmp_dir(), "file_digests"))
         for cdrom in params.objects("cdroms"):
             if params.get("medium") == "import":
                 break
@@ -857,19 +870,19 @@ class VM(virt_vm.BaseVM):
                 if cdrom_params.get("md5sum_1m"):
                     logging.debug("Comparing expected MD5 sum with MD5 sum of "
                                   "first MB of ISO file...")
-                    actual_hash = utils.hash_file(iso, 1048576, method="md5")
+                    actual_hash = digest_cache.get_digest(iso, "md5", 1048576)
                     expected_hash = cdrom_params.get("md5sum_1m")
                     compare = True
                 elif cdrom_params.get("md5sum"):
                     logging.debug("Comparing expected MD5 sum with MD5 sum of "
                                   "ISO file...")
-                    actual_hash = utils.hash_file(iso, method="md5")
+                    actual_hash = digest_cache.get_digest(iso, "md5")
                     expected_hash = cdrom_params.get("md5sum")
                     compare = True
                 elif cdrom_params.get("sha1sum"):
                     logging.debug("Comparing expected SHA1 sum with SHA1 sum "
                                   "of ISO file...")
-                    actual_hash = utils.hash_file(iso, method="sha1")
+                    actual_hash = digest_cache.get_digest(iso, "sha1")
                     expected_hash = cdrom_params.get("sha1sum")
                     compare = True
                 if compare:
@@ -881,8 +894,13 @@ class VM(virt_vm.BaseVM):
 
         # Make sure the following code is not executed by more than one thread
         # at the same time
-        lockfile = open("/tmp/libvirt-autotest-vm-create.lock", "w+")
-        fcntl.lockf(lockfile, fcntl.LOCK_EX)
+        _create_lock.acquire()
+        try:
+            lockfile = open("/tmp/libvirt-autotest-vm-create.lock", "w+")
+            fcntl.lockf(lockfile, fcntl.LOCK_EX)
+        except Exception:
+            _create_lock.release()
+            raise
 
         try:
             # Handle port redirections
@@ -951,17 +969,22 @@ class VM(virt_vm.BaseVM):
                     "virsh console %s" % self.name,
                     auto_close=False,
                     output_func=utils_misc.log_line,
-                    output_params=("serial-%s.log" % name,))
+                    output_params=("serial-%s.log" % name,),
+                    multiplex=False)
             else:
                 self.serial_console = aexpect.ShellSession(
                     "tail -f %s" % self.get_serial_console_filename(),
                     auto_close=False,
                     output_func=utils_misc.log_line,
-                    output_params=("serial-%s.log" % name,))
+                    output_params=("serial-%s.log" % name,),
+                    multiplex=False)
 
         finally:
-            fcntl.lockf(lockfile, fcntl.LOCK_UN)
-            lockfile.close()
+            try:
+                fcntl.lockf(lockfile, fcntl.LOCK_UN)
+                lockfile.close()
+            finally:
+                _create_lock.release()
 
 
     def migrate(self, dest_uri="", option="--live --timeout 60", extra="",
@@ -1290,7 +1313,7 @@ class VM(virt_vm.BaseVM):
         while count > 0:
             # check every 5 seconds
             if count % 5 == 0:
-                if virsh.is_dead(self.name, uri=self.connect_uri):
+                if self.is_dead():
                     logging.debug("Shutdown took %d seconds", timeout - count)
                     return True
             count -= 1
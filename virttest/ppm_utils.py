@@ -4,11 +4,15 @@ Utility functions to deal with ppm (qemu screendump format) files.
 @copyright: Red Hat 2008-2009
 """
 
-import os, struct, time, re
+import os, time, re, binascii, operator, math
 try:
     import hashlib
 except ImportError:
     import md5
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Some directory/filename utils, for consistency
 
@@ -120,16 +124,8 @@ def image_crop(width, height, data, x1, y1, dx, dy):
     @return: A 3-tuple containing the width, height and data of the
     cropped image.
     """
-    if x1 > width - 1: x1 = width - 1
-    if y1 > height - 1: y1 = height - 1
-    if dx > width - x1: dx = width - x1
-    if dy > height - y1: dy = height - y1
-    newdata = ""
-    index = (x1 + y1*width) * 3
-    for _ in range(dy):
-        newdata += data[index:(index+dx*3)]
-        index += width*3
-    return (dx, dy, newdata)
+    cropped = PPMImage(width, height, data).crop(x1, y1, dx, dy)
+    return (cropped.width, cropped.height, cropped.tostring())
 
 
 def image_md5sum(width, height, data):
@@ -161,11 +157,11 @@ def get_region_md5sum(width, height, data, x1, y1, dx, dy,
     @param cropped_image_filename: if not None, write the resulting cropped
             image to a file with this name
     """
-    (cw, ch, cdata) = image_crop(width, height, data, x1, y1, dx, dy)
+    cropped = PPMImage(width, height, data).crop(x1, y1, dx, dy)
     # Write cropped image for debugging
     if cropped_image_filename:
-        image_write_to_ppm_file(cropped_image_filename, cw, ch, cdata)
-    return image_md5sum(cw, ch, cdata)
+        cropped.write(cropped_image_filename)
+    return cropped.md5sum()
 
 
 def image_verify_ppm_file(filename):
@@ -204,31 +200,9 @@ def image_comparison(width, height, data1, data2):
 
     @note: Input images must be the same size.
     """
-    newdata = ""
-    i = 0
-    while i < width*height*3:
-        # Compute monochromatic value of current pixel in data1
-        pixel1_str = data1[i:i+3]
-        temp = struct.unpack("BBB", pixel1_str)
-        value1 = int((temp[0] + temp[1] + temp[2]) / 3)
-        # Compute monochromatic value of current pixel in data2
-        pixel2_str = data2[i:i+3]
-        temp = struct.unpack("BBB", pixel2_str)
-        value2 = int((temp[0] + temp[1] + temp[2]) / 3)
-        # Compute average of the two values
-        value = int((value1 + value2) / 2)
-        # Scale value to the upper half of the range [0, 255]
-        value = 128 + value / 2
-        # Compare pixels
-        if pixel1_str == pixel2_str:
-            # Equal -- give the pixel a greenish hue
-            newpixel = [0, value, 0]
-        else:
-            # Not equal -- give the pixel a reddish hue
-            newpixel = [value, 0, 0]
-        newdata += struct.pack("BBB", newpixel[0], newpixel[1], newpixel[2])
-        i += 3
-    return (width, height, newdata)
+    image1 = PPMImage(width, height, data1)
+    image2 = PPMImage(width, height, data2)
+    return (width, height, image1.comparison(image2).tostring())
 
 
 def image_fuzzy_compare(width, height, data1, data2):
@@ -243,16 +217,476 @@ def image_fuzzy_compare(width, height, data1, data2):
 
     @note: Input images must be the same size.
     """
-    equal = 0.0
-    different = 0.0
-    i = 0
-    while i < width*height*3:
-        pixel1_str = data1[i:i+3]
-        pixel2_str = data2[i:i+3]
-        # Compare pixels
-        if pixel1_str == pixel2_str:
-            equal += 1.0
+    image1 = PPMImage(width, height, data1)
+    image2 = PPMImage(width, height, data2)
+    return image1.fuzzy_compare(image2)
+
+
+# Buffer backed images
+
+# Lookup tables used to compute the comparison image without numpy: the
+# monochromatic value of a pixel from the sum of its components, and the
+# shade of a comparison pixel from the sum of the monochromatic values
+_MONO_TABLE = [value / 3 for value in range(3 * 255 + 1)]
+_SHADE_TABLE = [128 + value / 2 / 2 for value in range(2 * 255 + 1)]
+# Translation tables mapping nonzero bytes to 1 and to 255
+_BOOL_TABLE = "\x00" + "\x01" * 255
+_MAP_TABLE = "\x00" + "\xff" * 255
+
+
+def _string_xor(data1, data2):
+    """
+    Return the bytewise xor of two strings of the same length.
+    """
+    if not data1:
+        return ""
+    value = (long(binascii.hexlify(data1), 16) ^
+             long(binascii.hexlify(data2), 16))
+    return binascii.unhexlify("%0*x" % (len(data1) * 2, value))
+
+
+def _string_or(*strings):
+    """
+    Return the bytewise or of strings of the same length.
+    """
+    if not strings[0]:
+        return ""
+    value = 0L
+    for data in strings:
+        value |= long(binascii.hexlify(data), 16)
+    return binascii.unhexlify("%0*x" % (len(strings[0]) * 2, value))
+
+
+def _diff_mask(data1, data2, row_size):
+    """
+    Compare two strings of RGB pixels, row by row.
+
+    @param row_size: Size of a row of pixels in bytes; only the rows that
+            differ are compared pixel by pixel.
+    @return: A string with one byte per pixel, zero for equal pixels and
+            nonzero for different pixels.
+    """
+    if data1 == data2:
+        return "\x00" * (len(data1) / 3)
+    equal_row = "\x00" * (row_size / 3)
+    mask = []
+    for start in xrange(0, len(data1), row_size):
+        row1 = data1[start:start + row_size]
+        row2 = data2[start:start + row_size]
+        if row1 == row2:
+            mask.append(equal_row)
+        else:
+            diff = _string_xor(row1, row2)
+            mask.append(_string_or(diff[0::3], diff[1::3], diff[2::3]))
+    return "".join(mask)
+
+
+def _mono_values(data):
+    """
+    Return the list of monochromatic values of a string of RGB pixels.
+    """
+    sums = map(operator.add, bytearray(data[0::3]), bytearray(data[1::3]))
+    sums = map(operator.add, sums, bytearray(data[2::3]))
+    return map(_MONO_TABLE.__getitem__, sums)
+
+
+def _numpy_pixels(data):
+    """
+    Return a string of RGB pixels as a numpy array of shape (pixels, 3).
+    """
+    return numpy.frombuffer(data, numpy.uint8).reshape(-1, 3)
+
+
+def _block_bounds(size, blocks):
+    """
+    Split range(size) into the given number of blocks.
+
+    @return: A list of (start, end) tuples.  Blocks are never empty, so
+            consecutive blocks may overlap if size < blocks.
+    """
+    starts = [i * size / blocks for i in range(blocks)] + [size]
+    return [(starts[i], max(starts[i + 1], starts[i] + 1))
+            for i in range(blocks)]
+
+
+def _dct_matrix(size, coefficients):
+    """
+    Return the DCT-II basis: coefficients rows of size cosines.
+    """
+    return [[math.cos(math.pi * k * (2 * n + 1) / (2.0 * size))
+             for n in range(size)] for k in range(coefficients)]
+
+
+def hash_distance(hash1, hash2):
+    """
+    Return the number of bits that differ between two image hashes (see
+    PPMImage.average_hash() and PPMImage.perceptual_hash()).
+    """
+    return bin(hash1 ^ hash2).count("1")
+
+
+class PPMImage(object):
+    """
+    An image in PPM (P6) format, possibly a view of a region of the data of
+    another image.
+
+    Cropping returns a view that shares the data of the original image, so
+    no data is copied unless the pixels of a cropped image are requested
+    with tostring().  Hashing reads the rows of the view in place, and
+    comparisons work on whole images at a time, using numpy if available.
+    """
+
+    def __init__(self, width, height, data, offset=0, stride=None):
+        """
+        @param width: Image width (pixels)
+        @param height: Image height (pixels)
+        @param data: String holding the pixels (3 bytes per pixel, RGB)
+        @param offset: Position of the first pixel of the image in data
+        @param stride: Distance in bytes between the start of consecutive
+                rows in data (default: width * 3)
+        """
+        self.width = width
+        self.height = height
+        self.data = data
+        self.offset = offset
+        if stride is None:
+            stride = width * 3
+        self.stride = stride
+
+
+    @classmethod
+    def from_string(cls, contents):
+        """
+        Create an image from the contents of a PPM file.
+
+        @raise ValueError: If contents is not a valid PPM image.
+        """
+        try:
+            magic, size, maxval, data = contents.split("\n", 3)
+            width, height = map(int, size.split())
+        except ValueError:
+            raise ValueError("Invalid PPM header")
+        if magic.strip() != "P6" or maxval.strip() != "255":
+            raise ValueError("Invalid PPM header")
+        if width <= 0 or height <= 0 or len(data) != width * height * 3:
+            raise ValueError("Invalid PPM image: dimensions: %sx%s, "
+                             "data size: %d" % (width, height, len(data)))
+        return cls(width, height, data)
+
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Read an image from a PPM file.
+
+        @raise ValueError: If filename is not a valid PPM image.
+        """
+        fin = open(filename, "rb")
+        try:
+            return cls.from_string(fin.read())
+        finally:
+            fin.close()
+
+
+    def is_contiguous(self):
+        """
+        Return True if the rows of the image are contiguous in its data.
+        """
+        return self.stride == self.width * 3
+
+
+    def rows(self):
+        """
+        Iterate over the rows of the image, as buffers sharing its data.
+        """
+        row_size = self.width * 3
+        for y in xrange(self.height):
+            yield buffer(self.data, self.offset + y * self.stride, row_size)
+
+
+    def tostring(self):
+        """
+        Return the pixels of the image as a string (3 bytes per pixel).
+        """
+        size = self.width * self.height * 3
+        if self.is_contiguous():
+            if self.offset == 0 and len(self.data) == size:
+                return self.data
+            return self.data[self.offset:self.offset + size]
+        return "".join([str(row) for row in self.rows()])
+
+
+    def header(self):
+        """
+        Return the PPM header of the image.
+        """
+        return "P6\n%d %d\n255\n" % (self.width, self.height)
+
+
+    def write(self, filename):
+        """
+        Write the image to a PPM file.
+        """
+        fout = open(filename, "wb")
+        try:
+            fout.write(self.header())
+            for row in self.rows():
+                fout.write(row)
+        finally:
+            fout.close()
+
+
+    def md5sum(self):
+        """
+        Return the md5sum of the image in PPM format, without copying its
+        data (same as image_md5sum()).
+        """
+        hsh = md5eval(self.header())
+        if self.is_contiguous():
+            hsh.update(buffer(self.data, self.offset,
+                              self.width * self.height * 3))
+        else:
+            for row in self.rows():
+                hsh.update(row)
+        return hsh.hexdigest()
+
+
+    def crop(self, x1, y1, dx, dy):
+        """
+        Return a view of a region of the image.  The region is clipped to
+        the image bounds the same way image_crop() does.
+
+        @param x1: x coordinate of the region
+        @param y1: y coordinate of the region
+        @param dx: Width of the region
+        @param dy: Height of the region
+        """
+        if x1 > self.width - 1: x1 = self.width - 1
+        if y1 > self.height - 1: y1 = self.height - 1
+        if dx > self.width - x1: dx = self.width - x1
+        if dy > self.height - y1: dy = self.height - y1
+        offset = self.offset + y1 * self.stride + x1 * 3
+        return PPMImage(dx, dy, self.data, offset, self.stride)
+
+
+    def _check_size(self, other):
+        if (self.width, self.height) != (other.width, other.height):
+            raise ValueError("Images differ in size: %dx%d, %dx%d" %
+                             (self.width, self.height,
+                              other.width, other.height))
+
+
+    def diff_map(self, other):
+        """
+        Compare the image with another one of the same size.
+
+        @return: A string with one byte per pixel, 0 for equal pixels and
+                255 for different pixels.
+        """
+        self._check_size(other)
+        if numpy is not None:
+            diff = (_numpy_pixels(self.tostring()) !=
+                    _numpy_pixels(other.tostring())).any(axis=1)
+            return (diff.astype(numpy.uint8) * 255).tostring()
+        mask = _diff_mask(self.tostring(), other.tostring(), self.width * 3)
+        return mask.translate(_MAP_TABLE)
+
+
+    def fuzzy_compare(self, other):
+        """
+        Return the degree of equality of the image and another one of the
+        same size, as the ratio equal_pixel_count / total_pixel_count.
+        """
+        self._check_size(other)
+        total = float(self.width * self.height)
+        data1 = self.tostring()
+        data2 = other.tostring()
+        if data1 == data2:
+            return 1.0
+        if numpy is not None:
+            pixels1 = _numpy_pixels(data1)
+            pixels2 = _numpy_pixels(data2)
+            different = (pixels1 != pixels2).any(axis=1).sum()
+            return (total - different) / total
+        mask = _diff_mask(data1, data2, self.width * 3)
+        return mask.count("\x00") / total
+
+
+    def comparison(self, other):
+        """
+        Generate a green-red comparison image from the image and another
+        one of the same size: equal pixels are given a greenish hue,
+        different pixels a reddish hue (see image_comparison()).
+        """
+        self._check_size(other)
+        data1 = self.tostring()
+        data2 = other.tostring()
+        if numpy is not None:
+            pixels1 = _numpy_pixels(data1)
+            pixels2 = _numpy_pixels(data2)
+            diff = (pixels1 != pixels2).any(axis=1)
+            mono1 = pixels1.sum(axis=1, dtype=numpy.int32) / 3
+            mono2 = pixels2.sum(axis=1, dtype=numpy.int32) / 3
+            shade = (128 + (mono1 + mono2) / 2 / 2).astype(numpy.uint8)
+            newpixels = numpy.zeros(pixels1.shape, numpy.uint8)
+            newpixels[diff, 0] = shade[diff]
+            newpixels[~diff, 1] = shade[~diff]
+            return PPMImage(self.width, self.height, newpixels.tostring())
+        sums = map(operator.add, _mono_values(data1), _mono_values(data2))
+        shade = map(_SHADE_TABLE.__getitem__, sums)
+        mask = _diff_mask(data1, data2, self.width * 3)
+        mask = bytearray(mask.translate(_BOOL_TABLE))
+        red = map(operator.mul, shade, mask)
+        newdata = bytearray(len(data1))
+        newdata[0::3] = red
+        newdata[1::3] = map(operator.sub, shade, red)
+        return PPMImage(self.width, self.height, str(newdata))
+
+
+    def copy(self):
+        """
+        Return a copy of the image that does not share its data.
+        """
+        return PPMImage(self.width, self.height, str(self.tostring()))
+
+
+    def block_means(self, cols, rows):
+        """
+        Scale the image down to cols x rows blocks.
+
+        @return: A list of rows lists of cols values, each value being the
+                mean brightness (0-255) of the pixels of a block.
+        """
+        xbounds = _block_bounds(self.width, cols)
+        ybounds = _block_bounds(self.height, rows)
+        if numpy is not None:
+            pixels = _numpy_pixels(self.tostring()).reshape(self.height,
+                                                            self.width, 3)
+            sums = pixels.sum(axis=2, dtype=numpy.int64)
+            sums = numpy.add.reduceat(sums, [y0 for y0, y1 in ybounds], axis=0)
+            sums = numpy.add.reduceat(sums, [x0 for x0, x1 in xbounds], axis=1)
+            sums = sums.tolist()
         else:
-            different += 1.0
-        i += 3
-    return equal / (equal + different)
+            rows_data = list(self.rows())
+            sums = []
+            for y0, y1 in ybounds:
+                band = [0] * self.width
+                for row in rows_data[y0:y1]:
+                    row = str(row)
+                    band = map(operator.add, band, bytearray(row[0::3]))
+                    band = map(operator.add, band, bytearray(row[1::3]))
+                    band = map(operator.add, band, bytearray(row[2::3]))
+                sums.append([sum(band[x0:x1]) for x0, x1 in xbounds])
+        means = []
+        for j, (y0, y1) in enumerate(ybounds):
+            means.append([sums[j][i] / (3.0 * (x1 - x0) * (y1 - y0))
+                          for i, (x0, x1) in enumerate(xbounds)])
+        return means
+
+
+    def average_hash(self, hash_size=8):
+        """
+        Return the average hash of the image: a hash_size * hash_size bit
+        integer, each bit telling whether a block of the image is brighter
+        than the mean.  Similar images have hashes differing in few bits
+        (see hash_distance()).
+        """
+        values = sum(self.block_means(hash_size, hash_size), [])
+        mean = sum(values) / len(values)
+        image_hash = 0L
+        for value in values:
+            image_hash = (image_hash << 1) | (value > mean)
+        return image_hash
+
+
+    def perceptual_hash(self, hash_size=8, scale=4):
+        """
+        Return the perceptual hash of the image: a hash_size * hash_size
+        bit integer, each bit telling whether a low frequency coefficient
+        of the DCT of the image, scaled down to hash_size * scale blocks
+        per side, is above the median.  It is less sensitive than the
+        average hash to small changes in brightness and contrast.
+        """
+        size = hash_size * scale
+        dct = _dct_matrix(size, hash_size)
+        means = self.block_means(size, size)
+        # DCT of the rows, then of the columns of the result
+        rows = [[sum(map(operator.mul, basis, row)) for basis in dct]
+                for row in means]
+        columns = zip(*rows)
+        values = []
+        for basis in dct:
+            values.extend([sum(map(operator.mul, basis, column))
+                           for column in columns])
+        # The first value (DC coefficient) is the mean brightness
+        median = sorted(values[1:])[len(values[1:]) / 2]
+        image_hash = 0L
+        for value in values:
+            image_hash = (image_hash << 1) | (value > median)
+        return image_hash
+
+
+class RegionMatcher(object):
+    """
+    Matches a region of screendumps against an expected region, given by
+    its md5sum and, optionally, by the expected screendump.
+
+    Without the expected screendump or a similarity threshold, a region
+    matches only if its md5sum is the expected one.  Otherwise a region
+    with a different md5sum still matches if its perceptual hash is close
+    to the one of the expected region and the fraction of equal pixels is
+    at least the similarity threshold, so changes like a blinking cursor
+    or a clock do not prevent the match.  The hash of the expected region
+    is computed once, when the matcher is created.
+    """
+
+    def __init__(self, md5sum, x1, y1, dx, dy, expected=None,
+                 similarity=None, max_distance=5):
+        """
+        @param md5sum: md5sum of the expected region (see
+                get_region_md5sum())
+        @param x1: x coordinate of the region
+        @param y1: y coordinate of the region
+        @param dx: Width of the region
+        @param dy: Height of the region
+        @param expected: PPMImage of the expected screendump, or None
+        @param similarity: Minimum fraction of equal pixels for a region
+                to match the expected one, or None to only accept an exact
+                match
+        @param max_distance: Maximum number of bits that may differ between
+                the perceptual hashes of the region and the expected one
+        """
+        self.md5sum = md5sum
+        self.region = (x1, y1, dx, dy)
+        self.similarity = similarity
+        self.max_distance = max_distance
+        self.expected = None
+        self.expected_hash = None
+        if expected is not None and similarity is not None:
+            self.expected = expected.crop(x1, y1, dx, dy).copy()
+            self.expected_hash = self.expected.perceptual_hash()
+
+
+    def match(self, image):
+        """
+        Check whether the region of a screendump matches the expected one.
+
+        @param image: PPMImage of the screendump.
+        @return: A tuple (matched, similarity), similarity being the
+                fraction of equal pixels if it was computed, 1.0 for an
+                exact match and None otherwise.
+        """
+        region = image.crop(*self.region)
+        if region.md5sum() == self.md5sum:
+            return True, 1.0
+        if self.expected is None:
+            return False, None
+        if ((region.width, region.height) !=
+            (self.expected.width, self.expected.height)):
+            return False, None
+        distance = hash_distance(region.perceptual_hash(),
+                                 self.expected_hash)
+        if distance > self.max_distance:
+            return False, None
+        similarity = region.fuzzy_compare(self.expected)
+        return similarity >= self.similarity, similarity
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+import unittest, os, tempfile, shutil
+import ppm_utils
+
+
+def make_image(width, height):
+    data = "".join([chr((x * 7 + y * 13) % 256) * 3
+                    for y in range(height) for x in range(width)])
+    return ppm_utils.PPMImage(width, height, data)
+
+
+class PPMImageTest(unittest.TestCase):
+    def setUp(self):
+        self.image = make_image(8, 6)
+
+
+    def test_crop_is_a_view(self):
+        cropped = self.image.crop(2, 1, 3, 4)
+        self.assertTrue(cropped.data is self.image.data)
+        self.assertEqual((cropped.width, cropped.height), (3, 4))
+        expected = "".join([self.image.data[(y * 8 + 2) * 3:(y * 8 + 5) * 3]
+                            for y in range(1, 5)])
+        self.assertEqual(cropped.tostring(), expected)
+        # Cropping a view is relative to the view
+        self.assertEqual(cropped.crop(1, 1, 1, 1).tostring(),
+                         self.image.crop(3, 2, 1, 1).tostring())
+
+
+    def test_crop_is_clipped(self):
+        cropped = self.image.crop(6, 4, 10, 10)
+        self.assertEqual((cropped.width, cropped.height), (2, 2))
+
+
+    def test_md5sum(self):
+        cropped = self.image.crop(2, 1, 3, 4)
+        self.assertEqual(cropped.md5sum(),
+                         ppm_utils.image_md5sum(3, 4, cropped.tostring()))
+        self.assertEqual(self.image.md5sum(),
+                         ppm_utils.image_md5sum(8, 6, self.image.data))
+
+
+    def test_from_string(self):
+        contents = self.image.header() + self.image.data
+        image = ppm_utils.PPMImage.from_string(contents)
+        self.assertEqual((image.width, image.height), (8, 6))
+        self.assertEqual(image.data, self.image.data)
+        self.assertRaises(ValueError, ppm_utils.PPMImage.from_string,
+                          contents[:-1])
+        self.assertRaises(ValueError, ppm_utils.PPMImage.from_string,
+                          "P5" + contents[2:])
+
+
+    def test_write(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "cropped.ppm")
+            self.image.crop(2, 1, 3, 4).write(filename)
+            self.assertTrue(ppm_utils.image_verify_ppm_file(filename))
+            self.assertEqual(ppm_utils.image_read_from_ppm_file(filename),
+                             (3, 4, self.image.crop(2, 1, 3, 4).tostring()))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+    def test_compare(self):
+        other = ppm_utils.PPMImage(2, 2, "\x00\x00\x00\x03\x03\x03"
+                                         "\xff\xff\xff\x10\x20\x30")
+        changed = ppm_utils.PPMImage(2, 2, "\x00\x00\x00\x03\x03\x06"
+                                           "\xff\xff\xff\x10\x20\x31")
+        self.assertEqual(other.fuzzy_compare(other), 1.0)
+        self.assertEqual(other.fuzzy_compare(changed), 0.5)
+        self.assertEqual(other.diff_map(changed), "\x00\xff\x00\xff")
+        self.assertEqual(other.comparison(changed).tostring(),
+                         "\x00\x80\x00\x81\x00\x00"
+                         "\x00\xff\x00\x90\x00\x00")
+        self.assertRaises(ValueError, other.fuzzy_compare, self.image)
+
+
+class ImageHashTest(unittest.TestCase):
+    def setUp(self):
+        self.image = make_image(64, 48)
+        data = bytearray(self.image.data)
+        # A few changed pixels, like a blinking cursor
+        data[(20 * 64 + 30) * 3:(20 * 64 + 32) * 3] = "\xff" * 6
+        self.changed = ppm_utils.PPMImage(64, 48, str(data))
+        self.other = ppm_utils.PPMImage(64, 48, self.image.data[::-1])
+
+
+    def test_block_means(self):
+        image = ppm_utils.PPMImage(2, 2, "\x00\x00\x00\x03\x03\x03"
+                                         "\x06\x06\x06\x09\x09\x0c")
+        self.assertEqual(image.block_means(1, 1), [[4.75]])
+        self.assertEqual(image.block_means(2, 1), [[3.0, 6.5]])
+        # Blocks are never empty
+        self.assertEqual(image.block_means(4, 1), [[3.0, 3.0, 6.5, 6.5]])
+
+
+    def test_hashes(self):
+        for func in (ppm_utils.PPMImage.average_hash,
+                     ppm_utils.PPMImage.perceptual_hash):
+            image_hash = func(self.image)
+            self.assertEqual(func(self.image.copy()), image_hash)
+            self.assertTrue(ppm_utils.hash_distance(
+                                    func(self.changed), image_hash) <= 2)
+            self.assertTrue(ppm_utils.hash_distance(
+                                    func(self.other), image_hash) > 10)
+
+
+    def test_region_matcher(self):
+        region = (16, 8, 32, 32)
+        md5sum = self.image.crop(*region).md5sum()
+        exact = ppm_utils.RegionMatcher(md5sum, *region)
+        self.assertEqual(exact.match(self.image), (True, 1.0))
+        self.assertEqual(exact.match(self.changed), (False, None))
+        similar = ppm_utils.RegionMatcher(md5sum, expected=self.image,
+                                          similarity=0.99, *region)
+        matched, similarity = similar.match(self.changed)
+        self.assertTrue(matched)
+        self.assertEqual(similarity, 1 - 2 / 1024.0)
+        self.assertEqual(similar.match(self.other), (False, None))
+        strict = ppm_utils.RegionMatcher(md5sum, expected=self.image,
+                                         similarity=0.999, *region)
+        self.assertFalse(strict.match(self.changed)[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
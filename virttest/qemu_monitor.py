@@ -4,7 +4,8 @@ Interfaces to the QEMU monitor.
 @copyright: 2008-2010 Red Hat Inc.
 """
 
-import socket, time, threading, logging, select, re, os
+import socket, time, threading, logging, select, re, os, fcntl, weakref
+import collections
 import utils_misc, passfd_setup
 from autotest.client.shared import utils
 try:
@@ -614,15 +615,142 @@ class HumanMonitor(Monitor):
         return self.cmd("getfd %s" % name, fd=fd)
 
 
+class _QMPStreamDecoder(object):
+    """
+    Incremental decoder of the QMP stream.
+
+    QMP sends one JSON object per line.  Data is split in lines as it
+    arrives, and each complete line is decoded exactly once; the incomplete
+    last line is kept until the rest of it arrives.
+    """
+    def __init__(self):
+        self._pieces = []
+
+
+    def feed(self, data):
+        """
+        Add data read from the socket.
+
+        @param data: Data read from the socket.
+        @return: A list of (line, obj) tuples, one per complete line that was
+                decoded successfully.
+        """
+        index = data.rfind("\n")
+        if index < 0:
+            if data:
+                self._pieces.append(data)
+            return []
+        self._pieces.append(data[:index])
+        lines = "".join(self._pieces).split("\n")
+        self._pieces = [data[index + 1:]]
+        objs = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                objs.append((line, json.loads(line)))
+            except ValueError:
+                logging.debug("Ignoring undecodable QMP line: %r", line)
+        return objs
+
+
+class _Waiter(object):
+    """
+    Lets a thread sleep until the QMP reader thread wakes it up, through a
+    pipe (unlike threading.Condition.wait() with a timeout, which polls).
+    """
+    def __init__(self):
+        self._r, self._w = os.pipe()
+        fcntl.fcntl(self._w, fcntl.F_SETFL,
+                    fcntl.fcntl(self._w, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+    def __del__(self):
+        os.close(self._r)
+        os.close(self._w)
+
+
+    def wake(self):
+        try:
+            os.write(self._w, "x")
+        except OSError:
+            # The pipe is full, so the waiter will wake up anyway
+            pass
+
+
+    def wait(self, timeout):
+        if select.select([self._r], [], [], timeout)[0]:
+            os.read(self._r, 4096)
+
+
+_waiters = threading.local()
+
+
+def _get_waiter():
+    # Return the _Waiter of the current thread
+    waiter = getattr(_waiters, "waiter", None)
+    if waiter is None:
+        waiter = _waiters.waiter = _Waiter()
+    return waiter
+
+
+def _qmp_reader(monitor_ref, sock):
+    """
+    Body of the reader thread of a QMPMonitor: read from the monitor socket
+    and pass the decoded objects to the monitor, until the socket is closed.
+
+    Only a weak reference to the monitor is kept between reads, so the
+    thread doesn't keep the monitor from being garbage collected (and its
+    socket from being closed).
+    """
+    decoder = _QMPStreamDecoder()
+    while True:
+        try:
+            r = select.select([sock], [], [], 0.5)[0]
+        except (select.error, socket.error, ValueError, TypeError):
+            r = None
+        monitor = monitor_ref()
+        if monitor is None:
+            return
+        if r is None:
+            monitor._reader_closed()
+            return
+        if r:
+            try:
+                data = sock.recv(65536)
+            except socket.error:
+                data = ""
+            if not data:
+                monitor._reader_closed()
+                return
+            monitor._dispatch(decoder.feed(data))
+        del monitor
+
+
 class QMPMonitor(Monitor):
     """
     Wraps QMP monitor commands.
+
+    A background thread reads and decodes everything QEMU sends, storing
+    asynchronous events and handing responses to the callers waiting for
+    them by id.  The monitor lock is only held while sending, so several
+    threads can have commands in flight at the same time, and a single
+    caller can pipeline commands with send_cmd() and get_response().
+
+    Events are kept in arrival order and indexed by name, up to MAX_EVENTS
+    events in total and MAX_EVENTS_PER_NAME events of each name (the oldest
+    ones are dropped), until clear_events() is called.  Each event gets a
+    'seq' key, its sequence number in the monitor (starting at 1, and not
+    reset by clear_events()), which tells events received after a given
+    one apart.
     """
 
-    READ_OBJECTS_TIMEOUT = 5
     CMD_TIMEOUT = 20
     RESPONSE_TIMEOUT = 20
     PROMPT_TIMEOUT = 20
+    MAX_EVENTS = 1024
+    MAX_EVENTS_PER_NAME = 256
 
     def __init__(self, name, filename, suppress_exceptions=False):
         """
@@ -645,7 +773,9 @@ class QMPMonitor(Monitor):
 
             self.protocol = "qmp"
             self._greeting = None
-            self._events = []
+            self._events = collections.deque(maxlen=self.MAX_EVENTS)
+            self._events_by_name = {}
+            self._event_seq = 0
 
             # Make sure json is available
             try:
@@ -654,17 +784,23 @@ class QMPMonitor(Monitor):
                 raise MonitorNotSupportedError("QMP requires the json module "
                                                "(Python 2.6 and up)")
 
+            # Responses are routed by the reader thread: those with the id of
+            # a command sent by send_cmd() go to _responses, other responses
+            # to _unrouted (see cmd_raw())
+            self._state_lock = threading.Lock()
+            self._waiters = set()
+            self._responses = {}
+            self._unrouted = collections.deque(maxlen=100)
+            self._reader_done = False
+            self._reader = threading.Thread(target=_qmp_reader,
+                                            args=(weakref.ref(self),
+                                                  self._socket),
+                                            name="qmp_reader_%s" % name)
+            self._reader.setDaemon(True)
+            self._reader.start()
+
             # Read greeting message
-            end_time = time.time() + 20
-            while time.time() < end_time:
-                for obj in self._read_objects():
-                    if "QMP" in obj:
-                        self._greeting = obj
-                        break
-                if self._greeting:
-                    break
-                time.sleep(0.1)
-            else:
+            if not self._wait(lambda: self._greeting, 20):
                 raise MonitorProtocolError("No QMP greeting message received")
 
             # Issue qmp_capabilities
@@ -691,44 +827,85 @@ class QMPMonitor(Monitor):
         return obj
 
 
-    def _read_objects(self, timeout=READ_OBJECTS_TIMEOUT):
+    def _dispatch(self, objs):
         """
-        Read lines from the monitor and try to decode them.
-        Stop when all available lines have been successfully decoded, or when
-        timeout expires.  If any decoded objects are asynchronous events, store
-        them in self._events.  Return all decoded objects.
+        Store the objects decoded by the reader thread: keep asynchronous
+        events and route responses to whoever is waiting for them.
 
-        @param timeout: Time to wait for all lines to decode successfully
-        @return: A list of objects
+        @param objs: List of (line, obj) tuples (see _QMPStreamDecoder).
         """
-        if not self._data_available():
-            return []
-        s = ""
+        self._state_lock.acquire()
+        try:
+            for line, obj in objs:
+                self._log_lines(line)
+                if not isinstance(obj, dict):
+                    continue
+                if "event" in obj:
+                    self._event_seq += 1
+                    obj["seq"] = self._event_seq
+                    self._events.append(obj)
+                    events = self._events_by_name.get(obj["event"])
+                    if events is None:
+                        events = collections.deque(
+                                            maxlen=self.MAX_EVENTS_PER_NAME)
+                        self._events_by_name[obj["event"]] = events
+                    events.append(obj)
+                elif "QMP" in obj:
+                    self._greeting = obj
+                elif "return" in obj or "error" in obj:
+                    q_id = obj.get("id")
+                    if q_id is not None and q_id in self._responses:
+                        self._responses[q_id] = obj
+                    else:
+                        self._unrouted.append(obj)
+            self._wake_waiters()
+        finally:
+            self._state_lock.release()
+
+
+    def _reader_closed(self):
+        """
+        Called by the reader thread when the connection is closed, to wake
+        up the callers waiting for responses.
+        """
+        self._state_lock.acquire()
+        try:
+            self._reader_done = True
+            self._wake_waiters()
+        finally:
+            self._state_lock.release()
+
+
+    def _wake_waiters(self):
+        # Must be called with self._state_lock held
+        for waiter in self._waiters:
+            waiter.wake()
+
+
+    def _wait(self, func, timeout):
+        """
+        Wait until func returns something true, or until timeout expires or
+        the connection is closed.
+
+        @param func: Function checking the state kept by the reader thread
+                (called with self._state_lock held).
+        @param timeout: Time duration to wait
+        @return: The last value returned by func
+        """
+        waiter = _get_waiter()
         end_time = time.time() + timeout
-        while self._data_available(end_time - time.time()):
-            s += self._recvall()
-            # Make sure all lines are decodable
-            for line in s.splitlines():
-                if line:
-                    try:
-                        json.loads(line)
-                    except Exception:
-                        # Found an incomplete or broken line -- keep reading
-                        break
-            else:
-                # All lines are OK -- stop reading
-                break
-        # Decode all decodable lines
-        objs = []
-        for line in s.splitlines():
+        while True:
+            self._state_lock.acquire()
             try:
-                objs += [json.loads(line)]
-                self._log_lines(line)
-            except Exception:
-                pass
-        # Keep track of asynchronous events
-        self._events += [obj for obj in objs if "event" in obj]
-        return objs
+                result = func()
+                remaining = end_time - time.time()
+                if result or self._reader_done or remaining <= 0:
+                    self._waiters.discard(waiter)
+                    return result
+                self._waiters.add(waiter)
+            finally:
+                self._state_lock.release()
+            waiter.wait(remaining)
 
 
     def _send(self, data):
@@ -747,20 +924,33 @@ class QMPMonitor(Monitor):
 
     def _get_response(self, q_id=None, timeout=RESPONSE_TIMEOUT):
         """
-        Read a response from the QMP monitor.
+        Wait for a response from the QMP monitor.
 
-        @param id: If not None, look for a response with this id
+        @param q_id: If not None, wait for the response to the command with
+                this id, which must have been registered by send_cmd();
+                otherwise wait for the next response not sent to such a
+                command
         @param timeout: Time duration to wait for response
         @return: The response dict, or None if none was found
         """
-        end_time = time.time() + timeout
-        while self._data_available(end_time - time.time()):
-            for obj in self._read_objects():
-                if isinstance(obj, dict):
-                    if q_id is not None and obj.get("id") != q_id:
-                        continue
-                    if "return" in obj or "error" in obj:
-                        return obj
+        if q_id is None:
+            def get():
+                if self._unrouted:
+                    return self._unrouted.popleft()
+            return self._wait(get, timeout)
+        try:
+            return self._wait(lambda: self._responses.get(q_id), timeout)
+        finally:
+            self._forget_id(q_id)
+
+
+    def _forget_id(self, q_id):
+        """
+        Stop keeping the response to the command with the given id.
+        """
+        self._state_lock.acquire()
+        self._responses.pop(q_id, None)
+        self._state_lock.release()
 
 
     def _get_supported_cmds(self):
@@ -822,6 +1012,85 @@ class QMPMonitor(Monitor):
 
     # Public methods
 
+    def send_cmd(self, cmd, args=None, debug=True, fd=None):
+        """
+        Send a QMP monitor command without waiting for the response.
+
+        The response can be collected later with get_response(), so several
+        commands can be in flight at the same time.
+
+        @param cmd: Command to send
+        @param args: A dict containing command arguments, or None
+        @param debug: Whether to print the command being sent
+        @param fd: file object or file descriptor to pass
+
+        @return: The id assigned to the command
+
+        @raise MonitorLockError: Raised if the lock cannot be acquired
+        @raise MonitorSocketError: Raised if a socket error occurs
+        """
+        self._log_command(cmd, debug)
+        q_id = utils_misc.generate_random_string(8)
+        cmdobj = self._build_cmd(cmd, args, q_id)
+        # Register the id before sending, so the response is kept for us
+        self._state_lock.acquire()
+        self._responses[q_id] = None
+        self._state_lock.release()
+        if not self._acquire_lock():
+            self._forget_id(q_id)
+            raise MonitorLockError("Could not acquire exclusive lock to send "
+                                   "QMP command '%s'" % cmd)
+        try:
+            try:
+                if fd is not None:
+                    if self._passfd is None:
+                        self._passfd = passfd_setup.import_passfd()
+                    # If command includes a file descriptor, use passfd module
+                    self._passfd.sendfd(self._socket, fd,
+                                        json.dumps(cmdobj) + "\n")
+                else:
+                    self._send(json.dumps(cmdobj) + "\n")
+            except Exception:
+                self._forget_id(q_id)
+                raise
+        finally:
+            self._lock.release()
+        return q_id
+
+
+    def get_response(self, q_id, cmd, args=None, timeout=CMD_TIMEOUT,
+                     debug=True):
+        """
+        Wait for the response to a command sent by send_cmd().
+
+        @param q_id: The id returned by send_cmd()
+        @param cmd: The command that was sent (used for logging and errors)
+        @param args: The arguments of the command (used for errors)
+        @param timeout: Time duration to wait for response
+        @param debug: Whether to print the response
+
+        @return: The response received
+
+        @raise MonitorProtocolError: Raised if no response is received
+        @raise QMPCmdError: Raised if the response is an error message
+                            (the exception's args are (cmd, args, data)
+                             where data is the error data)
+        """
+        r = self._get_response(q_id, timeout)
+        if r is None:
+            raise MonitorProtocolError("Received no response to QMP "
+                                       "command '%s', or received a "
+                                       "response with an incorrect id"
+                                       % cmd)
+        if "return" in r:
+            ret = r["return"]
+            if ret:
+                self._log_response(cmd, ret, debug)
+            return ret
+        if "error" in r:
+            raise QMPCmdError(cmd, args, r["error"])
+
+
     def cmd(self, cmd, args=None, timeout=CMD_TIMEOUT, debug=True, fd=None):
         """
         Send a QMP monitor command and return the response.
@@ -844,41 +1113,8 @@ class QMPMonitor(Monitor):
                             (the exception's args are (cmd, args, data)
                              where data is the error data)
         """
-        self._log_command(cmd, debug)
-        if not self._acquire_lock():
-            raise MonitorLockError("Could not acquire exclusive lock to send "
-                                   "QMP command '%s'" % cmd)
-
-        try:
-            # Read any data that might be available
-            self._read_objects()
-            # Send command
-            q_id = utils_misc.generate_random_string(8)
-            cmdobj = self._build_cmd(cmd, args, q_id)
-            if fd is not None:
-                if self._passfd is None:
-                    self._passfd = passfd_setup.import_passfd()
-                # If command includes a file descriptor, use passfd module
-                self._passfd.sendfd(self._socket, fd, json.dumps(cmdobj) + "\n")
-            else:
-                self._send(json.dumps(cmdobj) + "\n")
-            # Read response
-            r = self._get_response(q_id, timeout)
-            if r is None:
-                raise MonitorProtocolError("Received no response to QMP "
-                                           "command '%s', or received a "
-                                           "response with an incorrect id"
-                                           % cmd)
-            if "return" in r:
-                ret = r["return"]
-                if ret:
-                    self._log_response(cmd, ret, debug)
-                return ret
-            if "error" in r:
-                raise QMPCmdError(cmd, args, r["error"])
-
-        finally:
-            self._lock.release()
+        q_id = self.send_cmd(cmd, args, debug, fd)
+        return self.get_response(q_id, cmd, args, timeout, debug)
 
 
     def cmd_raw(self, data, timeout=CMD_TIMEOUT):
@@ -899,7 +1135,10 @@ class QMPMonitor(Monitor):
                                    "data: %r" % data)
 
         try:
-            self._read_objects()
+            # Forget responses nobody was waiting for
+            self._state_lock.acquire()
+            self._unrouted.clear()
+            self._state_lock.release()
             self._send(data)
             r = self._get_response(None, timeout)
             if r is None:
@@ -986,16 +1225,12 @@ class QMPMonitor(Monitor):
         clear_events() call.
 
         @return: A list of events (the objects returned have an "event" key)
-        @raise MonitorLockError: Raised if the lock cannot be acquired
         """
-        if not self._acquire_lock():
-            raise MonitorLockError("Could not acquire exclusive lock to read "
-                                   "QMP events")
+        self._state_lock.acquire()
         try:
-            self._read_objects()
-            return self._events[:]
+            return list(self._events)
         finally:
-            self._lock.release()
+            self._state_lock.release()
 
 
     def get_event(self, name):
@@ -1005,9 +1240,37 @@ class QMPMonitor(Monitor):
         @param name: The name of the event to look for (e.g. 'RESET')
         @return: An event object or None if none is found
         """
-        for e in self.get_events():
-            if e.get("event") == name:
-                return e
+        self._state_lock.acquire()
+        try:
+            events = self._events_by_name.get(name)
+            if events:
+                return events[0]
+        finally:
+            self._state_lock.release()
+
+
+    def wait_for_event(self, name, predicate=None, timeout=CMD_TIMEOUT):
+        """
+        Wait for an event with the given name to be received, returning as
+        soon as it arrives.  Events received since the last clear_events()
+        call are considered too, so it's safe to clear the events, trigger
+        the event and then wait for it.
+
+        @param name: The name of the event to wait for (e.g. 'SHUTDOWN')
+        @param predicate: Function taking an event object and returning True
+                if it's the event being waited for (e.g. checking the device
+                of a BLOCK_JOB_COMPLETED event), or None to accept any event
+                with the given name.  It's called with the event lock held,
+                so it must not use the monitor.
+        @param timeout: Time duration to wait for the event
+        @return: The oldest matching event object, or None if none was
+                received before timeout expired
+        """
+        def find_event():
+            for event in self._events_by_name.get(name, ()):
+                if predicate is None or predicate(event):
+                    return event
+        return self._wait(find_event, timeout)
 
 
     def human_monitor_cmd(self, cmd="", timeout=CMD_TIMEOUT,
@@ -1035,14 +1298,11 @@ class QMPMonitor(Monitor):
     def clear_events(self):
         """
         Clear the list of asynchronous events.
-
-        @raise MonitorLockError: Raised if the lock cannot be acquired
         """
-        if not self._acquire_lock():
-            raise MonitorLockError("Could not acquire exclusive lock to clear "
-                                   "QMP event list")
-        self._events = []
-        self._lock.release()
+        self._state_lock.acquire()
+        self._events.clear()
+        self._events_by_name = {}
+        self._state_lock.release()
 
 
     def get_greeting(self):
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+import unittest, os, socket, threading, tempfile, shutil, time, json
+import common
+import qemu_monitor
+
+
+class QMPStreamDecoderTest(unittest.TestCase):
+    def test_split_object(self):
+        decoder = qemu_monitor._QMPStreamDecoder()
+        self.assertEqual(decoder.feed('{"return": '), [])
+        self.assertEqual(decoder.feed('{}}\r\n{"event": "STOP"}\r\n{"ev'),
+                         [('{"return": {}}', {"return": {}}),
+                          ('{"event": "STOP"}', {"event": "STOP"})])
+        self.assertEqual(decoder.feed('ent": "RESUME"}\r\n'),
+                         [('{"event": "RESUME"}', {"event": "RESUME"})])
+
+
+    def test_broken_line(self):
+        decoder = qemu_monitor._QMPStreamDecoder()
+        self.assertEqual(decoder.feed('junk\r\n\r\n{"return": 1}\n'),
+                         [('{"return": 1}', {"return": 1})])
+
+
+class FakeQMPServer(object):
+    """
+    Minimal QMP server: answers every command, delaying the response to
+    'slow', sending a STOP event before the response to 'stop' and sending
+    RESET events some time after the response to 'system_reset'.
+    """
+    def __init__(self, filename):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(filename)
+        self.sock.listen(1)
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+
+    def _serve(self):
+        conn = self.sock.accept()[0]
+        conn.sendall('{"QMP": {"version": {}, "capabilities": []}}\r\n')
+        for line in conn.makefile():
+            obj = json.loads(line)
+            resp = {"return": {}, "id": obj.get("id")}
+            if obj["execute"] == "slow":
+                timer = threading.Timer(0.5, conn.sendall,
+                                        (json.dumps(resp) + "\r\n",))
+                timer.start()
+                continue
+            if obj["execute"] == "stop":
+                conn.sendall('{"event": "STOP", "timestamp": {}}\r\n')
+            if obj["execute"] == "system_reset":
+                events = "".join('{"event": "RESET", "data": {"n": %d}}\r\n'
+                                 % n for n in range(3))
+                timer = threading.Timer(0.3, conn.sendall, (events,))
+                timer.start()
+            conn.sendall(json.dumps(resp) + "\r\n")
+
+
+class QMPMonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(self.tmpdir, "qmp")
+        self.server = FakeQMPServer(filename)
+        self.monitor = qemu_monitor.QMPMonitor("qmp1", filename)
+
+
+    def tearDown(self):
+        self.monitor._close_sock()
+        shutil.rmtree(self.tmpdir)
+
+
+    def test_events(self):
+        self.monitor.cmd("stop", debug=False)
+        self.assertEqual([e["event"] for e in self.monitor.get_events()],
+                         ["STOP"])
+        self.monitor.clear_events()
+        self.assertEqual(self.monitor.get_events(), [])
+
+
+    def test_wait_for_event(self):
+        self.monitor.cmd("system_reset", debug=False)
+        self.assertEqual(self.monitor.get_event("RESET"), None)
+        start = time.time()
+        event = self.monitor.wait_for_event(
+                            "RESET", lambda e: e["data"]["n"] == 2, timeout=5)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(event["data"], {"n": 2})
+        self.assertEqual(self.monitor.get_event("RESET")["data"], {"n": 0})
+        self.assertEqual(self.monitor.wait_for_event("SHUTDOWN", timeout=0.1),
+                         None)
+
+
+    def test_event_seq(self):
+        self.monitor.cmd("stop", debug=False)
+        self.monitor.clear_events()
+        self.monitor.cmd("system_reset", debug=False)
+        self.monitor.wait_for_event("RESET", lambda e: e["data"]["n"] == 2,
+                                    timeout=5)
+        # Sequence numbers go on after clear_events()
+        self.assertEqual([e["seq"] for e in self.monitor.get_events()],
+                         [2, 3, 4])
+
+
+    def test_pipelined_commands(self):
+        slow_id = self.monitor.send_cmd("slow", debug=False)
+        ids = [self.monitor.send_cmd("query-status", debug=False)
+               for i in range(5)]
+        start = time.time()
+        for q_id in ids:
+            self.monitor.get_response(q_id, "query-status", debug=False)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(self.monitor.get_response(slow_id, "slow"), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,16 @@ Utility classes and functions to handle Virtual Machine creation using qemu.
 @copyright: 2008-2009 Red Hat Inc.
 """
 
-import time, os, logging, fcntl, re, commands, errno
+import time, os, logging, fcntl, re, commands, errno, threading
 from autotest.client.shared import error
 from autotest.client import utils
 import utils_misc, virt_vm, test_setup, storage, qemu_monitor, aexpect
 import qemu_virtio_port, remote, data_dir, utils_net
 
+# The lock file used by VM.create() only excludes other processes, this lock
+# excludes other threads of this process (see env_process.process())
+_create_lock = threading.Lock()
+
 
 class QemuSegFaultError(virt_vm.VMError):
     def __init__(self, crash_message):
@@ -29,6 +33,223 @@ class ImageUnbootableError(virt_vm.VMError):
         return ("VM '%s' can't bootup from image" % self.name)
 
 
+def parse_migration_info(info):
+    """
+    Parse the output of the 'info migrate' monitor command.
+
+    @param info: Output of monitor.info("migrate"), a string (human monitor)
+            or a dict (QMP).
+    @return: A dict with the keys 'status', 'transferred', 'remaining',
+            'total' (bytes of RAM) and 'dirty_rate' (dirty pages/s), set to
+            None for the values not reported.
+    """
+    result = dict.fromkeys(["status", "transferred", "remaining", "total",
+                            "dirty_rate"])
+    if isinstance(info, str):
+        match = re.search(r"Migration status: (\w+)", info)
+        if match:
+            result["status"] = match.group(1)
+        for key in ["transferred", "remaining", "total"]:
+            match = re.search(r"%s ram: (\d+) kbytes" % key, info)
+            if match:
+                result[key] = int(match.group(1)) * 1024
+        match = re.search(r"dirty pages rate: (\d+) pages", info)
+        if match:
+            result["dirty_rate"] = int(match.group(1))
+    elif isinstance(info, dict):
+        result["status"] = info.get("status")
+        ram = info.get("ram", {})
+        for key in ["transferred", "remaining", "total"]:
+            result[key] = ram.get(key)
+        result["dirty_rate"] = ram.get("dirty-pages-rate")
+    return result
+
+
+class MigrationTracker(object):
+    """
+    Follows the outgoing migration of a VM and records its progress.
+
+    wait() polls 'info migrate' at an interval adapted to the progress of
+    the migration, from MIN_INTERVAL up to MAX_INTERVAL.  With QMP, it
+    also returns as soon as QEMU sends a MIGRATION event, so create the
+    tracker before starting the migration to catch every event (see
+    VM.get_migration_tracker()).
+
+    Every poll is recorded in the samples list, as the dicts returned by
+    parse_migration_info() with an additional 'time' key (seconds since the
+    tracker was created).
+    """
+
+    MIN_INTERVAL = 0.1
+    MAX_INTERVAL = 2.0
+    ACTIVE_STATUSES = ["setup", "active"]
+
+    def __init__(self, vm, check_spice=True):
+        """
+        @param vm: The source VM.
+        @param check_spice: If True and the VM uses spice seamless migration,
+                the migration is only finished once spice is migrated too.
+        """
+        self.vm = vm
+        self.check_spice = check_spice
+        self.start_time = time.time()
+        self.samples = []
+        self.status = None
+        # Sequence number of the last MIGRATION event seen
+        self._last_seq = self._get_last_seq()
+
+
+    def __getstate__(self):
+        # Event sequence numbers restart with the monitor connection
+        state = self.__dict__.copy()
+        state["_last_seq"] = None
+        return state
+
+
+    def _get_last_seq(self):
+        monitor = self.vm.monitor
+        if monitor.protocol != "qmp":
+            return 0
+        events = [e for e in monitor.get_events() if e["event"] == "MIGRATION"]
+        if not events:
+            return 0
+        return events[-1]["seq"]
+
+
+    def _wait_for_event(self, timeout):
+        """
+        Wait for a MIGRATION event received since the last call, or for
+        timeout seconds if the monitor doesn't support events.
+        """
+        monitor = self.vm.monitor
+        if monitor.protocol != "qmp":
+            time.sleep(timeout)
+            return
+        if self._last_seq is None:
+            self._last_seq = self._get_last_seq()
+        event = monitor.wait_for_event(
+                            "MIGRATION",
+                            lambda e: e["seq"] > self._last_seq, timeout)
+        if event:
+            logging.debug("Migration status changed to %s",
+                          event.get("data", {}).get("status"))
+            self._last_seq = event["seq"]
+
+
+    def poll(self):
+        """
+        Query and record the migration status.
+
+        @return: The sample recorded.
+        """
+        sample = parse_migration_info(self.vm.monitor.info("migrate"))
+        sample["time"] = time.time() - self.start_time
+        self.samples.append(sample)
+        self.status = sample["status"]
+        return sample
+
+
+    def is_active(self):
+        """
+        Return True if the last poll found the migration in progress.
+        """
+        return self.status in self.ACTIVE_STATUSES
+
+
+    def succeeded(self):
+        return self.status == "completed"
+
+
+    def failed(self):
+        return self.status == "failed"
+
+
+    def cancelled(self):
+        return self.status in ["cancelled", "canceled"]
+
+
+    def spice_migrated(self):
+        """
+        Return True unless the VM uses spice seamless migration and spice
+        wasn't migrated yet.
+        """
+        if (not self.check_spice or self.vm.params["display"] != "spice" or
+            self.vm.get_spice_var("spice_seamless_migration") != "on"):
+            return True
+        s = self.vm.monitor.info("spice")
+        if isinstance(s, str):
+            return "migrated: true" in s
+        else:
+            return s.get("migrated") == "true"
+
+
+    def finished(self):
+        """
+        Poll the migration status, return True if the migration is over.
+        """
+        self.poll()
+        if self.is_active():
+            return False
+        return not self.succeeded() or self.spice_migrated()
+
+
+    def _next_interval(self, interval):
+        """
+        Return the time to wait before the next poll: half the estimated
+        time left if the last samples allow an estimate, otherwise twice the
+        previous interval.
+        """
+        if len(self.samples) >= 2:
+            prev, last = self.samples[-2:]
+            if (last["remaining"] is not None and
+                last["transferred"] is not None and
+                prev["transferred"] is not None and
+                last["transferred"] > prev["transferred"]):
+                rate = ((last["transferred"] - prev["transferred"]) /
+                        max(last["time"] - prev["time"], 1e-3))
+                interval = last["remaining"] / rate / 2
+            else:
+                interval *= 2
+        return min(max(interval, self.MIN_INTERVAL), self.MAX_INTERVAL)
+
+
+    def wait(self, timeout):
+        """
+        Wait for the migration to finish.
+
+        @param timeout: Time to wait, in seconds.
+        @return: True if the migration finished, False if timeout expired.
+        """
+        end_time = time.time() + timeout
+        interval = self.MIN_INTERVAL
+        logging.debug("Waiting for migration to finish")
+        while not self.finished():
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                return False
+            interval = self._next_interval(interval)
+            self._wait_for_event(min(interval, remaining))
+        logging.debug("Migration %s after %.1f s", self.status,
+                      time.time() - self.start_time)
+        return True
+
+
+    def get_transfer_rates(self):
+        """
+        Return the RAM transfer rates between consecutive samples, as a list
+        of (time, bytes/s) tuples.
+        """
+        rates = []
+        samples = [s for s in self.samples if s["transferred"] is not None]
+        for prev, last in zip(samples, samples[1:]):
+            elapsed = last["time"] - prev["time"]
+            if elapsed > 0:
+                rates.append((last["time"],
+                              (last["transferred"] - prev["transferred"]) /
+                              elapsed))
+        return rates
+
+
 class VM(virt_vm.BaseVM):
     """
     This class handles all basic VM operations.
@@ -1576,7 +1797,10 @@ class VM(virt_vm.BaseVM):
         params = self.params
         root_dir = self.root_dir
 
-        # Verify the md5sum of the ISO images
+        # Verify the md5sum of the ISO images, reusing the digests computed
+        # by previous runs as long as the files did not change
+        digest_cache = utils_misc.FileDigestCache(os.path.join(
+                                data_dir.get_tmp_dir(), "file_digests"))
         for cdrom in params.objects("cdroms"):
             cdrom_params = params.object_params(cdrom)
             iso = cdrom_params.get("cdrom")
@@ -1588,19 +1812,19 @@ class VM(virt_vm.BaseVM):
                 if cdrom_params.get("md5sum_1m"):
                     logging.debug("Comparing expected MD5 sum with MD5 sum of "
                                   "first MB of ISO file...")
-                    actual_hash = utils.hash_file(iso, 1048576, method="md5")
+                    actual_hash = digest_cache.get_digest(iso, "md5", 1048576)
                     expected_hash = cdrom_params.get("md5sum_1m")
                     compare = True
                 elif cdrom_params.get("md5sum"):
                     logging.debug("Comparing expected MD5 sum with MD5 sum of "
                                   "ISO file...")
-                    actual_hash = utils.hash_file(iso, method="md5")
+                    actual_hash = digest_cache.get_digest(iso, "md5")
                     expected_hash = cdrom_params.get("md5sum")
                     compare = True
                 elif cdrom_params.get("sha1sum"):
                     logging.debug("Comparing expected SHA1 sum with SHA1 sum "
                                   "of ISO file...")
-                    actual_hash = utils.hash_file(iso, method="sha1")
+                    actual_hash = digest_cache.get_digest(iso, "sha1")
                     expected_hash = cdrom_params.get("sha1sum")
                     compare = True
                 if compare:
@@ -1612,8 +1836,13 @@ class VM(virt_vm.BaseVM):
 
         # Make sure the following code is not executed by more than one thread
         # at the same time
-        lockfile = open("/tmp/kvm-autotest-vm-create.lock", "w+")
-        fcntl.lockf(lockfile, fcntl.LOCK_EX)
+        _create_lock.acquire()
+        try:
+            lockfile = open("/tmp/kvm-autotest-vm-create.lock", "w+")
+            fcntl.lockf(lockfile, fcntl.LOCK_EX)
+        except Exception:
+            _create_lock.release()
+            raise
 
         try:
             # Handle port redirections
@@ -1732,14 +1961,18 @@ class VM(virt_vm.BaseVM):
                 logging.info("Running Proxy Helper:\n%s", proxy_helper_cmd)
                 self.process = aexpect.run_bg(proxy_helper_cmd, None,
                                               logging.info,
-                                              "[9p proxy helper]")
+                                              "[9p proxy helper]",
+                                              multiplex=False)
 
             logging.info("Running qemu command (reformatted):")
             for item in qemu_command.replace(" -", " \n    -").splitlines():
                 logging.info("%s", item)
             self.qemu_command = qemu_command
+            # The processes of the VM are pickled with it, so they can't be
+            # run by the aexpect multiplexer
             self.process = aexpect.run_bg(qemu_command, None,
-                                          logging.info, "[qemu output] ")
+                                          logging.info, "[qemu output] ",
+                                          multiplex=False)
 
             # test doesn't need to hold tapfd's open
             for nic in self.virtnet:
@@ -1868,7 +2101,8 @@ class VM(virt_vm.BaseVM):
                 auto_close=False,
                 output_func=utils_misc.log_line,
                 output_params=("serial-%s-%s.log" % (tmp_serial, name),),
-                prompt=self.params.get("shell_prompt", "[\#\$]"))
+                prompt=self.params.get("shell_prompt", "[\#\$]"),
+                multiplex=False)
             del tmp_serial
 
             for key, value in self.logs.items():
@@ -1877,7 +2111,8 @@ class VM(virt_vm.BaseVM):
                     "nc -U %s" % value,
                     auto_close=False,
                     output_func=utils_misc.log_line,
-                    output_params=(outfile,))
+                    output_params=(outfile,),
+                    multiplex=False)
                 self.logsessions[key].set_log_file(outfile)
 
             if params.get("paused_after_start_vm") != "yes":
@@ -1893,8 +2128,11 @@ class VM(virt_vm.BaseVM):
                             raise e
 
         finally:
-            fcntl.lockf(lockfile, fcntl.LOCK_UN)
-            lockfile.close()
+            try:
+                fcntl.lockf(lockfile, fcntl.LOCK_UN)
+                lockfile.close()
+            finally:
+                _create_lock.release()
 
 
     def destroy(self, gracefully=True, free_mac_addresses=True):
@@ -2377,20 +2615,25 @@ class VM(virt_vm.BaseVM):
         error.context()
 
 
+    def get_migration_tracker(self, new=False, check_spice=True):
+        """
+        Return the MigrationTracker following the outgoing migration of the
+        VM, creating one if there's none yet.
+
+        @param new: If True, replace it with a new tracker.  Do so right
+                before starting a migration.
+        @param check_spice: See MigrationTracker.
+        """
+        tracker = getattr(self, "migration_tracker", None)
+        # A clone made with copy_state=True gets the source VM's tracker
+        if new or tracker is None or tracker.vm is not self:
+            tracker = MigrationTracker(self, check_spice)
+            self.migration_tracker = tracker
+        return tracker
+
+
     def mig_finished(self):
-        ret = True
-        if (self.params["display"] == "spice" and
-            self.get_spice_var("spice_seamless_migration") == "on"):
-            s = self.monitor.info("spice")
-            if isinstance(s, str):
-                ret = "migrated: true" in s
-            else:
-                ret = s.get("migrated") == "true"
-        o = self.monitor.info("migrate")
-        if isinstance(o, str):
-            return ret and (not "status: active" in o)
-        else:
-            return ret and (o.get("status") != "active")
+        return self.get_migration_tracker().finished()
 
     def mig_succeeded(self):
         o = self.monitor.info("migrate")
@@ -2415,11 +2658,23 @@ class VM(virt_vm.BaseVM):
             return (o.get("status") == "cancelled" or
                     o.get("status") == "canceled")
 
-    def wait_for_migration(self, timeout):
-        if not utils_misc.wait_for(self.mig_finished, timeout, 2, 2,
-                                  "Waiting for migration to complete"):
+    def wait_for_migration(self, timeout, tracker=None):
+        """
+        Wait for the outgoing migration to finish.
+
+        @param timeout: Time to wait, in seconds.
+        @param tracker: MigrationTracker created before the migration was
+                started, the one returned by get_migration_tracker() if
+                None.
+        @return: The MigrationTracker, recording the migration progress.
+        @raise VMMigrateTimeoutError: If timeout expired.
+        """
+        if tracker is None:
+            tracker = self.get_migration_tracker()
+        if not tracker.wait(timeout):
             raise virt_vm.VMMigrateTimeoutError("Timeout expired while waiting"
                                         " for migration to finish")
+        return tracker
 
 
     @error.context_aware
@@ -2572,6 +2827,7 @@ class VM(virt_vm.BaseVM):
                 self.monitor.cmd("stop")
 
             logging.info("Migrating to %s", uri)
+            tracker = self.get_migration_tracker(new=True)
             self.monitor.migrate(uri)
             if not_wait_for_migration:
                 return clone
@@ -2579,20 +2835,18 @@ class VM(virt_vm.BaseVM):
             if cancel_delay:
                 time.sleep(cancel_delay)
                 self.monitor.cmd("migrate_cancel")
-                if not utils_misc.wait_for(self.mig_cancelled, 60, 2, 2,
-                                          "Waiting for migration "
-                                          "cancellation"):
+                if not (tracker.wait(60) and tracker.cancelled()):
                     raise virt_vm.VMMigrateCancelError("Cannot cancel migration")
                 return
 
-            self.wait_for_migration(timeout)
+            self.wait_for_migration(timeout, tracker)
 
             self.verify_alive()
 
             # Report migration status
-            if self.mig_succeeded():
+            if tracker.succeeded():
                 logging.info("Migration completed successfully")
-            elif self.mig_failed():
+            elif tracker.failed():
                 raise virt_vm.VMMigrateFailedError("Migration failed")
             else:
                 raise virt_vm.VMMigrateFailedError("Migration ended with "
@@ -2678,9 +2932,8 @@ class VM(virt_vm.BaseVM):
             # Send a system_reset monitor command
             self.monitor.cmd("system_reset")
             # Look for RESET QMP events
-            time.sleep(1)
             for m in qmp_monitors:
-                if m.get_event("RESET"):
+                if m.wait_for_event("RESET", timeout=1):
                     logging.info("RESET QMP event received")
                 else:
                     raise virt_vm.VMRebootError("RESET QMP event not received "
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+import unittest, threading, time, pickle
+import common
+import qemu_vm
+
+
+HUMAN_INFO = """Migration status: active
+transferred ram: 1024 kbytes
+remaining ram: 3072 kbytes
+total ram: 4096 kbytes
+dirty pages rate: 120 pages
+"""
+
+QMP_INFO = {"status": "active",
+            "ram": {"transferred": 1048576, "remaining": 3145728,
+                    "total": 4194304, "dirty-pages-rate": 120}}
+
+
+class ParseMigrationInfoTest(unittest.TestCase):
+    def test_human(self):
+        self.assertEqual(qemu_vm.parse_migration_info(HUMAN_INFO),
+                         {"status": "active", "transferred": 1048576,
+                          "remaining": 3145728, "total": 4194304,
+                          "dirty_rate": 120})
+
+
+    def test_qmp(self):
+        self.assertEqual(qemu_vm.parse_migration_info(QMP_INFO),
+                         {"status": "active", "transferred": 1048576,
+                          "remaining": 3145728, "total": 4194304,
+                          "dirty_rate": 120})
+
+
+    def test_missing(self):
+        expected = dict.fromkeys(["transferred", "remaining", "total",
+                                  "dirty_rate"])
+        expected["status"] = "completed"
+        self.assertEqual(
+                qemu_vm.parse_migration_info("Migration status: completed\n"),
+                expected)
+        self.assertEqual(qemu_vm.parse_migration_info({"status": "completed"}),
+                         expected)
+        self.assertEqual(qemu_vm.parse_migration_info(None)["status"], None)
+
+
+class FakeMonitor(object):
+    """
+    Monitor answering 'info migrate' with a list of statuses, the last one
+    being repeated.  With QMP, MIGRATION events can be sent with
+    send_event().
+    """
+    def __init__(self, protocol, statuses):
+        self.protocol = protocol
+        self.statuses = list(statuses)
+        self.events = []
+        self.seq = 0
+        self.cond = threading.Condition()
+
+
+    def info(self, what):
+        status = self.statuses[0]
+        if len(self.statuses) > 1:
+            self.statuses.pop(0)
+        if self.protocol == "qmp":
+            return {"status": status}
+        return "Migration status: %s\n" % status
+
+
+    def send_event(self, status):
+        self.cond.acquire()
+        try:
+            self.seq += 1
+            self.events.append({"event": "MIGRATION", "seq": self.seq,
+                                "data": {"status": status}})
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+
+    def get_events(self):
+        return list(self.events)
+
+
+    def wait_for_event(self, name, predicate=None, timeout=None):
+        end_time = time.time() + timeout
+        self.cond.acquire()
+        try:
+            while True:
+                for event in self.events:
+                    if event["event"] == name and predicate(event):
+                        return event
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+        finally:
+            self.cond.release()
+
+
+class FakeVM(object):
+    def __init__(self, monitor):
+        self.monitor = monitor
+        self.params = {"display": "vnc"}
+
+
+    def __getstate__(self):
+        # Like monitors, the fake one isn't pickled
+        return {"params": self.params}
+
+
+class MigrationTrackerTest(unittest.TestCase):
+    def test_human(self):
+        vm = FakeVM(FakeMonitor("human", ["setup", "active", "completed"]))
+        tracker = qemu_vm.MigrationTracker(vm)
+        self.assertFalse(tracker.finished())
+        self.assertTrue(tracker.is_active())
+        self.assertTrue(tracker.wait(5))
+        self.assertTrue(tracker.succeeded())
+        self.assertEqual([s["status"] for s in tracker.samples],
+                         ["setup", "active", "completed"])
+
+
+    def test_failed(self):
+        vm = FakeVM(FakeMonitor("human", ["active", "failed"]))
+        tracker = qemu_vm.MigrationTracker(vm)
+        self.assertTrue(tracker.wait(5))
+        self.assertTrue(tracker.failed())
+
+
+    def test_timeout(self):
+        vm = FakeVM(FakeMonitor("human", ["active"]))
+        tracker = qemu_vm.MigrationTracker(vm)
+        start = time.time()
+        self.assertFalse(tracker.wait(0.3))
+        self.assertTrue(time.time() - start < 1)
+
+
+    def test_next_interval(self):
+        vm = FakeVM(FakeMonitor("human", ["active"]))
+        tracker = qemu_vm.MigrationTracker(vm)
+        self.assertEqual(tracker._next_interval(0.1), tracker.MIN_INTERVAL)
+        # Half the time left at the current transfer rate
+        tracker.samples = [{"time": 0.0, "transferred": 0, "remaining": 100},
+                           {"time": 1.0, "transferred": 100, "remaining": 100}]
+        self.assertEqual(tracker._next_interval(0.1), 0.5)
+        # Without an estimate, the interval doubles up to MAX_INTERVAL
+        tracker.samples[-1]["transferred"] = 0
+        self.assertEqual(tracker._next_interval(0.4), 0.8)
+        self.assertEqual(tracker._next_interval(1.5), tracker.MAX_INTERVAL)
+
+
+    def test_qmp_events(self):
+        monitor = FakeMonitor("qmp", ["active"])
+        # Events from a previous migration are ignored
+        monitor.send_event("completed")
+        vm = FakeVM(monitor)
+        tracker = qemu_vm.MigrationTracker(vm)
+        tracker.MAX_INTERVAL = 10
+        start = time.time()
+        tracker._wait_for_event(0.2)
+        self.assertTrue(time.time() - start >= 0.2)
+        # A new event ends the wait
+        threading.Timer(0.2, monitor.send_event, ("completed",)).start()
+        start = time.time()
+        tracker._wait_for_event(5)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(tracker._last_seq, 2)
+
+
+    def test_qmp_wait(self):
+        monitor = FakeMonitor("qmp", ["active"])
+        tracker = qemu_vm.MigrationTracker(FakeVM(monitor))
+        tracker.MIN_INTERVAL = tracker.MAX_INTERVAL = 10
+        def complete():
+            monitor.statuses = ["completed"]
+            monitor.send_event("completed")
+        threading.Timer(0.2, complete).start()
+        start = time.time()
+        self.assertTrue(tracker.wait(5))
+        self.assertTrue(time.time() - start < 1)
+        self.assertTrue(tracker.succeeded())
+
+
+    def test_pickle(self):
+        monitor = FakeMonitor("qmp", ["active"])
+        monitor.send_event("active")
+        tracker = qemu_vm.MigrationTracker(FakeVM(monitor))
+        self.assertEqual(tracker._last_seq, 1)
+        tracker = pickle.loads(pickle.dumps(tracker))
+        self.assertEqual(tracker._last_seq, None)
+        # The sequence number is looked up again on the next wait
+        tracker.vm.monitor = monitor
+        tracker._wait_for_event(0.1)
+        self.assertEqual(tracker._last_seq, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,41 @@
-import os, select
-import utils_env, virt_vm, aexpect
+import os, select, time, logging
+import utils_env, virt_vm, aexpect, utils_plan, utils_params, storage, data_dir
+
+
+def get_host_cpu_time():
+    """
+    Return the CPU time (in seconds) the host spent on anything but idling
+    since boot, according to /proc/stat.
+    """
+    fileobj = open("/proc/stat")
+    try:
+        # user, nice, system, idle, iowait, irq, softirq, steal (guest time
+        # is already accounted as user time)
+        ticks = [int(f) for f in fileobj.readline().split()[1:9]]
+    finally:
+        fileobj.close()
+    busy = sum(ticks) - ticks[3] - ticks[4]
+    return float(busy) / os.sysconf("SC_CLK_TCK")
+
+
+def get_host_used_mem():
+    """
+    Return the memory (MB) in use on the host, not counting the page cache,
+    according to /proc/meminfo.
+    """
+    info = {}
+    fileobj = open("/proc/meminfo")
+    try:
+        for line in fileobj:
+            key, value = line.split(":", 1)
+            info[key] = int(value.split()[0])
+    finally:
+        fileobj.close()
+    if "MemAvailable" in info:
+        free = info["MemAvailable"]
+    else:
+        free = info["MemFree"] + info.get("Buffers", 0) + info["Cached"]
+    return (info["MemTotal"] - free) / 1024
 
 
 class scheduler:
@@ -19,6 +55,8 @@ class scheduler:
         @param bindir: The directory where environment files reside.
         """
         self.tests = tests
+        # Index of test names and dependencies, used to resolve deps
+        self.plan = utils_plan.TestPlan(tests)
         self.num_workers = num_workers
         self.total_cpus = total_cpus
         self.total_mem = total_mem
@@ -122,15 +160,13 @@ class scheduler:
                 # A worker completed a test
                 elif msg[0] == "done":
                     test_index = int(msg[1])
-                    test = self.tests[test_index]
                     status = int(eval(msg[2]))
                     test_status[test_index] = ("fail", "pass")[status]
+                    self.plan.deps.record_result(test_index, bool(status))
                     # If the test failed, mark all dependent tests as "failed" too
                     if not status:
-                        for i, other_test in enumerate(self.tests):
-                            for dep in other_test.get("dep", []):
-                                if dep in test["name"]:
-                                    test_status[i] = "fail"
+                        for i in self.plan.deps.get_dependents(test_index):
+                            test_status[i] = "fail"
 
                 # A worker is done shutting down its VMs and other processes
                 elif msg[0] == "cleanup_done":
@@ -154,11 +190,7 @@ class scheduler:
                     # Make sure the test's dependencies are satisfied
                     dependencies_satisfied = True
                     for dep in test["dep"]:
-                        dependencies = [j for j, t in enumerate(self.tests)
-                                        if dep in t["name"]]
-                        bad_status_deps = [j for j in dependencies
-                                           if test_status[j] != "pass"]
-                        if bad_status_deps:
+                        if not self.plan.deps.dep_passed(dep):
                             dependencies_satisfied = False
                             break
                     if not dependencies_satisfied:
@@ -197,19 +229,14 @@ class scheduler:
                     # Update used_cpus and used_mem
                     used_cpus[worker] = test_used_cpus
                     used_mem[worker] = test_used_mem
-                    # Assign all related tests to this worker
-                    for j, other_test in enumerate(self.tests):
-                        for other_dep in other_test["dep"]:
-                            # All tests that depend on this test
-                            if other_dep in test["name"]:
-                                test_worker[j] = worker
-                                break
-                            # ... and all tests that share a dependency
-                            # with this test
-                            for dep in test["dep"]:
-                                if dep in other_dep or other_dep in dep:
-                                    test_worker[j] = worker
-                                    break
+                    # Assign all related tests to this worker: all tests
+                    # that depend on this test...
+                    related = self.plan.deps.get_dependents(i)
+                    # ... and all tests that share a dependency with this test
+                    for dep in test["dep"]:
+                        related.extend(self.plan.deps.get_related(dep))
+                    for j in related:
+                        test_worker[j] = worker
                     # Tell the worker to run the test
                     self.s2w_w[worker].write("run %s\n" % i)
                     break
@@ -227,3 +254,348 @@ class scheduler:
                 for worker in idle_workers:
                     self.s2w_w[worker].write("terminate\n")
                 break
+
+
+class ResourceScheduler(object):
+    """
+    Runs tests in parallel, packing them onto the host according to the
+    CPUs and memory they need.
+
+    Each test runs in a child process on behalf of one of num_workers
+    workers.  Every worker has its own environment file (see worker_dicts),
+    so the VMs left alive by a test may be reused by the next test run by
+    the same worker, and tests related by dependencies are kept on the same
+    worker for that reason.  A worker holds the resources of its last test
+    until it runs out of tests and destroys the VMs in its environment.
+    Tests that write to the same image never run at the same time.
+
+    Tests are packed according to the resources they declare (see
+    get_needs()), while the utilization reported by get_utilization() is
+    measured on the host while the tests run.
+    """
+
+    # Interval (in seconds) between measurements of the host's resource usage
+    sample_interval = 1.0
+
+    def __init__(self, tests, num_workers, total_cpus, total_mem, envdir,
+                 get_params=None):
+        """
+        Initialize the class.
+
+        @param tests: A list of test dictionaries.
+        @param num_workers: The maximum number of tests to run at a time.
+        @param total_cpus: The total number of CPUs to dedicate to tests.
+        @param total_mem: The total amount of memory (MB) to dedicate to
+                tests.
+        @param envdir: The directory where environment files reside.
+        @param get_params: Function returning the complete dictionary of a
+                test given its index, in which case the dictionaries in
+                tests only need the name and dep of each test.
+        """
+        self.tests = tests
+        self.get_params = get_params or (lambda i: tests[i].copy())
+        self.plan = utils_plan.TestPlan(tests)
+        self.num_workers = num_workers
+        self.total_cpus = total_cpus
+        self.total_mem = total_mem
+        self.envdir = envdir
+        # Each worker must use a different environment file.  MAC addresses
+        # are allocated from the shared address pool, which is locked and
+        # keyed by the unique instance id of each VM.
+        self.worker_dicts = [{"env": "env%d" % i} for i in range(num_workers)]
+        # Reservation accounting: integral of the resources held by workers
+        # over time and the maximum held at any time
+        self.cpu_seconds = 0.0
+        self.mem_seconds = 0.0
+        self.peak_cpus = 0
+        self.peak_mem = 0
+        self.elapsed = 0.0
+        self._last_time = None
+        # Utilization accounting: CPU time spent by the host and integral of
+        # the memory used on top of what was used before the run, as
+        # measured by get_host_cpu_time() and get_host_used_mem()
+        self.used_cpu_seconds = 0.0
+        self.used_mem_seconds = 0.0
+        self.peak_used_mem = 0
+        self._base_cpu_time = None
+        self._base_mem = None
+        self._last_sample = None
+
+
+    def get_needs(self, test):
+        """
+        Return the resources needed to run a test.
+
+        The CPUs and memory needed are the ones declared by the 'used_cpus'
+        and 'used_mem' params, or the sum of the vCPUs and memory of the
+        test's VMs, whichever is larger.
+
+        @param test: A test dictionary.
+        @return: Tuple (cpus, mem, images), images being the set of image
+                files the test may write to.
+        """
+        params = utils_params.Params(test)
+        cpus = 0
+        mem = 0
+        images = set()
+        for vm_name in params.objects("vms"):
+            vm_params = params.object_params(vm_name)
+            cpus += int(vm_params.get("smp", 1))
+            mem += int(vm_params.get("mem", 0))
+            for image_name in vm_params.objects("images"):
+                image_params = vm_params.object_params(image_name)
+                if (image_params.get("image_snapshot") == "yes" or
+                    image_params.get("image_readonly") == "yes"):
+                    continue
+                images.add(storage.get_image_filename(image_params,
+                                                      data_dir.get_data_dir()))
+        cpus = max(cpus, int(params.get("used_cpus", 1)))
+        mem = max(mem, int(params.get("used_mem", 128)))
+        return cpus, mem, images
+
+
+    def _fork(self, func, *args):
+        """
+        Call func(*args) in a child process.
+
+        @return: Tuple (pid, pipe), the return value of func being written
+                to pipe as a line of text.
+        """
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            try:
+                try:
+                    result = func(*args)
+                except Exception:
+                    logging.error("Worker process failed", exc_info=True)
+                    result = ""
+                os.write(w, "%s\n" % result)
+            finally:
+                os._exit(0)
+        os.close(w)
+        return pid, os.fdopen(r, "r")
+
+
+    def _cleanup(self, index):
+        """
+        Destroy the VMs and processes in the environment of a worker.
+        """
+        env_filename = os.path.join(self.envdir,
+                                    self.worker_dicts[index]["env"])
+        env = utils_env.Env(env_filename)
+        for obj in env.values():
+            if isinstance(obj, virt_vm.BaseVM):
+                obj.destroy()
+            elif isinstance(obj, aexpect.Spawn):
+                obj.close()
+        env.save()
+
+
+    def _run_test(self, run_test_func, test, worker_index):
+        test.update(self.worker_dicts[worker_index])
+        status, elapsed = run_test_func(test)
+        return "%s %f" % (status, elapsed)
+
+
+    def _account(self, now, used_cpus, used_mem):
+        if self._last_time is not None:
+            interval = now - self._last_time
+            self.cpu_seconds += min(used_cpus, self.total_cpus) * interval
+            self.mem_seconds += min(used_mem, self.total_mem) * interval
+        self._last_time = now
+        self.peak_cpus = max(self.peak_cpus, used_cpus)
+        self.peak_mem = max(self.peak_mem, used_mem)
+
+
+    def _sample(self, now):
+        used_mem = max(0, get_host_used_mem() - self._base_mem)
+        if self._last_sample is not None:
+            self.used_mem_seconds += used_mem * (now - self._last_sample)
+        self._last_sample = now
+        self.used_cpu_seconds = get_host_cpu_time() - self._base_cpu_time
+        self.peak_used_mem = max(self.peak_used_mem, used_mem)
+
+
+    def get_reservation(self):
+        """
+        Return the average fraction of the CPUs and memory reserved for
+        tests (according to get_needs()) during the last run() call, as a
+        tuple (cpus, mem).
+        """
+        if not self.elapsed:
+            return 0.0, 0.0
+        return (self.cpu_seconds / (self.total_cpus * self.elapsed),
+                self.mem_seconds / (self.total_mem * self.elapsed))
+
+
+    def get_utilization(self):
+        """
+        Return the average fraction of the CPUs and memory actually used on
+        the host during the last run() call, as a tuple (cpus, mem).  Memory
+        in use before the run started isn't counted, CPU time spent by other
+        processes is.
+        """
+        if not self.elapsed:
+            return 0.0, 0.0
+        return (min(1.0, self.used_cpu_seconds /
+                         (self.total_cpus * self.elapsed)),
+                self.used_mem_seconds / (self.total_mem * self.elapsed))
+
+
+    def run(self, run_test_func, report_func=None):
+        """
+        Run all tests.
+
+        @param run_test_func: Function called in a child process with the
+                test dictionary (updated with the worker dict) to run a
+                test, returning a tuple (status, elapsed time), status
+                being one of "PASS", "FAIL", "SKIP" or "WARN".
+        @param report_func: Function called as report_func(test_index,
+                status, elapsed) when a test completes, is skipped because
+                one of its dependencies failed, or can't run at all because
+                its dependencies never pass (status "ERROR").
+        @return: A list with the status of each test.
+        """
+        n_tests = len(self.tests)
+        # Needs of the tests, computed when they first become candidates to
+        # run, and the dictionary of the last test they were computed for,
+        # which is usually the one started next.  Only the few dictionaries
+        # in use are built at any time.
+        needs = [None] * n_tests
+        last_params = [None, None]
+        test_status = ["waiting"] * n_tests
+        test_worker = [None] * n_tests
+        # Resources held by each worker, and what it is doing: None when
+        # idle, or a tuple (pid, pipe, test index), the test index being
+        # None when cleaning up
+        held = [(0, 0, set())] * self.num_workers
+        busy = [None] * self.num_workers
+        self.cpu_seconds = self.mem_seconds = 0.0
+        self.peak_cpus = self.peak_mem = 0
+        self._last_time = None
+        self.used_cpu_seconds = self.used_mem_seconds = 0.0
+        self.peak_used_mem = 0
+        self._base_cpu_time = get_host_cpu_time()
+        self._base_mem = get_host_used_mem()
+        self._last_sample = None
+        start = time.time()
+        self._sample(start)
+
+        def report(i, status, elapsed=0.0):
+            test_status[i] = status
+            self.plan.deps.record_result(i, status in ("PASS", "WARN"))
+            if report_func:
+                report_func(i, status, elapsed)
+
+        def get_needs(i):
+            if needs[i] is None:
+                test = self.get_params(i)
+                needs[i] = self.get_needs(test)
+                last_params[:] = [i, test]
+            return needs[i]
+
+        def get_params(i):
+            if last_params[0] == i:
+                test = last_params[1]
+                last_params[:] = [None, None]
+                return test
+            return self.get_params(i)
+
+        def can_run(i, worker):
+            # Tests too large for the host only run when nothing else does
+            cpus, mem, images = get_needs(i)
+            others = [held[w] for w in range(self.num_workers) if w != worker]
+            used_cpus = sum(h[0] for h in others)
+            used_mem = sum(h[1] for h in others)
+            if used_cpus and used_cpus + cpus > self.total_cpus:
+                return False
+            if used_mem and used_mem + mem > self.total_mem:
+                return False
+            for h in others:
+                if h[2] & images:
+                    return False
+            return True
+
+        def find_test(worker):
+            for i in range(n_tests):
+                if test_status[i] != "waiting":
+                    continue
+                if test_worker[i] is not None and test_worker[i] != worker:
+                    continue
+                entry = self.plan[i]
+                if self.plan.dependencies_failed(entry):
+                    report(i, "SKIP")
+                    continue
+                dependencies_satisfied = True
+                for dep in entry.dep:
+                    if not self.plan.deps.dep_passed(dep):
+                        dependencies_satisfied = False
+                        break
+                if dependencies_satisfied and can_run(i, worker):
+                    return i
+            return None
+
+        while True:
+            for worker in range(self.num_workers):
+                if busy[worker] is not None:
+                    continue
+                i = find_test(worker)
+                if i is not None:
+                    test_status[i] = "running"
+                    held[worker] = needs[i]
+                    # Keep the tests depending on this test, and the tests
+                    # sharing a dependency with it, on this worker
+                    related = self.plan.deps.get_dependents(i)
+                    for dep in self.plan[i].dep:
+                        related.extend(self.plan.deps.get_related(dep))
+                    for j in related:
+                        if test_worker[j] is None:
+                            test_worker[j] = worker
+                    pid, pipe = self._fork(self._run_test, run_test_func,
+                                           get_params(i), worker)
+                    busy[worker] = (pid, pipe, i)
+                elif held[worker][0] or held[worker][1]:
+                    pid, pipe = self._fork(self._cleanup, worker)
+                    busy[worker] = (pid, pipe, None)
+
+            self._account(time.time(), sum(h[0] for h in held),
+                          sum(h[1] for h in held))
+
+            pipes = [b[1] for b in busy if b is not None]
+            if not pipes:
+                break
+            r, _, _ = select.select(pipes, [], [], self.sample_interval)
+            self._sample(time.time())
+            for worker in range(self.num_workers):
+                if busy[worker] is None or busy[worker][1] not in r:
+                    continue
+                pid, pipe, i = busy[worker]
+                msg = pipe.read().split()
+                pipe.close()
+                os.waitpid(pid, 0)
+                busy[worker] = None
+                if i is None:
+                    held[worker] = (0, 0, set())
+                elif len(msg) == 2:
+                    report(i, msg[0], float(msg[1]))
+                else:
+                    report(i, "FAIL")
+            self._account(time.time(), sum(h[0] for h in held),
+                          sum(h[1] for h in held))
+
+        # Tests still waiting can never run: nothing is running, so they
+        # can't be held back by the resources used by other tests, only by
+        # dependencies that will never pass (e.g. circular ones)
+        for i in range(n_tests):
+            if test_status[i] == "waiting":
+                deps = [dep for dep in self.plan[i].dep
+                        if not self.plan.deps.dep_passed(dep)]
+                logging.error("Test %s can't run, its dependencies never "
+                              "passed: %s", self.plan[i].name,
+                              ", ".join(deps))
+                report(i, "ERROR")
+        self.elapsed = time.time() - start
+        self._sample(start + self.elapsed)
+        return test_status
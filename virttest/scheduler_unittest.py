@@ -0,0 +1,170 @@
+#!/usr/bin/python
+import unittest, os, time, shutil, tempfile
+import common
+import scheduler
+
+
+def make_test(name, dep=(), **params):
+    test = {"name": name, "shortname": name, "dep": list(dep), "vms": "",
+            "status": "PASS", "sleep": "0"}
+    test.update(params)
+    return test
+
+
+class ResourceSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmpdir, "log")
+        self.get_host_cpu_time = scheduler.get_host_cpu_time
+        self.get_host_used_mem = scheduler.get_host_used_mem
+
+
+    def tearDown(self):
+        scheduler.get_host_cpu_time = self.get_host_cpu_time
+        scheduler.get_host_used_mem = self.get_host_used_mem
+        shutil.rmtree(self.tmpdir)
+
+
+    def run_test(self, params):
+        # Called in a child process of the scheduler
+        def log(event):
+            fd = os.open(self.log, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            os.write(fd, "%s %s %s\n" % (event, params["name"], params["env"]))
+            os.close(fd)
+        log("start")
+        time.sleep(float(params["sleep"]))
+        log("end")
+        if params["status"] == "crash":
+            raise Exception("Test crashed")
+        return params["status"], float(params["sleep"])
+
+
+    def run_scheduler(self, tests, num_workers=2, total_cpus=4,
+                      total_mem=4096, get_params=None):
+        self.sched = scheduler.ResourceScheduler(tests, num_workers,
+                                                 total_cpus, total_mem,
+                                                 self.tmpdir, get_params)
+        self.reports = []
+        report_func = lambda i, status, elapsed: self.reports.append(
+                                                        (i, status))
+        return self.sched.run(self.run_test, report_func)
+
+
+    def get_log(self):
+        if not os.path.exists(self.log):
+            return []
+        return [line.split() for line in open(self.log)]
+
+
+    def overlap(self, name1, name2):
+        # Return True if the tests ran at the same time
+        events = [(e, n) for e, n, env in self.get_log()]
+        return (events.index(("start", name1)) <
+                events.index(("end", name2)) and
+                events.index(("start", name2)) <
+                events.index(("end", name1)))
+
+
+    def test_packing(self):
+        tests = [make_test("t1", used_cpus=2, sleep=0.3),
+                 make_test("t2", used_cpus=2, sleep=0.3),
+                 make_test("t3", used_cpus=4, sleep=0.1)]
+        self.assertEqual(self.run_scheduler(tests, num_workers=3),
+                         ["PASS", "PASS", "PASS"])
+        self.assertTrue(self.overlap("t1", "t2"))
+        self.assertFalse(self.overlap("t1", "t3"))
+        self.assertFalse(self.overlap("t2", "t3"))
+        self.assertEqual(self.sched.peak_cpus, 4)
+
+
+    def test_too_large(self):
+        # Tests needing more than the host has still run, alone
+        tests = [make_test("t1", used_mem=8192, sleep=0.2),
+                 make_test("t2", sleep=0.2)]
+        self.assertEqual(self.run_scheduler(tests), ["PASS", "PASS"])
+        self.assertFalse(self.overlap("t1", "t2"))
+
+
+    def test_images(self):
+        image = {"vms": "vm1", "images": "image1", "image_name": "img",
+                 "image_format": "raw", "sleep": 0.2}
+        tests = [make_test("t1", **image), make_test("t2", **image),
+                 make_test("t3", image_snapshot="yes", **image)]
+        self.assertEqual(self.run_scheduler(tests, num_workers=3),
+                         ["PASS", "PASS", "PASS"])
+        self.assertFalse(self.overlap("t1", "t2"))
+        self.assertTrue(self.overlap("t1", "t3"))
+
+
+    def test_deps(self):
+        tests = [make_test("t1", sleep=0.2), make_test("t2", ["t1"]),
+                 make_test("t3", sleep=0.2)]
+        self.assertEqual(self.run_scheduler(tests),
+                         ["PASS", "PASS", "PASS"])
+        self.assertFalse(self.overlap("t1", "t2"))
+        self.assertTrue(self.overlap("t1", "t3"))
+        # Dependent tests run on the same worker, so they can reuse its env
+        envs = dict((n, env) for e, n, env in self.get_log())
+        self.assertEqual(envs["t1"], envs["t2"])
+        self.assertNotEqual(envs["t1"], envs["t3"])
+
+
+    def test_lazy_params(self):
+        # Test dicts are only built when tests become candidates to run,
+        # and once for the tests started right away
+        tests = [make_test("t1"), make_test("t2", ["t1"]),
+                 make_test("t3", ["t2"])]
+        calls = []
+
+        def get_params(i):
+            calls.append((i, len(self.get_log())))
+            return tests[i].copy()
+
+        self.assertEqual(self.run_scheduler(tests, num_workers=1,
+                                            get_params=get_params),
+                         ["PASS", "PASS", "PASS"])
+        # Each test is built after the previous one ran (start and end)
+        self.assertEqual(calls, [(0, 0), (1, 2), (2, 4)])
+
+
+    def test_failure(self):
+        tests = [make_test("t1", status="FAIL"), make_test("t2", ["t1"]),
+                 make_test("t3", status="crash"), make_test("t4")]
+        self.assertEqual(self.run_scheduler(tests),
+                         ["FAIL", "SKIP", "FAIL", "PASS"])
+        self.assertEqual(sorted(self.reports),
+                         [(0, "FAIL"), (1, "SKIP"), (2, "FAIL"),
+                          (3, "PASS")])
+        self.assertFalse("t2" in [n for e, n, env in self.get_log()])
+
+
+    def test_cycle(self):
+        tests = [make_test("t1", ["t2"]), make_test("t2", ["t1"]),
+                 make_test("t3")]
+        self.assertEqual(self.run_scheduler(tests),
+                         ["ERROR", "ERROR", "PASS"])
+        self.assertEqual(sorted(self.reports),
+                         [(0, "ERROR"), (1, "ERROR"), (2, "PASS")])
+
+
+    def test_utilization(self):
+        # The host has 2 CPUs busy and 512 MB more in use while tests run
+        start = time.time()
+        scheduler.get_host_cpu_time = lambda: (time.time() - start) * 2
+        mem = [1000, 1512]
+        scheduler.get_host_used_mem = lambda: mem.pop(0) if mem else 1512
+        tests = [make_test("t1", used_cpus=1, used_mem=1024, sleep=0.5)]
+        self.run_scheduler(tests, num_workers=1, total_cpus=4,
+                           total_mem=1024)
+        cpus, mem = self.sched.get_utilization()
+        self.assertAlmostEqual(cpus, 0.5, 1)
+        self.assertAlmostEqual(mem, 0.5, 1)
+        self.assertEqual(self.sched.peak_used_mem, 512)
+        # What the tests declared is accounted separately
+        cpus, mem = self.sched.get_reservation()
+        self.assertTrue(0 < cpus <= 0.25)
+        self.assertTrue(0 < mem <= 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+"""
+Append-only archive of the screendumps taken from a VM.
+
+Instead of one JPEG file per screendump, an archive directory holds two
+files:
+
+    frames: The encoded images, each one stored once, as records made of a
+            "<md5sum> <size>" line followed by size bytes of data.
+    index:  One "<time> <md5sum>" line per screendump taken, in order.
+
+Both files are only ever appended to, so a reader can follow an archive
+while it is being written, and a record cut short by a crash is simply
+ignored.
+
+tools/screendump_extract.py writes the screendumps of archives back as
+numbered JPEG files.
+
+@copyright: Red Hat 2013
+"""
+
+import os, threading
+
+
+FRAMES_FILENAME = "frames"
+INDEX_FILENAME = "index"
+
+
+def is_archive(path):
+    """
+    Return True if path is a screendump archive directory.
+    """
+    return os.path.isfile(os.path.join(path, INDEX_FILENAME))
+
+
+class ScreendumpArchive(object):
+    """
+    A screendump archive, see the module documentation.
+
+    The writer keeps a bounded cache of the md5sums of the images stored
+    (or being stored) in the archive, used to store repeated images only
+    once and to tell when the screen last changed.  An image evicted from
+    the cache is stored again if it shows up later.
+    """
+
+    def __init__(self, path, cache_size=1024):
+        """
+        @param path: Path of the archive directory.
+        @param cache_size: Maximum number of md5sums in the cache.
+        """
+        self.path = path
+        self.frames_filename = os.path.join(path, FRAMES_FILENAME)
+        self.index_filename = os.path.join(path, INDEX_FILENAME)
+        self.cache_size = cache_size
+        # md5sum -> sequence number of its last use
+        self._cache = {}
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._frames_file = None
+        self._index_file = None
+        # Time of the last screendump not found in the cache
+        self.last_change = None
+
+
+    def _open(self):
+        if self._index_file is None:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self._frames_file = open(self.frames_filename, "ab")
+            self._index_file = open(self.index_filename, "a")
+
+
+    def _touch(self, image_hash):
+        self._sequence += 1
+        self._cache[image_hash] = self._sequence
+        if len(self._cache) > self.cache_size:
+            # Evict the least recently used quarter of the cache
+            by_use = sorted(self._cache.items(), key=lambda item: item[1])
+            for old_hash, _ in by_use[:len(by_use) - self.cache_size * 3 / 4]:
+                del self._cache[old_hash]
+
+
+    def has_frame(self, image_hash):
+        """
+        Return True if an image is in the cache, i.e. it does not need to
+        be stored again.
+
+        @param image_hash: md5sum of the image.
+        """
+        self._lock.acquire()
+        try:
+            return image_hash in self._cache
+        finally:
+            self._lock.release()
+
+
+    def add(self, image_hash, timestamp):
+        """
+        Record a screendump in the index.  Images not in the cache are
+        added to it and must be stored with store().
+
+        @param image_hash: md5sum of the image.
+        @param timestamp: Time the screendump was taken.
+        """
+        self._lock.acquire()
+        try:
+            self._open()
+            if image_hash not in self._cache:
+                self.last_change = timestamp
+            self._touch(image_hash)
+            self._index_file.write("%.3f %s\n" % (timestamp, image_hash))
+            self._index_file.flush()
+        finally:
+            self._lock.release()
+
+
+    def store(self, image_hash, data):
+        """
+        Append an encoded image to the archive.
+
+        @param image_hash: md5sum of the image (not of data).
+        @param data: Encoded image.
+        """
+        self._lock.acquire()
+        try:
+            self._open()
+            self._frames_file.write("%s %d\n%s" % (image_hash, len(data),
+                                                    data))
+            self._frames_file.flush()
+        finally:
+            self._lock.release()
+
+
+    def forget(self, image_hash):
+        """
+        Remove an image from the cache, e.g. because it could not be
+        stored, so that it is stored again if it shows up later.
+        """
+        self._lock.acquire()
+        try:
+            self._cache.pop(image_hash, None)
+        finally:
+            self._lock.release()
+
+
+    def close(self):
+        """
+        Close the archive files.
+        """
+        self._lock.acquire()
+        try:
+            if self._index_file is not None:
+                self._frames_file.close()
+                self._index_file.close()
+                self._frames_file = None
+                self._index_file = None
+        finally:
+            self._lock.release()
+
+
+    def read_index(self):
+        """
+        Return the list of screendumps recorded in the archive, as
+        (time, md5sum) tuples.
+        """
+        index = []
+        try:
+            fin = open(self.index_filename)
+        except IOError:
+            return index
+        try:
+            for line in fin:
+                if not line.endswith("\n"):
+                    break
+                timestamp, image_hash = line.split()
+                index.append((float(timestamp), image_hash))
+        finally:
+            fin.close()
+        return index
+
+
+    def read_offsets(self):
+        """
+        Return a dict mapping the md5sums of the images stored in the
+        archive to the (offset, size) of their data in the frames file.
+        """
+        offsets = {}
+        try:
+            fin = open(self.frames_filename, "rb")
+        except IOError:
+            return offsets
+        try:
+            file_size = os.fstat(fin.fileno()).st_size
+            while True:
+                line = fin.readline()
+                if not line.endswith("\n"):
+                    break
+                image_hash, size = line.split()
+                offset = fin.tell()
+                size = int(size)
+                if offset + size > file_size:
+                    break
+                offsets.setdefault(image_hash, (offset, size))
+                fin.seek(size, os.SEEK_CUR)
+        finally:
+            fin.close()
+        return offsets
+
+
+    def get_frames(self):
+        """
+        Iterate over the screendumps recorded in the archive, in order, as
+        (time, md5sum, data) tuples.  Screendumps whose image was not
+        stored are skipped.
+        """
+        offsets = self.read_offsets()
+        if not offsets:
+            return
+        fin = open(self.frames_filename, "rb")
+        try:
+            for timestamp, image_hash in self.read_index():
+                if image_hash not in offsets:
+                    continue
+                offset, size = offsets[image_hash]
+                fin.seek(offset)
+                yield timestamp, image_hash, fin.read(size)
+        finally:
+            fin.close()
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+import unittest, os, tempfile, shutil
+import screendump_archive
+
+
+class ScreendumpArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "screendumps_vm1")
+        self.archive = screendump_archive.ScreendumpArchive(self.path,
+                                                            cache_size=4)
+
+
+    def tearDown(self):
+        self.archive.close()
+        shutil.rmtree(self.tmpdir)
+
+
+    def add(self, image_hash, timestamp):
+        new = not self.archive.has_frame(image_hash)
+        self.archive.add(image_hash, timestamp)
+        if new:
+            self.archive.store(image_hash, "data-%s" % image_hash)
+
+
+    def test_frames(self):
+        self.assertFalse(screendump_archive.is_archive(self.path))
+        for timestamp, image_hash in enumerate("aabab"):
+            self.add(image_hash, timestamp)
+        self.assertTrue(screendump_archive.is_archive(self.path))
+        self.assertEqual(len(self.archive.read_offsets()), 2)
+        self.assertEqual(self.archive.last_change, 2)
+        frames = list(self.archive.get_frames())
+        self.assertEqual([(t, h) for t, h, d in frames],
+                         self.archive.read_index())
+        self.assertEqual([d for t, h, d in frames],
+                         ["data-a", "data-a", "data-b", "data-a", "data-b"])
+
+
+    def test_cache_is_bounded(self):
+        for timestamp, image_hash in enumerate("abcdeafa"):
+            self.add(image_hash, timestamp)
+        self.assertTrue(len(self.archive._cache) <= 4)
+        # 'a' was evicted and stored again at 5, then found in the cache
+        self.assertEqual(self.archive.last_change, 6)
+        frames = open(self.archive.frames_filename).read()
+        self.assertEqual(frames.count("data-a"), 2)
+        self.assertEqual(len(list(self.archive.get_frames())), 8)
+
+
+    def test_unstored_and_truncated_frames(self):
+        self.archive.add("a", 0)
+        self.add("b", 1)
+        self.archive.close()
+        open(self.archive.frames_filename, "a").write("c 100\nshort")
+        open(self.archive.index_filename, "a").write("2.000 c\n3.0")
+        reader = screendump_archive.ScreendumpArchive(self.path)
+        self.assertEqual(reader.read_index(), [(0, "a"), (1, "b"), (2, "c")])
+        self.assertEqual(list(reader.get_frames()), [(1, "b", "data-b")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,7 @@ import os, logging, imp, sys, time, traceback, Queue, glob, shutil
 from autotest.client.shared import error
 from autotest.client import utils
 import utils_misc, utils_params, utils_env, env_process, data_dir, bootstrap
-import storage, cartesian_config
+import storage, qemu_storage, cartesian_config, utils_plan, scheduler
 
 global GUEST_NAME_LIST
 GUEST_NAME_LIST = None
@@ -386,6 +386,34 @@ def create_config_files(options):
     bootstrap.create_guest_os_cfg(options.type)
 
 
+def get_cartesian_cache_dir(options):
+    """
+    Return the directory used to cache parsed cartesian configs.
+
+    @param options: OptParser object with options.
+    @return: Path of the cache dir, or None if caching was disabled.
+    """
+    if not getattr(options, "config_cache", True):
+        return None
+    return os.path.join(data_dir.get_tmp_dir(), "cartesian_cache")
+
+
+def get_cartesian_parser(options):
+    """
+    Return a cartesian config parser set up according to options.
+
+    @param options: OptParser object with options.
+    """
+    cache_dir = get_cartesian_cache_dir(options)
+    # The parsed tree is small and shared by every run, while a dicts entry
+    # is the whole expansion for one set of filters, so it's opt-in
+    cache_dicts = (cache_dir is not None and
+                   getattr(options, "config_cache_dicts", False))
+    return cartesian_config.Parser(cache_dir=cache_dir,
+                                   cache_dicts=cache_dicts,
+                                   jobs=getattr(options, "config_jobs", 1))
+
+
 def get_paginator():
     try:
         less_cmd = utils_misc.find_command('less')
@@ -408,9 +436,13 @@ def print_test_list(options, cartesian_parser):
     pipe.write("Tests produced for type %s, config file %s" %
                (options.type, cartesian_parser.filename))
     pipe.write("\n\n")
-    d = cartesian_parser.get_dicts().next()
-    tag_index = get_tag_index(options, d)
-    for params in cartesian_parser.get_dicts():
+    # Only compute the parameters shown here instead of the whole dicts
+    tests = list(cartesian_parser.query(keys=["virt_test_type",
+                                               "requires_root", "vm_type"]))
+    if not tests:
+        return
+    tag_index = get_tag_index(options, tests[0])
+    for params in tests:
         virt_test_type = params.get('virt_test_type', "")
         supported_virt_backends = virt_test_type.split(" ")
         if options.type in supported_virt_backends:
@@ -433,10 +465,10 @@ def get_guest_name_list(options):
     if GUEST_NAME_LIST is None:
         cfg = os.path.join(data_dir.get_root_dir(), options.type,
                            "cfg", "guest-os.cfg")
-        cartesian_parser = cartesian_config.Parser()
+        cartesian_parser = get_cartesian_parser(options)
         cartesian_parser.parse_file(cfg)
         guest_name_list = []
-        for params in cartesian_parser.get_dicts():
+        for params in cartesian_parser.query():
             shortname = ".".join(params['name'].split(".")[1:])
             guest_name_list.append(shortname)
 
@@ -457,7 +489,7 @@ def print_guest_list(options):
     """
     cfg = os.path.join(data_dir.get_root_dir(), options.type,
                        "cfg", "guest-os.cfg")
-    cartesian_parser = cartesian_config.Parser()
+    cartesian_parser = get_cartesian_parser(options)
     cartesian_parser.parse_file(cfg)
     pipe = get_paginator()
     index = 0
@@ -555,6 +587,155 @@ def bootstrap_tests(options):
     return True
 
 
+def run_test(t):
+    """
+    Run a single test, logging its outcome to the test log.
+
+    @param t: Test object, with its debugdir already set.
+    @return: Tuple (status, elapsed time), status being one of "PASS",
+            "FAIL", "SKIP" or "WARN".
+    """
+    t_begin = time.time()
+    t.start_file_logging()
+    try:
+        try:
+            if t.run_once():
+                logging.info("PASS %s" % t.tag)
+                status = "PASS"
+            else:
+                status = "FAIL"
+        except error.TestNAError, reason:
+            logging.info("SKIP %s -> %s: %s", t.tag,
+                         reason.__class__.__name__, reason)
+            status = "SKIP"
+        except error.TestWarn, reason:
+            logging.info("WARN %s -> %s: %s", t.tag,
+                         reason.__class__.__name__,
+                         reason)
+            status = "WARN"
+        except Exception, reason:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            logging.error("")
+            tb_info = traceback.format_exception(exc_type, exc_value,
+                                                 exc_traceback.tb_next)
+            tb_info = "".join(tb_info)
+            for e_line in tb_info.splitlines():
+                logging.error(e_line)
+            logging.error("")
+            logging.error("FAIL %s -> %s: %s", t.tag,
+                          reason.__class__.__name__,
+                          reason)
+            status = "FAIL"
+    finally:
+        logging.info("")
+        t.stop_file_logging()
+    return status, time.time() - t_begin
+
+
+def print_status(status, t_elapsed):
+    """
+    Print the status of a test returned by run_test() to stdout.
+    """
+    if status == "PASS":
+        print_pass(t_elapsed)
+    elif status == "WARN":
+        print_warn(t_elapsed)
+    elif status == "SKIP":
+        print_skip()
+    else:
+        print_fail(t_elapsed)
+
+
+def get_host_resources():
+    """
+    Return the number of online CPUs and the total memory (MB) of the host.
+    """
+    return os.sysconf("SC_NPROCESSORS_ONLN"), utils.memtotal() / 1024
+
+
+def get_test_params(plan, entry):
+    """
+    Return the params a test of a plan runs with.
+
+    @param plan: utils_plan.TestPlan object.
+    @param entry: The PlanEntry of the test.
+    """
+    dct = plan.get_params(entry)
+    # Add the parameter decide if setup host env in the test case
+    # For some special tests we only setup host in the first and last case
+    # When we need to setup host env we need the host_setup_flag as following:
+    #    0(00): do nothing
+    #    1(01): setup env
+    #    2(10): cleanup env
+    #    3(11): setup and cleanup env
+    setup_flag = 1
+    cleanup_flag = 2
+    if entry.index == 0:
+        if dct.get("host_setup_flag", None) is not None:
+            flag = int(dct["host_setup_flag"])
+            dct["host_setup_flag"] = flag | setup_flag
+        else:
+            dct["host_setup_flag"] = setup_flag
+    if entry.index == len(plan) - 1:
+        if dct.get("host_setup_flag", None) is not None:
+            flag = int(dct["host_setup_flag"])
+            dct["host_setup_flag"] = flag | cleanup_flag
+        else:
+            dct["host_setup_flag"] = cleanup_flag
+
+    # Add kvm module status
+    dct["kvm_default"] = utils_misc.get_module_params(
+                                         dct.get("sysfs_dir", "sys"), "kvm")
+    return dct
+
+
+def run_tests_parallel(plan, entries, options, debugdir):
+    """
+    Run tests in parallel with scheduler.ResourceScheduler, printing the
+    status of each test as it completes.
+
+    @param plan: utils_plan.TestPlan object.
+    @param entries: List of PlanEntry objects of the tests to run.
+    @param options: Command line options.
+    @param debugdir: Directory where the test logs are placed.
+    @return: True, if all tests ran passed, False if any of them failed.
+    """
+    total_cpus, total_mem = get_host_resources()
+    envdir = os.path.join(data_dir.get_root_dir(), options.type)
+    n_tests = len(plan)
+    tests = [entry.info for entry in entries]
+    get_params = lambda i: get_test_params(plan, entries[i])
+    sched = scheduler.ResourceScheduler(tests, options.workers, total_cpus,
+                                        total_mem, envdir, get_params)
+    for worker_dict in sched.worker_dicts:
+        env_filename = os.path.join(envdir, worker_dict["env"])
+        utils_env.Env(env_filename, Test.env_version).destroy()
+    logging.info("Running up to %d tests at a time on %d CPUs and %d MB "
+                 "of memory", options.workers, total_cpus, total_mem)
+
+    def run_test_func(params):
+        t = Test(params, options)
+        t.set_debugdir(debugdir)
+        return run_test(t)
+
+    def report_func(i, status, t_elapsed):
+        entry = entries[i]
+        pretty_index = "(%d/%d)" % (entry.index + 1, n_tests)
+        tag = get_tag(entry.info, get_tag_index(options, entry.info))
+        print_stdout("%s %s:" % (pretty_index, tag), end=False)
+        print_status(status, t_elapsed)
+
+    results = sched.run(run_test_func, report_func)
+    cpu_usage, mem_usage = sched.get_utilization()
+    cpu_reserved, mem_reserved = sched.get_reservation()
+    print_header("UTILIZATION: CPU %d%% of %d (%d%% reserved), MEM %d%% of "
+                 "%d MB (%d%% reserved, peak %d MB used)" %
+                 (cpu_usage * 100, total_cpus, cpu_reserved * 100,
+                  mem_usage * 100, total_mem, mem_reserved * 100,
+                  sched.peak_used_mem))
+    return "FAIL" not in results and "ERROR" not in results
+
+
 def run_tests(parser, options):
     """
     Runs the sequence of KVM tests based on the list of dctionaries
@@ -576,16 +757,22 @@ def run_tests(parser, options):
 
     print_header("DEBUG LOG: %s" % debuglog)
 
-    last_index = -1
-
     logging.info("Starting test job at %s" % time.strftime('%Y-%m-%d %H:%M:%S'))
     logging.info("")
     logging.debug("Options received from the command line:")
     utils_misc.display_attributes(options)
     logging.debug("")
 
+    plan = utils_plan.get_test_plan(parser,
+                                    keys=["skip", "aexpect_multiplexer"])
+    if not plan:
+        print_stdout("No tests generated by config file %s" % parser.filename)
+        print_stdout("Please check the file for errors (bad variable names, "
+                     "wrong indentation)")
+        sys.exit(-1)
+
     logging.debug("Cleaning up previous job tmp files")
-    d = parser.get_dicts().next()
+    d = plan.get_params(plan[0])
     env_filename = os.path.join(data_dir.get_root_dir(),
                                 options.type, d.get("env", "env"))
     env = utils_env.Env(env_filename, Test.env_version)
@@ -603,7 +790,7 @@ def run_tests(parser, options):
 
     if options.restore_image_between_tests:
         logging.debug("Creating first backup of guest image")
-        qemu_img = storage.QemuImg(d, data_dir.get_data_dir(), "image")
+        qemu_img = qemu_storage.QemuImg(d, data_dir.get_data_dir(), "image")
         qemu_img.backup_image(d, data_dir.get_data_dir(), 'backup', True)
         logging.debug("")
 
@@ -616,133 +803,49 @@ def run_tests(parser, options):
 
     tag_index = get_tag_index(options, d)
     logging.info("Defined test set:")
-    for i, d in enumerate(parser.get_dicts()):
-        shortname = get_tag(d, tag_index)
-
-        logging.info("Test %4d:  %s" % (i + 1, shortname))
-        last_index += 1
-
-    if last_index == -1:
-        print_stdout("No tests generated by config file %s" % parser.filename)
-        print_stdout("Please check the file for errors (bad variable names, "
-                     "wrong indentation)")
-        sys.exit(-1)
+    for entry in plan:
+        shortname = get_tag(entry.info, tag_index)
+        logging.info("Test %4d:  %s" % (entry.index + 1, shortname))
     logging.info("")
 
-    n_tests = last_index + 1
+    n_tests = len(plan)
     print_header("TESTS: %s" % n_tests)
 
-    status_dct = {}
+    parallel = options.workers > 1
+    if parallel and [e for e in plan
+                     if e.info.get("aexpect_multiplexer") == "yes"]:
+        print_stdout("The aexpect multiplexer (aexpect_multiplexer = yes) "
+                     "can't be used with --parallel")
+        sys.exit(-1)
+    entries = []
     failed = False
-    # Add the parameter decide if setup host env in the test case
-    # For some special tests we only setup host in the first and last case
-    # When we need to setup host env we need the host_setup_flag as following:
-    #    0(00): do nothing
-    #    1(01): setup env
-    #    2(10): cleanup env
-    #    3(11): setup and cleanup env
-    index = 0
-    setup_flag = 1
-    cleanup_flag = 2
-    for dct in parser.get_dicts():
-        shortname = get_tag(dct, tag_index)
-
-        if index == 0:
-            if dct.get("host_setup_flag", None) is not None:
-                flag = int(dct["host_setup_flag"])
-                dct["host_setup_flag"] = flag | setup_flag
-            else:
-                dct["host_setup_flag"] = setup_flag
-        if index == last_index:
-            if dct.get("host_setup_flag", None) is not None:
-                flag = int(dct["host_setup_flag"])
-                dct["host_setup_flag"] = flag | cleanup_flag
-            else:
-                dct["host_setup_flag"] = cleanup_flag
-        index += 1
+    for entry in plan:
+        shortname = get_tag(entry.info, tag_index)
+        index = entry.index + 1
 
-        # Add kvm module status
-        dct["kvm_default"] = utils_misc.get_module_params(
-                                             dct.get("sysfs_dir", "sys"), "kvm")
-
-        if dct.get("skip") == "yes":
+        if entry.info.get("skip") == "yes":
             continue
 
-        dependencies_satisfied = True
-        for dep in dct.get("dep"):
-            for test_name in status_dct.keys():
-                if not dep in test_name:
-                    continue
-
-                if not status_dct[test_name]:
-                    dependencies_satisfied = False
-                    break
+        if parallel:
+            entries.append(entry)
+            continue
 
-        current_status = False
-        if dependencies_satisfied:
-            t = Test(dct, options)
+        if not plan.dependencies_failed(entry):
+            t = Test(get_test_params(plan, entry), options)
             t.set_debugdir(debugdir)
 
             pretty_index = "(%d/%d)" % (index, n_tests)
             print_stdout("%s %s:" % (pretty_index, t.tag), end=False)
-
-            try:
-                try:
-                    t_begin = time.time()
-                    t.start_file_logging()
-                    current_status = t.run_once()
-                    logging.info("PASS %s" % t.tag)
-                    logging.info("")
-                    t.stop_file_logging()
-                finally:
-                    t_end = time.time()
-                    t_elapsed = t_end - t_begin
-            except error.TestNAError, reason:
-                logging.info("SKIP %s -> %s: %s", t.tag,
-                             reason.__class__.__name__, reason)
-                logging.info("")
-                t.stop_file_logging()
-                print_skip()
-                status_dct[dct.get("name")] = False
-                continue
-            except error.TestWarn, reason:
-                logging.info("WARN %s -> %s: %s", t.tag,
-                             reason.__class__.__name__,
-                             reason)
-                logging.info("")
-                t.stop_file_logging()
-                print_warn(t_elapsed)
-                status_dct[dct.get("name")] = True
-                continue
-            except Exception, reason:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                logging.error("")
-                tb_info = traceback.format_exception(exc_type, exc_value,
-                                                     exc_traceback.tb_next)
-                tb_info = "".join(tb_info)
-                for e_line in tb_info.splitlines():
-                    logging.error(e_line)
-                logging.error("")
-                logging.error("FAIL %s -> %s: %s", t.tag,
-                              reason.__class__.__name__,
-                              reason)
-                logging.info("")
-                t.stop_file_logging()
-                current_status = False
+            status, t_elapsed = run_test(t)
         else:
-            shortname = get_tag(d, tag_index)
             print_stdout("%s:" % shortname, end=False)
-            print_skip()
-            status_dct[dct.get("name")] = False
-            continue
-
-        if not current_status:
+            status, t_elapsed = "SKIP", 0
+        print_status(status, t_elapsed)
+        if status == "FAIL":
             failed = True
-            print_fail(t_elapsed)
-
-        else:
-            print_pass(t_elapsed)
+        plan.record_result(entry, status in ("PASS", "WARN"))
 
-        status_dct[dct.get("name")] = current_status
+    if parallel:
+        failed = not run_tests_parallel(plan, entries, options, debugdir)
 
     return not failed
@@ -3,6 +3,7 @@ Classes and functions to handle storage devices.
 
 This exports:
   - two functions for get image/blkdebug filename
+  - functions to copy image files, cloning them when possible
   - class for image operates and basic parameters
 """
 import logging, os, shutil, re
@@ -102,6 +103,64 @@ def get_image_filename(params, root_dir):
     return image_filename
 
 
+def reflink_copy(src, dst):
+    """
+    Clone a file, sharing its data blocks with the copy (copy-on-write).
+
+    This only works on filesystems supporting reflinks, such as btrfs.
+
+    @param src: Source file.
+    @param dst: Destination file.
+    @return: True if the file was cloned, False otherwise.
+    """
+    result = utils.run("cp --reflink=always %s %s" % (src, dst),
+                       ignore_status=True, verbose=False)
+    return result.exit_status == 0
+
+
+def sparse_copy(src, dst, block_size=4 * 1024 * 1024):
+    """
+    Copy a file in large blocks, leaving holes in the copy where the source
+    has blocks of zeros.
+
+    @param src: Source file.
+    @param dst: Destination file.
+    @param block_size: Amount of data to copy at a time.
+    """
+    zeros = "\0" * block_size
+    src_file = open(src, "rb")
+    try:
+        dst_file = open(dst, "wb")
+        try:
+            data = src_file.read(block_size)
+            while data:
+                if data == zeros[:len(data)]:
+                    dst_file.seek(len(data), os.SEEK_CUR)
+                else:
+                    dst_file.write(data)
+                data = src_file.read(block_size)
+            dst_file.truncate()
+        finally:
+            dst_file.close()
+    finally:
+        src_file.close()
+    shutil.copymode(src, dst)
+
+
+def copy_image_file(src, dst):
+    """
+    Copy an image file, cloning it if possible.
+
+    @param src: Source file.
+    @param dst: Destination file.
+    """
+    if reflink_copy(src, dst):
+        logging.debug("Cloned %s -> %s", src, dst)
+    else:
+        logging.debug("Copying %s -> %s", src, dst)
+        sparse_copy(src, dst)
+
+
 class OptionMissing(Exception):
     """
     Option not found in the odbject
@@ -181,14 +240,16 @@ class QemuImg(object):
         """
         def backup_raw_device(src, dst):
             if os.path.exists(src):
-                utils.system("dd if=%s of=%s bs=4k conv=sync" % (src, dst))
+                cmd = "dd if=%s of=%s bs=4M" % (src, dst)
+                if not os.path.exists(dst) or os.path.isfile(dst):
+                    cmd += " conv=sparse"
+                utils.system(cmd)
             else:
                 logging.info("No source %s, skipping dd...", src)
 
         def backup_image_file(src, dst):
-            logging.debug("Copying %s -> %s", src, dst)
             if os.path.isfile(src):
-                shutil.copy(src, dst)
+                copy_image_file(src, dst)
             else:
                 logging.info("No source file %s, skipping copy...", src)
 
@@ -265,9 +326,129 @@ class QemuImg(object):
                               "full backup. Skipping backup...")
                 return
 
+        image_file = backup_func is backup_image_file
+        if image_file and (good or action == "restore"):
+            src, dst = backup_set[0]
+            if self._backup_overlay(params, action, src, dst):
+                return
+
         for src, dst in backup_set:
             backup_func(src, dst)
 
+        if image_file and not good and action == "backup":
+            # The copy of a bad overlay has to point to the copy of the good
+            # image it was made over
+            (src_bad, dst_bad), (src_good, dst_good) = backup_set
+            if self._is_overlay_over(dst_bad, src_good):
+                utils.run("%s rebase -u -b %s -F qcow2 %s" %
+                          (self.image_cmd, dst_good, dst_bad), verbose=False)
+
+
+    def get_restore_method(self, params):
+        """
+        Return how backup_image() backs up and restores the image:
+
+            overlay: Make the image a throwaway qcow2 overlay over the
+                     backup, restoring the image just creates a new overlay.
+            copy: Copy the whole image, cloning it with a reflink when the
+                  filesystem supports it.
+
+        @param params: Dictionary containing the test parameters.
+
+        @note: params may contain:
+               image_restore_method -- copy (the default) or overlay.
+                   Overlays are only used for qcow2 image files, when
+                   qemu-img is available, other images are copied.  Since
+                   the image is moved to backup_dir and replaced by an
+                   overlay, only ask for overlays for images the tests own.
+        """
+        method = params.get("image_restore_method", "copy")
+        if (method == "overlay" and self.image_format == "qcow2" and
+            params.get("image_raw_device") != "yes" and
+            getattr(self, "image_cmd", None) is not None):
+            return "overlay"
+        return "copy"
+
+
+    def get_backing_file(self, filename):
+        """
+        Return the backing file of an image, None if it has none.
+
+        @param filename: Path of the image.
+        """
+        if getattr(self, "image_cmd", None) is None:
+            return None
+        result = utils.run("%s info %s" % (self.image_cmd, filename),
+                           ignore_status=True, verbose=False)
+        for line in result.stdout.splitlines():
+            if line.startswith("backing file:"):
+                backing_file = line.split(":", 1)[1].strip()
+                return backing_file.split(" (actual path:")[0]
+        return None
+
+
+    def _is_overlay_over(self, filename, base):
+        if not (os.path.isfile(filename) and os.path.isfile(base)):
+            return False
+        backing_file = self.get_backing_file(filename)
+        return (backing_file is not None and os.path.isfile(backing_file) and
+                os.path.samefile(backing_file, base))
+
+
+    def create_overlay(self, filename, backing_file):
+        """
+        Create a qcow2 image whose reads fall through to backing_file, and
+        whose writes are kept in the new image.
+
+        @param filename: Path of the new image.
+        @param backing_file: Path of the qcow2 backing image.
+        @return: True if the overlay was created, False otherwise.
+        """
+        if os.path.exists(filename):
+            os.unlink(filename)
+        result = utils.run("%s create -f qcow2 -b %s -F qcow2 %s" %
+                           (self.image_cmd, backing_file, filename),
+                           ignore_status=True, verbose=False)
+        if result.exit_status != 0:
+            logging.warning("Could not create overlay %s over %s: %s",
+                            filename, backing_file, result.stderr.strip())
+            return False
+        return True
+
+
+    def _backup_overlay(self, params, action, src, dst):
+        """
+        Do a backup_image() step of a good image without copying it, when
+        the image is (or can be made) an overlay over its backup.
+
+        @return: True if the step was done, False if the image has to be
+                copied instead.
+        """
+        overlay = self.get_restore_method(params) == "overlay"
+        if action == "backup" and os.path.isfile(src):
+            if self._is_overlay_over(src, dst):
+                # Merge the changes made since the last restore, and turn
+                # the image back into a full copy unless overlays are used
+                logging.debug("Committing %s into %s", src, dst)
+                utils.run("%s commit %s" % (self.image_cmd, src),
+                          verbose=False)
+                if not overlay or not self.create_overlay(src, dst):
+                    copy_image_file(dst, src)
+                return True
+            if overlay:
+                logging.debug("Moving %s -> %s", src, dst)
+                try:
+                    os.rename(src, dst)
+                except OSError:
+                    copy_image_file(src, dst)
+                if not self.create_overlay(src, dst):
+                    copy_image_file(dst, src)
+                return True
+        elif action == "restore" and os.path.isfile(src) and overlay:
+            logging.debug("Discarding the changes made to %s", dst)
+            return self.create_overlay(dst, src)
+        return False
+
 
     def clone_image(self, params, vm_name, image_name, root_dir):
         """
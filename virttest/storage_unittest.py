@@ -0,0 +1,67 @@
+#!/usr/bin/python
+import unittest, os, tempfile, shutil
+import common
+import storage, utils_params
+
+
+class StorageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def write_sparse(self, filename):
+        sparse = open(filename, "wb")
+        sparse.write("x" * 100)
+        sparse.seek(20 * 1024 * 1024)
+        sparse.write("y" * 100)
+        sparse.truncate(30 * 1024 * 1024)
+        sparse.close()
+
+
+    def test_sparse_copy(self):
+        src = os.path.join(self.tmpdir, "src")
+        dst = os.path.join(self.tmpdir, "dst")
+        self.write_sparse(src)
+        storage.sparse_copy(src, dst)
+        self.assertEqual(open(src).read(), open(dst).read())
+        self.assertTrue(os.stat(dst).st_blocks * 512 < 10 * 1024 * 1024)
+
+
+    def test_copy_restore(self):
+        params = utils_params.Params({
+                            "image_name": os.path.join(self.tmpdir, "image"),
+                            "image_format": "raw",
+                            "backup_dir": os.path.join(self.tmpdir, "backup")})
+        image = storage.QemuImg(params, self.tmpdir, "image1")
+        self.assertEqual(image.get_restore_method(params), "copy")
+        self.write_sparse(image.image_filename)
+        image.backup_image(params, self.tmpdir, "backup", True)
+        image_file = open(image.image_filename, "r+b")
+        image_file.write("z" * 100)
+        image_file.close()
+        image.backup_image(params, self.tmpdir, "restore", True)
+        image_file = open(image.image_filename)
+        self.assertEqual(image_file.read(100), "x" * 100)
+        image_file.close()
+
+
+    def test_restore_method(self):
+        params = utils_params.Params({
+                            "image_name": os.path.join(self.tmpdir, "image"),
+                            "image_format": "qcow2"})
+        image = storage.QemuImg(params, self.tmpdir, "image1")
+        image.image_cmd = "qemu-img"
+        # Overlays have to be asked for
+        self.assertEqual(image.get_restore_method(params), "copy")
+        params["image_restore_method"] = "overlay"
+        self.assertEqual(image.get_restore_method(params), "overlay")
+        params["image_raw_device"] = "yes"
+        self.assertEqual(image.get_restore_method(params), "copy")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,23 @@
-import cPickle, UserDict, os, logging
+import cPickle, UserDict, os, logging, StringIO, fcntl, threading
+
+try:
+    import hashlib
+except ImportError:
+    import md5 as hashlib
 
 ENV_VERSION = 1
 
+# First line of an env journal file.  Env files without it are whole-dict
+# pickles written by older versions.
+ENV_JOURNAL_MAGIC = "#virt-test env journal 1\n"
+
+# Types never referenced across entries, see EnvStore
+_UNSHARED_TYPES = (basestring, int, long, float, bool, type(None), tuple)
+
+# The lock file of a journal (see EnvStore.save()) only excludes other
+# processes, this lock excludes other threads of this process
+_save_lock = threading.Lock()
+
 
 def get_env_version():
     return ENV_VERSION
@@ -11,6 +27,561 @@ class EnvSaveError(Exception):
     pass
 
 
+def _md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def _same_file(f1, f2):
+    st1 = os.fstat(f1.fileno())
+    st2 = os.fstat(f2.fileno())
+    return (st1.st_dev, st1.st_ino) == (st2.st_dev, st2.st_ino)
+
+
+def _format_record(op, key, refs=(), data=""):
+    """
+    Return a journal record: a "<md5sum> <meta size> <data size>" line,
+    followed by the pickled (op, key, refs) tuple and the entry pickle.
+    """
+    meta = cPickle.dumps((op, key, sorted(refs)), 2)
+    return "%s %d %d\n%s%s" % (_md5(meta + data), len(meta), len(data),
+                                meta, data)
+
+
+def _read_records(f):
+    """
+    Iterate over the journal records in f, from its current position, as
+    (op, key, refs, data offset, data size, data md5sum, record end)
+    tuples.  Stops at the first truncated or corrupted record.
+    """
+    while True:
+        line = f.readline()
+        if not line.endswith("\n"):
+            return
+        try:
+            md5sum, meta_size, data_size = line.split()
+            meta_size = int(meta_size)
+            data_size = int(data_size)
+        except ValueError:
+            return
+        payload = f.read(meta_size + data_size)
+        if len(payload) != meta_size + data_size or _md5(payload) != md5sum:
+            return
+        try:
+            op, key, refs = cPickle.loads(payload[:meta_size])
+        except Exception:
+            return
+        end = f.tell()
+        yield (op, key, set(refs), end - data_size, data_size,
+               _md5(payload[meta_size:]), end)
+
+
+class EnvStore(UserDict.DictMixin):
+    """
+    Dict-like storage of env entries in a journal file.
+
+    Each entry is pickled on its own.  Loading the journal only reads the
+    record headers; entries are unpickled on first access, after checking
+    their md5sum.  Entries set, or handed out (and so possibly modified),
+    since the last save are dirty: on save(), they are pickled again, and
+    only the new, changed and deleted ones are appended to the journal
+    followed by a commit record, then the file is synced.  Records after the
+    last commit (e.g. cut short by a crash) are ignored.  When the journal
+    grows too much, or when it is first written, it is rewritten to a
+    temporary file renamed over it.
+
+    Several stores may use the same journal: saving is done under a lock,
+    after reading the records other stores committed since this one last
+    read or wrote the journal.  Entries changed by both are saved with the
+    value of the last store saving them.  A store keeps the journal it read
+    open, so it keeps loading consistent entries if another store rewrites
+    the journal.
+
+    Objects which are themselves values of other entries (e.g. the address
+    cache shared by the VMs and tcpdump) are pickled as references to those
+    entries, so they are still shared once loaded back.
+
+    Entries may be accessed from several threads (e.g. the screendump thread
+    and parallel preprocessing): loading, changing and saving entries is
+    done under a per-store lock, since loads seek in the shared journal.
+    """
+
+    # Rewrite the journal when it is both this much larger than its live
+    # entries and larger than COMPACT_MIN_SIZE
+    COMPACT_RATIO = 2
+    COMPACT_MIN_SIZE = 1024 * 1024
+
+    def __init__(self, filename=None):
+        """
+        @param filename: Path to the journal file.  Nothing is loaded if
+                None or if the file doesn't exist.
+        @raise: Exception if the file exists but can't be read.
+        """
+        self.filename = filename
+        # key -> (data offset, data size, data md5sum) of persisted entries
+        self._index = {}
+        # key -> entries referenced by its pickle
+        self._refs = {}
+        # key -> value of the entries loaded, set or accessed
+        self._values = {}
+        # entries set or accessed since the last save
+        self._dirty = set()
+        # persisted entries deleted since the last save
+        self._deleted = set()
+        self._loading = set()
+        # The journal file read or written last, size of its valid part, and
+        # size of its live records
+        self._journal = None
+        self._end = 0
+        self._live_size = 0
+        self._rewrite = False
+        # Reentrant, loading an entry loads the entries it references
+        self._data_lock = threading.RLock()
+        if filename and os.path.isfile(filename):
+            self._load_journal()
+
+
+    def _load_journal(self):
+        f = open(self.filename, "rb")
+        if f.readline() != ENV_JOURNAL_MAGIC:
+            # Whole dict pickle from an older version
+            try:
+                f.seek(0)
+                self._values = cPickle.load(f)
+            finally:
+                f.close()
+            self._dirty = set(self._values)
+            self._rewrite = True
+            return
+        self._journal = f
+        self._end = self._replay(f, f.tell(), self._index, self._refs)
+        self._live_size = sum([size for _, size, _ in self._index.values()])
+
+
+    def _replay(self, f, start, index, refs):
+        """
+        Apply the committed records of f found from start on to index and
+        refs.  Return the end of the last commit record.
+        """
+        f.seek(start)
+        end = start
+        pending = []
+        for record in _read_records(f):
+            if record[0] != "commit":
+                pending.append(record)
+                continue
+            for op, key, key_refs, offset, size, md5sum, _ in pending:
+                if op == "set":
+                    index[key] = (offset, size, md5sum)
+                    refs[key] = key_refs
+                else:
+                    index.pop(key, None)
+                    refs.pop(key, None)
+            pending = []
+            end = record[-1]
+        return end
+
+
+    def _lock(self):
+        _save_lock.acquire()
+        try:
+            lock_file = open(self.filename + ".lock", "w")
+            fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        except Exception:
+            _save_lock.release()
+            raise
+        return lock_file
+
+
+    def _unlock(self, lock_file):
+        try:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+        finally:
+            _save_lock.release()
+
+
+    def _refresh(self):
+        """
+        Read the records committed by other stores since this one last read
+        or wrote the journal (all of them if the journal was rewritten).
+        Entries changed by other stores are reloaded on their next access,
+        unless they are dirty.  Must be called with the journal locked.
+        """
+        try:
+            f = open(self.filename, "rb")
+        except IOError:
+            return
+        if self._journal and _same_file(f, self._journal):
+            f.close()
+            f = self._journal
+            if os.fstat(f.fileno()).st_size == self._end:
+                return
+            index = dict(self._index)
+            refs = dict(self._refs)
+            end = self._replay(f, self._end, index, refs)
+        else:
+            index = {}
+            refs = {}
+            if f.readline() == ENV_JOURNAL_MAGIC:
+                end = self._replay(f, f.tell(), index, refs)
+            else:
+                # Not a journal, it will be rewritten
+                end = 0
+                self._rewrite = True
+        for key in set(self._index) | set(index):
+            if (self._index.get(key, (None, None, None))[2] ==
+                    index.get(key, (None, None, None))[2]):
+                continue
+            if key not in self._dirty and key not in self._deleted:
+                self._values.pop(key, None)
+        self._deleted.intersection_update(index)
+        # Dirty entries will be pickled again by this store
+        for key in self._dirty:
+            if key in self._refs:
+                refs[key] = self._refs[key]
+        self._index = index
+        self._refs = refs
+        self._set_journal(f)
+        self._end = end
+        self._live_size = sum([size for _, size, _ in self._index.values()])
+
+
+    def _set_journal(self, f):
+        if self._journal and self._journal is not f:
+            self._journal.close()
+        self._journal = f
+
+
+    def _read_data(self, key):
+        """
+        Return the pickle of a persisted entry.
+
+        @raise ValueError: If it doesn't match its md5sum.
+        """
+        offset, size, md5sum = self._index[key]
+        self._journal.seek(offset)
+        data = self._journal.read(size)
+        if _md5(data) != md5sum:
+            raise ValueError("Env entry %s doesn't match its md5sum" % key)
+        return data
+
+
+    def _load(self, key):
+        """
+        Unpickle a persisted entry.  Must be called with the data lock held.
+
+        @raise KeyError: If the entry doesn't match its md5sum (it is kept,
+                and only dropped if the journal is rewritten) or can't be
+                unpickled (it is dropped with a warning).
+        """
+        if key in self._loading:
+            raise ValueError("Circular reference loading env entry %s" % key)
+        try:
+            data = self._read_data(key)
+        except ValueError, e:
+            logging.warn("Failed to load env entry %s: %s", key, e)
+            raise KeyError(key)
+        self._loading.add(key)
+        try:
+            unpickler = cPickle.Unpickler(StringIO.StringIO(data))
+            unpickler.persistent_load = self._get
+            value = unpickler.load()
+        except Exception, e:
+            logging.warn("Dropping env entry %s that failed to load: %s",
+                         key, e)
+            self._drop(key)
+            raise KeyError(key)
+        finally:
+            self._loading.discard(key)
+        self._values[key] = value
+        return value
+
+
+    def _is_persisted(self, key):
+        return key in self._index and key not in self._deleted
+
+
+    def _drop(self, key):
+        if key in self._index:
+            self._deleted.add(key)
+        self._values.pop(key, None)
+        self._dirty.discard(key)
+
+
+    def _detach(self, key):
+        """
+        Load the persisted entries referencing key before it is replaced or
+        deleted, so that they keep the object they referenced (and pickle
+        it themselves from now on).
+        """
+        for other, refs in self._refs.items():
+            if (key in refs and other != key and self._is_persisted(other)):
+                try:
+                    self._get(other)
+                except KeyError:
+                    continue
+                self._dirty.add(other)
+
+
+    def _get(self, key):
+        # Get an entry without making it dirty
+        self._data_lock.acquire()
+        try:
+            if key in self._values:
+                return self._values[key]
+            if self._is_persisted(key):
+                return self._load(key)
+            raise KeyError(key)
+        finally:
+            self._data_lock.release()
+
+
+    def __getitem__(self, key):
+        self._data_lock.acquire()
+        try:
+            value = self._get(key)
+            # The caller may change it
+            self._dirty.add(key)
+            return value
+        finally:
+            self._data_lock.release()
+
+
+    def __setitem__(self, key, value):
+        self._data_lock.acquire()
+        try:
+            if self._values.get(key, self) is value:
+                self._dirty.add(key)
+                return
+            self._detach(key)
+            self._values[key] = value
+            self._dirty.add(key)
+            self._deleted.discard(key)
+        finally:
+            self._data_lock.release()
+
+
+    def __delitem__(self, key):
+        self._data_lock.acquire()
+        try:
+            if key not in self:
+                raise KeyError(key)
+            self._detach(key)
+            self._drop(key)
+        finally:
+            self._data_lock.release()
+
+
+    def __contains__(self, key):
+        return key in self._values or self._is_persisted(key)
+
+
+    has_key = __contains__
+
+
+    def keys(self):
+        self._data_lock.acquire()
+        try:
+            keys = set(self._values)
+            keys.update([key for key in self._index
+                         if key not in self._deleted])
+            return list(keys)
+        finally:
+            self._data_lock.release()
+
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def clear(self):
+        """
+        Remove all entries.  The journal is rewritten on the next save.
+        """
+        self._data_lock.acquire()
+        try:
+            self._index = {}
+            self._refs = {}
+            self._values = {}
+            self._dirty = set()
+            self._deleted = set()
+            self._rewrite = True
+        finally:
+            self._data_lock.release()
+
+
+    def _reaches(self, key, target):
+        """
+        Return True if entry key references target, directly or not.
+        """
+        seen = set()
+        todo = [key]
+        while todo:
+            current = todo.pop()
+            if current == target:
+                return True
+            if current not in seen:
+                seen.add(current)
+                todo.extend(self._refs.get(current, ()))
+        return False
+
+
+    def _pickle(self, key, value, shared):
+        """
+        Pickle an entry, referencing the values of other entries found in
+        it unless that would make a reference cycle.
+
+        @param shared: dict mapping id() of entry values to their keys.
+        @return: Tuple (set of referenced keys, pickle).
+        """
+        refs = set()
+
+        def persistent_id(obj):
+            ref = shared.get(id(obj))
+            if (ref is None or ref == key or obj is value or
+                    self._values.get(ref) is not obj):
+                return None
+            if ref not in refs and self._reaches(ref, key):
+                return None
+            refs.add(ref)
+            return ref
+
+        output = StringIO.StringIO()
+        pickler = cPickle.Pickler(output, 2)
+        pickler.persistent_id = persistent_id
+        pickler.dump(value)
+        return refs, output.getvalue()
+
+
+    def _pickle_values(self, keys):
+        """
+        Pickle loaded entries, return a dict mapping their keys to
+        (refs, pickle) tuples.
+
+        @param keys: Keys of the entries to pickle.
+        """
+        shared = dict([(id(value), key) for key, value in self._values.items()
+                       if not isinstance(value, _UNSHARED_TYPES)])
+        pickles = {}
+        for key in keys:
+            refs, data = self._pickle(key, self._values[key], shared)
+            self._refs[key] = refs
+            pickles[key] = (refs, data)
+        return pickles
+
+
+    def _write_journal(self, filename, pickles):
+        """
+        Write all entries to a new journal, atomically replacing filename.
+        Persisted entries that can't be read are dropped with a warning.
+
+        @return: dict mapping keys to (data offset, data size, data md5sum).
+        """
+        index = {}
+        tmp_filename = filename + ".tmp"
+        f = open(tmp_filename, "wb")
+        try:
+            f.write(ENV_JOURNAL_MAGIC)
+            for key in self.keys():
+                if key in pickles:
+                    refs, data = pickles[key]
+                else:
+                    try:
+                        refs, data = self._refs[key], self._read_data(key)
+                    except ValueError, e:
+                        logging.warn("Dropping env entry %s: %s", key, e)
+                        continue
+                record = _format_record("set", key, refs, data)
+                f.write(record)
+                index[key] = (f.tell() - len(data), len(data), _md5(data))
+            f.write(_format_record("commit", None))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp_filename, filename)
+        return index
+
+
+    def save(self, filename=None):
+        """
+        Write the entries to the journal, see the class documentation.
+
+        @param filename: Write a full copy of the entries to this file
+                instead, without changing the journal this store uses.
+        """
+        self._data_lock.acquire()
+        try:
+            if filename and filename != self.filename:
+                pickles = self._pickle_values([key for key in self._dirty
+                                               if key in self._values])
+                self._write_journal(filename, pickles)
+                return
+            lock_file = self._lock()
+            try:
+                self._refresh()
+                self._save()
+            finally:
+                self._unlock(lock_file)
+        finally:
+            self._data_lock.release()
+
+
+    def _save(self):
+        pickles = self._pickle_values([key for key in self._dirty
+                                       if key in self._values])
+        if (self._rewrite or not os.path.isfile(self.filename) or
+            (self._end > self.COMPACT_MIN_SIZE and
+             self._end > self._live_size * self.COMPACT_RATIO)):
+            self._index = self._write_journal(self.filename, pickles)
+            for key in self._deleted:
+                self._refs.pop(key, None)
+            self._deleted = set()
+            self._dirty = set()
+            self._live_size = sum([size for _, size, _ in
+                                   self._index.values()])
+            self._set_journal(open(self.filename, "rb"))
+            self._end = os.fstat(self._journal.fileno()).st_size
+            self._rewrite = False
+            return
+
+        records = []
+        for key, (refs, data) in pickles.items():
+            if self._index.get(key, (None, None, None))[2] != _md5(data):
+                records.append((key, refs, data))
+        self._dirty = set()
+        if not records and not self._deleted:
+            return
+        f = open(self.filename, "r+b")
+        try:
+            # Drop whatever follows the last commit (e.g. records cut short
+            # by a crash)
+            f.seek(self._end)
+            f.truncate()
+            index = {}
+            for key, refs, data in records:
+                f.write(_format_record("set", key, refs, data))
+                index[key] = (f.tell() - len(data), len(data), _md5(data))
+            for key in self._deleted:
+                f.write(_format_record("del", key))
+            f.write(_format_record("commit", None))
+            f.flush()
+            os.fsync(f.fileno())
+            self._end = f.tell()
+        finally:
+            f.close()
+        for key in self._deleted:
+            self._index.pop(key, None)
+            self._refs.pop(key, None)
+        self._deleted = set()
+        self._index.update(index)
+        self._live_size = sum([size for _, size, _ in self._index.values()])
+
+
 class Env(UserDict.IterableUserDict):
     """
     A dict-like object containing global objects used by tests.
@@ -20,65 +591,66 @@ class Env(UserDict.IterableUserDict):
         Create an empty Env object or load an existing one from a file.
 
         If the version recorded in the file is lower than version, or if some
-        error occurs during unpickling, or if filename is not supplied,
-        create an empty Env object.
+        error occurs during loading, or if filename is not supplied,
+        create an empty Env object.  Entries are only unpickled when
+        accessed, see EnvStore.
 
         @param filename: Path to an env file.
         @param version: Required env version (int).
         """
         UserDict.IterableUserDict.__init__(self)
-        empty = {"version": version}
         self._filename = filename
+        self.data = EnvStore()
         if filename:
             try:
                 if os.path.isfile(filename):
-                    f = open(filename, "r")
-                    env = cPickle.load(f)
-                    f.close()
+                    env = EnvStore(filename)
                     if env.get("version", 0) >= version:
                         self.data = env
                     else:
                         logging.warn("Incompatible env file found. Not using it.")
-                        self.data = empty
                 else:
                     # No previous env file found, proceed...
                     logging.warn("Creating new, empty env file")
-                    self.data = empty
             # Almost any exception can be raised during unpickling, so let's
             # catch them all
             except Exception, e:
                 logging.warn("Exception thrown while loading env")
                 logging.warn(e)
                 logging.warn("Creating new, empty env file")
-                self.data = empty
         else:
             logging.warn("Creating new, empty env file")
-            self.data = empty
+        if self.data.filename is None:
+            self.data.filename = filename
+            self.data["version"] = version
 
 
     def save(self, filename=None):
         """
-        Pickle the contents of the Env object into a file.
+        Save the contents of the Env object into a file.
 
-        @param filename: Filename to pickle the dict into.  If not supplied,
-                use the filename from which the dict was loaded.
+        @param filename: Filename to save the env into.  If not supplied,
+                use the filename from which the env was loaded, and only
+                write the entries that changed.
         """
         filename = filename or self._filename
         if filename is None:
             raise EnvSaveError("No filename specified for this env file")
-        f = open(filename, "w")
-        cPickle.dump(self.data, f)
-        f.close()
+        self.data.save(filename)
 
 
     def get_all_vms(self):
         """
-        Return a list of all VM objects in this Env object.
+        Return a list of all VM objects in this Env object.  VMs that fail
+        to load are left out.
         """
         vm_list = []
         for key in self.data.keys():
             if key.startswith("vm__"):
-                vm_list.append(self[key])
+                try:
+                    vm_list.append(self[key])
+                except KeyError:
+                    continue
         return vm_list
 
 
@@ -94,7 +666,7 @@ class Env(UserDict.IterableUserDict):
                     self.data[key].close()
             except Exception:
                 pass
-        self.data = {}
+        self.data.clear()
 
 
     def destroy(self):
@@ -103,8 +675,10 @@ class Env(UserDict.IterableUserDict):
         """
         self.clean_objects()
         if self._filename is not None:
-            if os.path.isfile(self._filename):
-                os.unlink(self._filename)
+            for filename in (self._filename, self._filename + ".tmp",
+                             self._filename + ".lock"):
+                if os.path.isfile(filename):
+                    os.unlink(filename)
 
 
     def get_vm(self, name):
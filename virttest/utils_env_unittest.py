@@ -1,5 +1,5 @@
 #!/usr/bin/python
-import unittest, time, logging, os
+import unittest, time, logging, os, threading
 import utils_env, utils_params, utils_misc
 
 
@@ -32,6 +32,14 @@ class FakeSyncListenServer(object):
         logging.info("Closing sync server (instance %s)", self.instance)
 
 
+class PickleCounter(object):
+    count = 0
+
+    def __getstate__(self):
+        PickleCounter.count += 1
+        return {}
+
+
 class TestEnv(unittest.TestCase):
     def test_save(self):
         """
@@ -74,6 +82,195 @@ class TestEnv(unittest.TestCase):
         if os.path.isfile(fname):
             os.unlink(fname)
 
+    def test_incremental_save(self):
+        """
+        1) Register 2 VMs sharing the address cache entry and save env.
+        2) Recover env from the file, verify that entries are only loaded
+           when accessed and that the address cache is still shared.
+        3) Change the address cache and save env, verify that the VM not
+           accessed was not written again, and that saving an unchanged env
+           writes nothing.
+        """
+        fname = "/dev/shm/EnvUnittest"
+        if os.path.isfile(fname):
+            os.unlink(fname)
+        env = utils_env.Env(filename=fname)
+        env["address_cache"] = {}
+        params = utils_params.Params({"main_vm": 'rhel7-migration'})
+        for name in ("vm1", "vm2"):
+            vm = FakeVm(name, params)
+            vm.address_cache = env["address_cache"]
+            env.register_vm(name, vm)
+        env.save()
+        size = os.path.getsize(fname)
+
+        env2 = utils_env.Env(filename=fname)
+        self.assertEqual(env2.data._values.keys(), ["version"])
+        vm1 = env2.get_vm("vm1")
+        self.assertTrue(vm1.address_cache is env2["address_cache"])
+        vm1.address_cache["00:11:22:33:44:55"] = "10.0.0.2"
+        env2.save()
+        self.assertTrue("vm__vm2" not in open(fname).read()[size:])
+        size = os.path.getsize(fname)
+        env2.save()
+        self.assertEqual(os.path.getsize(fname), size)
+
+        env3 = utils_env.Env(filename=fname)
+        vm2 = env3.get_vm("vm2")
+        self.assertTrue(vm2.address_cache is env3.get_vm("vm1").address_cache)
+        self.assertEqual(vm2.address_cache,
+                         {"00:11:22:33:44:55": "10.0.0.2"})
+        env3.destroy()
+        self.assertFalse(os.path.exists(fname))
+
+    def test_interrupted_save(self):
+        """
+        1) Register a VM and save env.
+        2) Register another VM, save env and cut the end of the file off, as
+           a crash during the save would.
+        3) Recover env from the file, verify that it has the first VM only.
+        """
+        fname = "/dev/shm/EnvUnittest"
+        if os.path.isfile(fname):
+            os.unlink(fname)
+        env = utils_env.Env(filename=fname)
+        params = utils_params.Params({"main_vm": 'rhel7-migration'})
+        env.register_vm("vm1", FakeVm("vm1", params))
+        env.save()
+        env.register_vm("vm2", FakeVm("vm2", params))
+        env.save()
+        f = open(fname, "r+")
+        f.truncate(os.path.getsize(fname) - 10)
+        f.close()
+        env2 = utils_env.Env(filename=fname)
+        self.assertEqual(env2.get_vm("vm1").instance,
+                         env.get_vm("vm1").instance)
+        self.assertEqual(env2.get_vm("vm2"), None)
+        env2.destroy()
+
+    def test_corrupted_entry(self):
+        """
+        1) Register 2 VMs and save env.
+        2) Recover env from the file, then corrupt the second VM's entry.
+        3) Verify that the first VM loads and the second one doesn't, but
+           that it isn't deleted from the file on save.
+        """
+        fname = "/dev/shm/EnvUnittest"
+        if os.path.isfile(fname):
+            os.unlink(fname)
+        env = utils_env.Env(filename=fname)
+        params = utils_params.Params({"main_vm": 'rhel7-migration'})
+        env.register_vm("vm1", FakeVm("vm1", params))
+        env.register_vm("vm2", FakeVm("vm2", params))
+        env.save()
+        env2 = utils_env.Env(filename=fname)
+        offset, size, md5sum = env2.data._index["vm__vm2"]
+        f = open(fname, "r+")
+        f.seek(offset + size / 2)
+        f.write("\0")
+        f.close()
+        self.assertEqual(env2.get_vm("vm1").instance,
+                         env.get_vm("vm1").instance)
+        self.assertEqual(env2.get_vm("vm2"), None)
+        env2.save()
+        self.assertTrue("vm__vm2" in env2)
+        env2.destroy()
+
+    def test_threaded_load(self):
+        """
+        1) Register VMs and save env, then recover it from the file.
+        2) Get the VMs from several threads at once, verify that all of them
+           load.
+        """
+        fname = "/dev/shm/EnvUnittest"
+        if os.path.isfile(fname):
+            os.unlink(fname)
+        env = utils_env.Env(filename=fname)
+        params = utils_params.Params({"main_vm": 'rhel7-migration'})
+        names = ["vm%d" % i for i in range(40)]
+        for name in names:
+            env.register_vm(name, FakeVm(name, params))
+        env.save()
+        env2 = utils_env.Env(filename=fname)
+        vms = {}
+
+        def get_vm(name):
+            vms[name] = env2.get_vm(name)
+
+        threads = [threading.Thread(target=get_vm, args=(name,))
+                   for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for name in names:
+            self.assertEqual(vms[name].instance, env.get_vm(name).instance)
+        env2.destroy()
+
+    def test_concurrent_save(self):
+        """
+        1) Register a VM, save env and recover it from the file twice.
+        2) Register a different VM in each copy and save them, verify that
+           both VMs are in the file.
+        3) Rewrite the file from one copy, then save a change to the other
+           copy, verify that it still loads entries and that both copies'
+           changes are in the file.
+        """
+        fname = "/dev/shm/EnvUnittest"
+        if os.path.isfile(fname):
+            os.unlink(fname)
+        env = utils_env.Env(filename=fname)
+        params = utils_params.Params({"main_vm": 'rhel7-migration'})
+        env.register_vm("vm1", FakeVm("vm1", params))
+        env.save()
+        env2 = utils_env.Env(filename=fname)
+        env3 = utils_env.Env(filename=fname)
+        env2.register_vm("vm2", FakeVm("vm2", params))
+        env2.save()
+        env3.register_vm("vm3", FakeVm("vm3", params))
+        env3.save()
+        env4 = utils_env.Env(filename=fname)
+        self.assertEqual(sorted(vm.name for vm in env4.get_all_vms()),
+                         ["vm1", "vm2", "vm3"])
+
+        env2.unregister_vm("vm1")
+        env2.data._rewrite = True
+        env2.save()
+        env3.get_vm("vm2").params = utils_params.Params({"mem": "1024"})
+        env3.save()
+        self.assertEqual(env3.get_vm("vm1"), None)
+        env5 = utils_env.Env(filename=fname)
+        self.assertEqual(sorted(vm.name for vm in env5.get_all_vms()),
+                         ["vm2", "vm3"])
+        self.assertEqual(env5.get_vm("vm2").params, {"mem": "1024"})
+        # env4 loaded the journal before it was rewritten
+        self.assertEqual(env4.get_vm("vm1").name, "vm1")
+        env5.destroy()
+
+    def test_dirty_entries(self):
+        """
+        1) Store an object counting how many times it is pickled, and save
+           env.
+        2) Save env again, verify that the object is not pickled again.
+        3) Access the object and save env, verify that it is pickled again,
+           but that the file doesn't change.
+        """
+        fname = "/dev/shm/EnvUnittest"
+        if os.path.isfile(fname):
+            os.unlink(fname)
+        env = utils_env.Env(filename=fname)
+        env["counter"] = PickleCounter()
+        env.save()
+        self.assertEqual(PickleCounter.count, 1)
+        env.save()
+        self.assertEqual(PickleCounter.count, 1)
+        size = os.path.getsize(fname)
+        env["counter"]
+        env.save()
+        self.assertEqual(PickleCounter.count, 2)
+        self.assertEqual(os.path.getsize(fname), size)
+        env.destroy()
+
     def test_register_vm(self):
         """
         1) Create an env object.
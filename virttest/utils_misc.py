@@ -5,11 +5,11 @@ Virtualization test utility functions.
 """
 
 import time, string, random, socket, os, signal, re, logging, commands
-import fcntl, sys, inspect, tarfile, shutil
+import fcntl, sys, inspect, tarfile, shutil, hashlib, json
 from autotest.client import utils, os_dep
 from autotest.client.shared import error, logging_config
 from autotest.client.shared import git
-import utils_koji
+import utils_koji, utils_plan
 
 
 def lock_file(filename, mode=fcntl.LOCK_EX):
@@ -355,6 +355,176 @@ def get_hash_from_file(hash_path, dvd_basename):
             return line.split()[0]
 
 
+def hash_file_digests(filename, digests, chunk_size=1024 * 1024):
+    """
+    Compute several digests of a file, reading it only once.
+
+    @param filename: Path of the file.
+    @param digests: List of (method, size) tuples, method being a hashlib
+            algorithm name (e.g. "md5" or "sha1") and size the number of
+            bytes to hash from the start of the file (None for all of them).
+    @return: Dict mapping each (method, size) tuple to its hex digest.
+    """
+    hashes = dict([(digest, hashlib.new(digest[0])) for digest in digests])
+    sizes = [size for _, size in digests]
+    if None in sizes:
+        limit = None
+    else:
+        limit = max(sizes)
+    offset = 0
+    input_file = open(filename, "rb")
+    try:
+        while limit is None or offset < limit:
+            data = input_file.read(chunk_size)
+            if not data:
+                break
+            for (_, size), hash_obj in hashes.items():
+                if size is None:
+                    hash_obj.update(data)
+                elif offset < size:
+                    hash_obj.update(data[:size - offset])
+            offset += len(data)
+    finally:
+        input_file.close()
+    return dict([(digest, hash_obj.hexdigest())
+                 for digest, hash_obj in hashes.items()])
+
+
+class FileDigestCache(object):
+    """
+    Persistent cache of file digests, shared by all processes using the same
+    cache file.
+
+    Entries are keyed by the real path of the file, and only used as long as
+    the inode, size and mtime of the file did not change.
+    """
+
+    def __init__(self, filename):
+        """
+        @param filename: Path of the cache file.
+        """
+        self.filename = filename
+
+
+    @staticmethod
+    def _get_signature(path):
+        info = os.stat(path)
+        return [info.st_ino, info.st_size, info.st_mtime]
+
+
+    @staticmethod
+    def _get_key(digest):
+        method, size = digest
+        if size is None:
+            return method
+        return "%s:%d" % digest
+
+
+    def _load(self):
+        try:
+            cache_file = open(self.filename)
+            try:
+                return json.load(cache_file)
+            finally:
+                cache_file.close()
+        except (IOError, ValueError):
+            return {}
+
+
+    def _store(self, path, signature, digests):
+        """
+        Add digests to the entry of path, if it is still for signature.
+        """
+        try:
+            lock = lock_file(self.filename + ".lock")
+        except IOError, e:
+            logging.warning("Could not update file digest cache %s: %s",
+                            self.filename, e)
+            return
+        try:
+            entries = self._load()
+            entry = entries.get(path)
+            if entry is None or entry["signature"] != signature:
+                entry = {"signature": signature, "digests": {}}
+                entries[path] = entry
+            entry["digests"].update(digests)
+            # Forget the files that are gone
+            for other_path in entries.keys():
+                if not os.path.exists(other_path):
+                    del entries[other_path]
+            tmp_filename = self.filename + ".tmp"
+            cache_file = open(tmp_filename, "w")
+            try:
+                json.dump(entries, cache_file)
+            finally:
+                cache_file.close()
+            os.rename(tmp_filename, self.filename)
+        finally:
+            unlock_file(lock)
+
+
+    def get_digests(self, path, digests):
+        """
+        Return digests of a file, computing the ones not in the cache in a
+        single pass over the file.
+
+        @param path: Path of the file.
+        @param digests: List of (method, size) tuples, see
+                hash_file_digests().
+        @return: Dict mapping each (method, size) tuple to its hex digest.
+        """
+        path = os.path.realpath(path)
+        signature = self._get_signature(path)
+        cached = {}
+        entry = self._load().get(path)
+        if entry is not None and entry["signature"] == signature:
+            cached = entry["digests"]
+        result = {}
+        missing = []
+        for digest in digests:
+            key = self._get_key(digest)
+            if key in cached:
+                result[digest] = str(cached[key])
+            else:
+                missing.append(digest)
+        if missing:
+            computed = hash_file_digests(path, missing)
+            result.update(computed)
+            # Do not cache digests of a file modified while reading it
+            if self._get_signature(path) == signature:
+                self._store(path, signature,
+                            dict([(self._get_key(digest), value)
+                                  for digest, value in computed.items()]))
+        return result
+
+
+    def get_digest(self, path, method="md5", size=None):
+        """
+        Return a digest of a file, see get_digests().
+
+        @param path: Path of the file.
+        @param method: hashlib algorithm name.
+        @param size: Number of bytes to hash from the start of the file, None
+                for all of them.
+        """
+        return self.get_digests(path, [(method, size)])[(method, size)]
+
+
+    def record_digests(self, path, digests):
+        """
+        Record digests of a file computed elsewhere (e.g. while writing it).
+
+        @param path: Path of the file.
+        @param digests: Dict mapping (method, size) tuples, see
+                hash_file_digests(), to hex digests of the current contents
+                of the file.
+        """
+        path = os.path.realpath(path)
+        self._store(path, self._get_signature(path),
+                    dict([(self._get_key(digest), value)
+                          for digest, value in digests.items()]))
+
+
 def run_tests(parser, job):
     """
     Runs the sequence of KVM tests based on the list of dictionaries
@@ -365,12 +535,11 @@ def run_tests(parser, job):
 
     @return: True, if all tests ran passed, False if any of them failed.
     """
-    last_index = -1
-    for i, d in enumerate(parser.get_dicts()):
-        logging.info("Test %4d:  %s" % (i + 1, d["shortname"]))
-        last_index += 1
+    plan = utils_plan.get_test_plan(parser)
+    for entry in plan:
+        logging.info("Test %4d:  %s" % (entry.index + 1, entry.shortname))
+    last_index = len(plan) - 1
 
-    status_dict = {}
     failed = False
     # Add the parameter decide if setup host env in the test case
     # For some special tests we only setup host in the first and last case
@@ -382,7 +551,8 @@ def run_tests(parser, job):
     index = 0
     setup_flag = 1
     cleanup_flag = 2
-    for param_dict in parser.get_dicts():
+    for entry in plan:
+        param_dict = plan.get_params(entry)
         if index == 0:
             if param_dict.get("host_setup_flag", None) is not None:
                 flag = int(param_dict["host_setup_flag"])
@@ -402,21 +572,10 @@ def run_tests(parser, job):
 
         if param_dict.get("skip") == "yes":
             continue
-        dependencies_satisfied = True
-        for dep in param_dict.get("dep"):
-            for test_name in status_dict.keys():
-                if not dep in test_name:
-                    continue
-                # So the only really non-fatal state is WARN,
-                # All the others make it not safe to proceed with dependency
-                # execution
-                if status_dict[test_name] not in ['GOOD', 'WARN']:
-                    dependencies_satisfied = False
-                    break
         test_iterations = int(param_dict.get("iterations", 1))
         test_tag = param_dict.get("vm_type") + "." + param_dict.get("shortname")
 
-        if dependencies_satisfied:
+        if not plan.dependencies_failed(entry):
             # Setting up profilers during test execution.
             profilers = param_dict.get("profilers", "").split()
             for profiler in profilers:
@@ -443,7 +602,10 @@ def run_tests(parser, job):
 
         if not current_status:
             failed = True
-        status_dict[param_dict.get("name")] = current_status
+        # So the only really non-fatal state is WARN,
+        # All the others make it not safe to proceed with dependency
+        # execution
+        plan.record_result(entry, current_status in ['GOOD', 'WARN'])
 
     return not failed
 
@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-import unittest
+import unittest, os, tempfile, shutil, time
 import common
 from autotest.client import utils
 from autotest.client.shared.test_utils import mock
@@ -201,5 +201,52 @@ class TestNumaNode(unittest.TestCase):
         self.god.unstub_all()
 
 
+class TestFileDigestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "image.iso")
+        self.write("x" * (3 * 1024 * 1024 + 10))
+        self.cache = utils_misc.FileDigestCache(os.path.join(self.tmpdir,
+                                                             "digests"))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def write(self, data):
+        image = open(self.path, "w")
+        image.write(data)
+        image.close()
+
+
+    def test_digests(self):
+        digests = [("md5", 1024 * 1024), ("sha1", None), ("md5", None)]
+        result = self.cache.get_digests(self.path, digests)
+        for method, size in digests:
+            self.assertEqual(result[(method, size)],
+                             utils.hash_file(self.path, size, method=method))
+
+
+    def test_cached(self):
+        md5 = self.cache.get_digest(self.path, "md5")
+        self.hashed = []
+        def hash_file_digests(filename, digests):
+            self.hashed.extend(digests)
+            return dict([(digest, "changed") for digest in digests])
+        god = mock.mock_god()
+        god.stub_with(utils_misc, "hash_file_digests", hash_file_digests)
+        try:
+            cache = utils_misc.FileDigestCache(self.cache.filename)
+            self.assertEqual(cache.get_digest(self.path, "md5"), md5)
+            self.assertEqual(self.hashed, [])
+            self.write("y")
+            os.utime(self.path, (time.time(), time.time() + 10))
+            self.assertEqual(cache.get_digest(self.path, "md5"), "changed")
+            self.assertEqual(self.hashed, [("md5", None)])
+        finally:
+            god.unstub_all()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,5 @@
 import platform, openvswitch, re, os, socket, fcntl, struct, logging, random
-import shelve, commands
+import shelve, commands, threading
 from autotest.client import utils
 from autotest.client.shared import error
 import propcan, utils_misc
@@ -41,6 +41,12 @@ else:
     # From linux/include/linux/if.h
     IFF_UP = 0x1
 
+
+# The address database lock file (see VirtNet.lock_db()) only excludes other
+# processes, this lock excludes other threads of this process
+_db_lock = threading.RLock()
+
+
 class NetError(Exception):
     pass
 
@@ -1147,12 +1153,128 @@ class ParamsNet(VMNet):
         nic.ip = new_ip
 
 
+class AddressPool(object):
+    """
+    Index of the MAC addresses allocated in a VirtNet database.
+
+    The index is kept in the (locked) database itself, split in at most 256
+    buckets by the last octet of the addresses: each bucket entry (KEY_PREFIX
+    followed by the octet) maps the allocated addresses ending with that
+    octet to the database keys using them.  Allocating or checking an
+    address only reads and writes its bucket, and the index adds few keys to
+    the database, which some dbm modules read in full when opened.  The KEY
+    entry marks databases whose index was built.
+    """
+
+    KEY = "__address_pool__"
+    KEY_PREFIX = "__macs__"
+
+    def __init__(self, db, entries=None):
+        """
+        Use the index of db, building it from entries if db has none.
+
+        @param: db: Open shelve database, must be locked by the caller
+        @param: entries: Callable returning an iterator over the
+                         (db_key, list of nic dicts) entries of db
+        """
+        self.db = db
+        if self.KEY not in db:
+            if entries is not None:
+                for db_key, entry in entries():
+                    self.update(db_key, [], [nic.get('mac') for nic in entry])
+            db[self.KEY] = True
+
+
+    @classmethod
+    def is_index_key(cls, db_key):
+        """
+        Return True if db_key is a database key used by the index
+        """
+        return db_key == cls.KEY or db_key.startswith(cls.KEY_PREFIX)
+
+
+    def _bucket_key(self, mac):
+        return self.KEY_PREFIX + mac[-2:]
+
+
+    def _bucket(self, mac):
+        return self.db.get(self._bucket_key(mac), {})
+
+
+    def _set_owners(self, mac, owners):
+        bucket = self._bucket(mac)
+        if owners:
+            bucket[mac] = owners
+        else:
+            bucket.pop(mac, None)
+        if bucket:
+            self.db[self._bucket_key(mac)] = bucket
+        elif self._bucket_key(mac) in self.db:
+            del self.db[self._bucket_key(mac)]
+
+
+    def __contains__(self, mac):
+        return mac.lower() in self._bucket(mac.lower())
+
+
+    def __iter__(self):
+        for db_key in self.db.keys():
+            if db_key.startswith(self.KEY_PREFIX):
+                for mac in self.db[db_key]:
+                    yield mac
+
+
+    def owners(self, mac):
+        """
+        Return the list of database keys using mac
+        """
+        mac = mac.lower()
+        return list(self._bucket(mac).get(mac, []))
+
+
+    def allocate(self, mac, db_key):
+        """
+        Mark mac as used by db_key unless it is already allocated.
+
+        @param: mac: MAC address string
+        @param: db_key: database key of the VM using mac
+        @return: True if mac was allocated to db_key
+        """
+        mac = mac.lower()
+        if mac in self:
+            return False
+        self._set_owners(mac, [db_key])
+        return True
+
+
+    def update(self, db_key, old_macs, new_macs):
+        """
+        Replace old_macs with new_macs as the addresses used by db_key,
+        addresses left without users are free again.
+
+        Unlike allocate(), addresses already used elsewhere are shared, as
+        statically configured addresses may be.
+        """
+        old_macs = set([mac.lower() for mac in old_macs if mac])
+        new_macs = set([mac.lower() for mac in new_macs if mac])
+        for mac in old_macs - new_macs:
+            self._set_owners(mac, [owner for owner in self.owners(mac)
+                                   if owner != db_key])
+        for mac in new_macs:
+            owners = self.owners(mac)
+            if db_key not in owners:
+                self._set_owners(mac, owners + [db_key])
+
+
 class DbNet(VMNet):
     """
     Networking information from database
 
         Database specification-
-            database values are python string-formatted lists of dictionaries
+            database values are lists of dictionaries, one per nic.  The
+            AddressPool keys index the MAC addresses in use.
+            Python string-formatted lists from older databases are still
+            accepted.
     """
 
     # __init__ must not presume clean state, it should behave
@@ -1189,9 +1311,14 @@ class DbNet(VMNet):
 
     def lock_db(self):
         if not hasattr(self, 'lock'):
-            self.lock = utils_misc.lock_file(self.db_lockfile)
+            _db_lock.acquire()
+            try:
+                self.lock = utils_misc.lock_file(self.db_lockfile)
+            except Exception:
+                _db_lock.release()
+                raise
             if not hasattr(self, 'db'):
-                self.db = shelve.open(self.db_filename)
+                self.db = shelve.open(self.db_filename, protocol=2)
             else:
                 raise DbNoLockError
         else:
@@ -1205,6 +1332,7 @@ class DbNet(VMNet):
             if hasattr(self, 'lock'):
                 utils_misc.unlock_file(self.lock)
                 del self.lock
+                _db_lock.release()
             else:
                 raise DbNoLockError
         else:
@@ -1213,7 +1341,7 @@ class DbNet(VMNet):
 
     def db_entry(self, db_key=None):
         """
-        Returns a python list of dictionaries from locked DB string-format entry
+        Returns a python list of dictionaries from locked DB entry
         """
         if not db_key:
             db_key = self.db_key
@@ -1221,18 +1349,19 @@ class DbNet(VMNet):
             db_entry = self.db[db_key]
         except AttributeError: # self.db doesn't exist:
             raise DbNoLockError
-        # Always wear protection
-        try:
-            eval_result = eval(db_entry, {}, {})
-        except SyntaxError:
-            raise ValueError("Error parsing entry for %s from "
-                             "database '%s'" % (self.db_key,
-                                                self.db_filename))
-        if not isinstance(eval_result, list):
+        if isinstance(db_entry, basestring):
+            # Entry from an older database, always wear protection
+            try:
+                db_entry = eval(db_entry, {}, {})
+            except SyntaxError:
+                raise ValueError("Error parsing entry for %s from "
+                                 "database '%s'" % (self.db_key,
+                                                    self.db_filename))
+        if not isinstance(db_entry, list):
             raise ValueError("Unexpected database data: %s" % (
-                                    str(eval_result)))
+                                    str(db_entry)))
         result = []
-        for result_dict in eval_result:
+        for result_dict in db_entry:
             if not isinstance(result_dict, dict):
                 raise ValueError("Unexpected database sub-entry data %s" % (
                                     str(result_dict)))
@@ -1240,19 +1369,51 @@ class DbNet(VMNet):
         return result
 
 
-    def save_to_db(self, db_key=None):
+    def db_entries(self):
+        """
+        Generator of (db_key, entry) for all VM entries in locked DB
+        """
+        try:
+            db_keys = self.db.keys()
+        except AttributeError:
+            raise DbNoLockError
+        for db_key in db_keys:
+            if not AddressPool.is_index_key(db_key):
+                yield db_key, self.db_entry(db_key)
+
+
+    def address_pool(self):
+        """
+        Return the AddressPool of the locked DB
+        """
+        try:
+            return AddressPool(self.db, self.db_entries)
+        except AttributeError:
+            raise DbNoLockError
+
+
+    def save_to_db(self, db_key=None, pool=None):
         """
-        Writes string representation out to database
+        Writes nic dictionaries out to database, updating the address pool
+
+        @param: pool: AddressPool of the locked DB, if already loaded
         """
         if db_key == None:
             db_key = self.db_key
-        data = str(self)
+        acceptable_types = (str, unicode, int, float, long)
+        data = [dict([(key, value) for key, value in nic.items()
+                      if issubclass(type(value), acceptable_types)])
+                for nic in self]
+        if pool is None:
+            pool = self.address_pool()
+        try:
+            old_macs = [nic.get('mac') for nic in self.db_entry(db_key)]
+        except KeyError:
+            old_macs = []
+        pool.update(db_key, old_macs, [nic.get('mac') for nic in data])
         # Avoid saving empty entries
-        if len(data) > 3:
-            try:
-                self.db[self.db_key] = data
-            except AttributeError:
-                raise DbNoLockError
+        if data:
+            self.db[db_key] = data
         else:
             try:
                 # make sure old db entry is removed
@@ -1263,22 +1424,16 @@ class DbNet(VMNet):
 
     def update_db(self):
         self.lock_db()
-        self.save_to_db()
-        self.unlock_db()
+        try:
+            self.save_to_db()
+        finally:
+            self.unlock_db()
 
 
     def mac_index(self):
         """Generator of mac addresses found in database"""
-        try:
-            for db_key in self.db.keys():
-                for nic in self.db_entry(db_key):
-                    mac = nic.get('mac')
-                    if mac:
-                        yield mac
-                    else:
-                        continue
-        except AttributeError:
-            raise DbNoLockError
+        for mac in self.address_pool():
+            yield mac
 
 
 class VirtNet(DbNet, ParamsNet):
@@ -1363,19 +1518,24 @@ class VirtNet(DbNet, ParamsNet):
         if nic.has_key('mac'):
             logging.warning("Overwriting mac %s for nic %s with random"
                                 % (nic.mac, str(nic_index_or_name)))
-        self.free_mac_address(nic_index_or_name)
-        attempts_remaining = attempts
-        while attempts_remaining > 0:
-            mac_attempt = nic.complete_mac_address(self.mac_prefix)
-            self.lock_db()
-            if mac_attempt not in self.mac_index():
-                nic.mac = mac_attempt.lower()
-                self.unlock_db()
-                self.update_db()
-                return self[nic_index_or_name].mac
-            else:
-                attempts_remaining -= 1
-                self.unlock_db()
+        static_macs = [mac.lower() for mac in ParamsNet.mac_index(self)]
+        self.lock_db()
+        try:
+            pool = self.address_pool()
+            # Same as free_mac_address(), without locking the DB again
+            if nic.has_key('mac'):
+                self.reset_mac(nic_index_or_name)
+            self.save_to_db(pool=pool)
+            for attempt in xrange(attempts):
+                mac_attempt = nic.complete_mac_address(self.mac_prefix).lower()
+                if mac_attempt in static_macs:
+                    continue
+                if pool.allocate(mac_attempt, self.db_key):
+                    nic.mac = mac_attempt
+                    self.save_to_db(pool=pool)
+                    return nic.mac
+        finally:
+            self.unlock_db()
         raise NetError("%s/%s MAC generation failed with prefix %s after %d "
                        "attempts for NIC %s on VM %s (%s)" % (
                             self.vm_type,
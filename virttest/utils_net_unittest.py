@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-import unittest, time, logging, sys, random, os, shelve
+import unittest, time, logging, sys, random, os, shelve, tempfile, shutil
 import common
 from autotest.client import utils
 from autotest.client.shared.test_utils import mock
@@ -532,10 +532,12 @@ class TestVmNetSubclasses(unittest.TestCase):
         # Verify on-disk data matches dummy data just written
         self.zero_counter()
         db = shelve.open(self.db_filename)
-        db_keys = db.keys()
+        db_keys = [key for key in db.keys()
+                   if not utils_net.AddressPool.is_index_key(key)]
         self.assertEqual(len(db_keys), self.db_item_count)
+        pool = utils_net.AddressPool(db)
         for key in db_keys:
-            db_value = eval(db[key], {}, {})
+            db_value = db[key]
             self.assert_(isinstance(db_value, list))
             self.assert_(len(db_value) > 0)
             self.assert_(isinstance(db_value[0], dict))
@@ -544,6 +546,7 @@ class TestVmNetSubclasses(unittest.TestCase):
                 if mac:
                     # Another test already checked mac_is_valid behavior
                     self.assert_(utils_net.VirtIface.mac_is_valid(mac))
+                    self.assert_(key in pool.owners(mac))
             self.print_and_inc()
         db.close()
 
@@ -700,5 +703,56 @@ class TestVmNetSubclasses(unittest.TestCase):
             pass
 
 
+class TestAddressPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db_filename = os.path.join(self.tmpdir, "address_pool")
+        self.db = shelve.open(self.db_filename)
+
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+
+    def test_allocate_free(self):
+        pool = utils_net.AddressPool(self.db)
+        self.assertTrue(pool.allocate("01:02:03:04:05:0A", "vm1"))
+        self.assertFalse(pool.allocate("01:02:03:04:05:0a", "vm2"))
+        self.assertFalse(pool.allocate("01:02:03:04:05:0a", "vm1"))
+        # Persisted in the database
+        pool = utils_net.AddressPool(self.db)
+        self.assertTrue("01:02:03:04:05:0a" in pool)
+        self.assertEqual(pool.owners("01:02:03:04:05:0a"), ["vm1"])
+        pool.update("vm1", ["01:02:03:04:05:0a"], [])
+        self.assertFalse("01:02:03:04:05:0a" in pool)
+        self.assertTrue(pool.allocate("01:02:03:04:05:0a", "vm2"))
+
+
+    def test_update_shared(self):
+        pool = utils_net.AddressPool(self.db)
+        pool.update("vm1", [], ["01:02:03:04:05:06", None])
+        pool.update("vm2", [], ["01:02:03:04:05:06"])
+        self.assertEqual(pool.owners("01:02:03:04:05:06"), ["vm1", "vm2"])
+        pool.update("vm1", ["01:02:03:04:05:06"], ["01:02:03:04:05:07"])
+        self.assertEqual(pool.owners("01:02:03:04:05:06"), ["vm2"])
+        self.assertEqual(sorted(pool), ["01:02:03:04:05:06",
+                                        "01:02:03:04:05:07"])
+
+
+    def test_legacy_entries(self):
+        self.db["vm1"] = str([{'nic_name': 'nic1',
+                               'mac': '01:02:03:04:05:06'}])
+        self.db["vm2"] = str([{'nic_name': 'nic1'}])
+        params = utils_params.Params({"nics": "nic1", "vms": "vm2"})
+        self.db.close()
+        virtnet = utils_net.VirtNet(params, "vm2", "vm2", self.db_filename)
+        self.db = shelve.open(self.db_filename)
+        pool = utils_net.AddressPool(self.db)
+        self.assertEqual(list(pool), ["01:02:03:04:05:06"])
+        self.assertEqual(self.db["vm2"], [{'nic_name': 'nic1'}])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,160 @@
 import UserDict
 
 
+class _Deleted(object):
+    """
+    Marks a key deleted from the base of a LayeredDict.
+    """
+    def __reduce__(self):
+        return "_deleted"
+
+    def __repr__(self):
+        return "<deleted>"
+
+_deleted = _Deleted()
+
+
+class LayeredDict(UserDict.DictMixin):
+    """
+    A dict made of a base dict, shared with other LayeredDicts and never
+    modified through them, and a dict of the local changes made on top of
+    it.  This is the type of the dicts generated by Parser.get_dicts(), the
+    leaves sharing most of their keys and values with their neighbours.
+    """
+    def __init__(self, base=None, local=None):
+        """
+        @param base: The shared base dict.
+        @param local: Dict of the keys set on top of base, deleted keys
+                being set to _deleted.
+        """
+        if base is None:
+            base = {}
+        if local is None:
+            local = {}
+        self.base = base
+        self.local = local
+
+
+    def __getitem__(self, key):
+        if key in self.local:
+            value = self.local[key]
+            if value is _deleted:
+                raise KeyError(key)
+            return value
+        return self.base[key]
+
+
+    def __setitem__(self, key, value):
+        self.local[key] = value
+
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.base:
+            self.local[key] = _deleted
+        else:
+            del self.local[key]
+
+
+    def __contains__(self, key):
+        if key in self.local:
+            return self.local[key] is not _deleted
+        return key in self.base
+
+
+    def has_key(self, key):
+        return key in self
+
+
+    def iteritems(self):
+        for key, value in self.base.iteritems():
+            if key not in self.local:
+                yield key, value
+        for key, value in self.local.iteritems():
+            if value is not _deleted:
+                yield key, value
+
+
+    def __iter__(self):
+        for key, _ in self.iteritems():
+            yield key
+
+
+    def keys(self):
+        return [key for key, _ in self.iteritems()]
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def copy(self):
+        return LayeredDict(self.base, self.local.copy())
+
+
 class Params(UserDict.IterableUserDict):
     """
     A dict-like object passed to every test.
     """
+    # Index of the keys of self.data (of its base, if self was returned by
+    # object_params()) by object name, and the parameters each object
+    # overrides, built on demand and dropped whenever they become stale
+    _object_keys = None
+    _object_overrides = None
+    # Whether self.data is the base of dicts returned by object_params(), in
+    # which case it's copied before being modified
+    _shared = False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("_object_keys", "_object_overrides", "_shared"):
+            state.pop(name, None)
+        return state
+
+
+    def _modify(self):
+        """
+        Prepare self.data to be modified.
+        """
+        if self._shared:
+            self.data = self.data.copy()
+            self._shared = False
+        if not isinstance(self.data, LayeredDict):
+            self._object_keys = None
+        self._object_overrides = None
+
+
+    def __setitem__(self, key, item):
+        self._modify()
+        UserDict.IterableUserDict.__setitem__(self, key, item)
+
+
+    def __delitem__(self, key):
+        self._modify()
+        UserDict.IterableUserDict.__delitem__(self, key)
+
+
+    def clear(self):
+        self._modify()
+        UserDict.IterableUserDict.clear(self)
+
+
+    def update(self, dict=None, **kwargs):
+        self._modify()
+        UserDict.IterableUserDict.update(self, dict, **kwargs)
+
+
+    def pop(self, key, *args):
+        self._modify()
+        return UserDict.IterableUserDict.pop(self, key, *args)
+
+
+    def popitem(self):
+        self._modify()
+        return UserDict.IterableUserDict.popitem(self)
+
+
     def objects(self, key):
         """
         Return the names of objects defined using a given key.
@@ -25,13 +175,47 @@ class Params(UserDict.IterableUserDict):
         The values of keys with the suffix overwrite the values of their
         suffixless versions.
 
+        The returned object doesn't copy the parameters of self, it only
+        holds the ones overwritten for the object on top of them.  Changing
+        either of them doesn't affect the other.
+
         @param obj_name: The name of the object (objects are listed by the
                 objects() method).
         """
-        suffix = "_" + obj_name
-        new_dict = self.copy()
-        for key in self:
-            if key.endswith(suffix):
-                new_key = key.split(suffix)[0]
-                new_dict[new_key] = self[key]
-        return new_dict
+        if isinstance(self.data, LayeredDict):
+            base = self.data.base
+            local = self.data.local
+        else:
+            base = self.data
+            local = {}
+        if self._object_keys is None:
+            # Index every key under each name it could be the suffix of
+            object_keys = {}
+            for key in base:
+                start = key.find("_")
+                while start != -1:
+                    object_keys.setdefault(key[start + 1:], []).append(key)
+                    start = key.find("_", start + 1)
+            self._object_keys = object_keys
+        if self._object_overrides is None:
+            self._object_overrides = {}
+        overrides = self._object_overrides.get(obj_name)
+        if overrides is None:
+            suffix = "_" + obj_name
+            keys = self._object_keys.get(obj_name, [])
+            if local:
+                keys = keys + [key for key in local if key.endswith(suffix)]
+            overrides = {}
+            for key in keys:
+                if key in self.data:
+                    overrides[key.split(suffix)[0]] = self.data[key]
+            self._object_overrides[obj_name] = overrides
+        local = local.copy()
+        local.update(overrides)
+        if base is self.data:
+            self._shared = True
+        new_params = self.__class__()
+        new_params.data = LayeredDict(base, local)
+        # The index of base is shared with the new params
+        new_params._object_keys = self._object_keys
+        return new_params
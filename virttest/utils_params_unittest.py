@@ -0,0 +1,77 @@
+#!/usr/bin/python
+import unittest, cPickle
+import utils_params
+
+
+BASE_DICT = {"image_name": "image", "image_format": "qcow2",
+             "image_name_image1": "image1", "image_size_image2": "20G",
+             "images": "image1 image2", "nic_model": "rtl8139",
+             "nic_model_nic1": "virtio", "nic_mode_nic1_vm2": "tap",
+             "drive_format_image1_vm2": "ide"}
+
+
+class ParamsTest(unittest.TestCase):
+    def setUp(self):
+        self.params = utils_params.Params(BASE_DICT)
+
+
+    def test_object_params(self):
+        image1 = self.params.object_params("image1")
+        self.assertEqual(image1["image_name"], "image1")
+        self.assertEqual(image1["image_format"], "qcow2")
+        self.assertEqual(image1["image_name_image1"], "image1")
+        self.assertFalse("image_size" in image1)
+        self.assertEqual(self.params.object_params("image2")["image_size"],
+                         "20G")
+        self.assertEqual(self.params.object_params("nic1_vm2")["nic_mode"],
+                         "tap")
+        vm2_image1 = self.params.object_params("vm2").object_params("image1")
+        self.assertEqual(vm2_image1["drive_format"], "ide")
+        self.assertEqual(vm2_image1["nic_mode_nic1"], "tap")
+        self.assertEqual(len(vm2_image1), len(BASE_DICT) + 3)
+
+
+    def test_changes(self):
+        image1 = self.params.object_params("image1")
+        image1["image_format"] = "raw"
+        del image1["nic_model"]
+        self.assertEqual(self.params, BASE_DICT)
+        self.assertEqual(self.params.object_params("image1")["image_format"],
+                         "qcow2")
+        self.params["image_name_image1"] = "other"
+        self.params["image_format"] = "vmdk"
+        self.assertEqual(image1["image_name"], "image1")
+        self.assertEqual(image1["image_format"], "raw")
+        self.assertFalse("nic_model" in image1)
+        image1 = self.params.object_params("image1")
+        self.assertEqual(image1["image_name"], "other")
+        self.assertEqual(image1["image_format"], "vmdk")
+
+
+    def test_pickle(self):
+        vm2 = self.params.object_params("vm2")
+        vm2["new"] = "value"
+        vm2 = cPickle.loads(cPickle.dumps(vm2))
+        self.assertEqual(vm2["drive_format_image1"], "ide")
+        self.assertEqual(vm2["new"], "value")
+        self.assertEqual(vm2.object_params("nic1")["nic_mode"], "tap")
+
+
+class LayeredDictTest(unittest.TestCase):
+    def test_changes_stay_local(self):
+        base = {"a": "1", "b": "2"}
+        d = utils_params.LayeredDict(base, {"c": "3"})
+        d["a"] = "changed"
+        del d["b"]
+        e = d.copy()
+        del e["c"]
+        self.assertEqual(base, {"a": "1", "b": "2"})
+        self.assertEqual(d, {"a": "changed", "c": "3"})
+        self.assertEqual(e, {"a": "changed"})
+        self.assertFalse("b" in d)
+        self.assertEqual(len(d), 2)
+        self.assertRaises(KeyError, d.__delitem__, "b")
+
+
+if __name__ == '__main__':
+    unittest.main()
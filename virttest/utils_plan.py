@@ -0,0 +1,258 @@
+"""
+Test plans for the virt test runners.
+
+A test plan is the list of tests generated by a cartesian config, computed
+in a single pass over the config tree.  Runners use it to count, list and
+execute tests without expanding the variants again.  Only the name,
+shortname and dependencies of each test (plus a few keys the runner asks
+for) are kept, the complete params of a test being built again when it runs.
+
+Test dependencies are dotted name prefixes (a test depending on
+'a.b.install' depends on every test whose name is 'a.b.install' or starts
+with 'a.b.install.'), so they are resolved through a trie of name
+components instead of scanning every test name for each dependency.
+
+@copyright: Red Hat 2013
+"""
+
+
+class PlanEntry(object):
+    """
+    A single test of a test plan.
+    """
+    __slots__ = ("index", "name", "shortname", "dep", "info", "path")
+
+    def __init__(self, index, info, path=None):
+        """
+        @param index: Position of the test in the plan (0 based).
+        @param info: A dict with the name, shortname and dep of the test,
+                and possibly other keys.
+        @param path: Path of the test in the cartesian config tree.
+        """
+        self.index = index
+        self.name = info["name"]
+        self.shortname = info["shortname"]
+        self.dep = info.get("dep", [])
+        self.info = info
+        self.path = path
+
+
+    def __repr__(self):
+        return "PlanEntry(%d, %r)" % (self.index, self.name)
+
+
+class _TrieNode(object):
+    __slots__ = ("children", "dependents", "n_tests", "n_passed", "n_failed")
+
+    def __init__(self):
+        self.children = {}
+        # Indexes of the tests that have a dependency naming this node
+        self.dependents = []
+        # Number of tests in this subtree, and how many of them have
+        # been recorded as passed and as failed
+        self.n_tests = 0
+        self.n_passed = 0
+        self.n_failed = 0
+
+
+class DependencyIndex(object):
+    """
+    Index of test names and dependencies, plus the results recorded so far.
+
+    Checking a dependency or finding the tests affected by a result costs
+    O(number of name components) instead of O(number of tests).
+    """
+    def __init__(self, entries):
+        """
+        @param entries: Iterable of PlanEntry objects.
+        """
+        self._root = _TrieNode()
+        self._paths = {}
+        self._status = {}
+        for entry in entries:
+            path = [self._root]
+            node = self._root
+            node.n_tests += 1
+            for component in entry.name.split("."):
+                node = node.children.setdefault(component, _TrieNode())
+                node.n_tests += 1
+                path.append(node)
+            self._paths[entry.index] = path
+            for dep in entry.dep:
+                self._get_node(dep, create=True).dependents.append(entry.index)
+
+
+    def _get_node(self, name, create=False):
+        node = self._root
+        for component in name.split("."):
+            child = node.children.get(component)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[component] = _TrieNode()
+            node = child
+        return node
+
+
+    def record_result(self, index, passed):
+        """
+        Record the result of a test.  Recording a new result for a test
+        replaces the previous one.
+
+        @param index: Plan index of the test.
+        @param passed: Whether the test passed.
+        """
+        previous = self._status.get(index)
+        if previous == passed:
+            return
+        self._status[index] = passed
+        for node in self._paths[index]:
+            if previous is not None:
+                if previous:
+                    node.n_passed -= 1
+                else:
+                    node.n_failed -= 1
+            if passed:
+                node.n_passed += 1
+            else:
+                node.n_failed += 1
+
+
+    def get_result(self, index):
+        """
+        Return the recorded result of a test (True/False), or None if none
+        was recorded yet.
+        """
+        return self._status.get(index)
+
+
+    def dep_failed(self, dep):
+        """
+        Return True if any test matching dep was recorded as failed.
+        """
+        node = self._get_node(dep)
+        return node is not None and node.n_failed > 0
+
+
+    def dep_passed(self, dep):
+        """
+        Return True if all tests matching dep were recorded as passed (also
+        True if no test matches dep).
+        """
+        node = self._get_node(dep)
+        return node is None or node.n_passed == node.n_tests
+
+
+    def get_dependents(self, index):
+        """
+        Return the indexes of the tests that depend on a given test.
+
+        @param index: Plan index of the test.
+        """
+        dependents = []
+        for node in self._paths[index]:
+            dependents.extend(node.dependents)
+        return dependents
+
+
+    def get_related(self, dep):
+        """
+        Return the indexes of the tests that have a dependency matching, or
+        matched by, dep (i.e. a dependency that is a prefix of dep, or that
+        dep is a prefix of).
+        """
+        related = []
+        node = self._root
+        for component in dep.split("."):
+            node = node.children.get(component)
+            if node is None:
+                return related
+            related.extend(node.dependents)
+        pending = node.children.values()
+        while pending:
+            node = pending.pop()
+            related.extend(node.dependents)
+            pending.extend(node.children.values())
+        return related
+
+
+class TestPlan(object):
+    """
+    The ordered list of tests generated by a cartesian config.
+    """
+    def __init__(self, dicts, parser=None):
+        """
+        Materialize the plan.
+
+        @param dicts: Iterable of test dicts, usually parser.get_dicts().
+                If parser is given, iterable of (path, dict) tuples as
+                generated by parser.query(paths=True) instead.
+        @param parser: The cartesian_config.Parser the complete params of
+                each test are built with.  If None, the entries keep the
+                dicts they were built from.
+        """
+        self.parser = parser
+        if parser is None:
+            self.entries = [PlanEntry(i, d) for i, d in enumerate(dicts)]
+        else:
+            self.entries = [PlanEntry(i, d, path)
+                            for i, (path, d) in enumerate(dicts)]
+        self.deps = DependencyIndex(self.entries)
+
+
+    def get_params(self, entry):
+        """
+        Return a new dict with the complete params of a test.
+
+        @param entry: A PlanEntry of this plan.
+        """
+        if self.parser is None:
+            params = entry.info.copy()
+        else:
+            params = self.parser.get_leaf_dict(entry.path)
+        params["dep"] = list(params.get("dep", []))
+        return params
+
+
+    def dependencies_failed(self, entry):
+        """
+        Return True if a test that entry depends on was recorded as failed.
+        """
+        for dep in entry.dep:
+            if self.deps.dep_failed(dep):
+                return True
+        return False
+
+
+    def record_result(self, entry, passed):
+        """
+        Record the result of a test, see DependencyIndex.record_result().
+        """
+        self.deps.record_result(entry.index, passed)
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __iter__(self):
+        return iter(self.entries)
+
+
+    def __getitem__(self, index):
+        return self.entries[index]
+
+
+def get_test_plan(parser, keys=()):
+    """
+    Build the test plan of a cartesian config.
+
+    @param parser: cartesian_config.Parser object, already fed with the
+            config and filters.
+    @param keys: Keys (besides name, shortname and dep) to keep in the info
+            dict of each entry.
+    """
+    if parser.cache_dir and parser.cache_dicts:
+        # The whole expansion is loaded from the cache anyway
+        return TestPlan(parser.get_dicts())
+    return TestPlan(parser.query(keys=keys, paths=True), parser)
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+import unittest
+import utils_plan
+
+
+def make_dicts():
+    return [{"name": "a.install", "shortname": "install", "dep": []},
+            {"name": "a.install.extra", "shortname": "install.extra",
+             "dep": []},
+            {"name": "a.boot", "shortname": "boot", "dep": ["a.install"]},
+            {"name": "a.install_other", "shortname": "install_other",
+             "dep": []},
+            {"name": "a.reboot", "shortname": "reboot",
+             "dep": ["a.install.extra"]},
+            {"name": "b.boot", "shortname": "boot", "dep": ["b.install"]}]
+
+
+class TestPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.plan = utils_plan.TestPlan(make_dicts())
+
+
+    def test_entries(self):
+        self.assertEqual(len(self.plan), 6)
+        entry = self.plan[2]
+        self.assertEqual(entry.index, 2)
+        self.assertEqual(entry.name, "a.boot")
+        self.assertEqual(entry.shortname, "boot")
+        self.assertEqual(entry.dep, ["a.install"])
+        self.assertEqual([e.index for e in self.plan], range(6))
+
+
+    def test_get_test_plan(self):
+        class FakeParser(object):
+            cache_dir = None
+            def query(self, keys, paths):
+                self.keys = keys
+                for i, d in enumerate(make_dicts()):
+                    yield (i,), d
+            def get_leaf_dict(self, path):
+                d = make_dicts()[path[0]]
+                d["built"] = "yes"
+                return d
+        parser = FakeParser()
+        plan = utils_plan.get_test_plan(parser, keys=["skip"])
+        self.assertEqual(parser.keys, ["skip"])
+        self.assertEqual([e.name for e in plan],
+                         [d["name"] for d in make_dicts()])
+        self.assertEqual(plan[4].path, (4,))
+        params = plan.get_params(plan[4])
+        self.assertEqual(params["name"], "a.reboot")
+        self.assertEqual(params["built"], "yes")
+
+
+    def test_get_params(self):
+        params = self.plan.get_params(self.plan[2])
+        self.assertEqual(params, make_dicts()[2])
+        params["dep"].append("b.install")
+        self.assertEqual(self.plan[2].dep, ["a.install"])
+
+
+    def test_dependencies_failed(self):
+        boot = self.plan[2]
+        self.assertFalse(self.plan.dependencies_failed(boot))
+        self.plan.record_result(self.plan[0], True)
+        self.assertFalse(self.plan.dependencies_failed(boot))
+        # 'a.install.extra' is matched by the 'a.install' dependency
+        self.plan.record_result(self.plan[1], False)
+        self.assertTrue(self.plan.dependencies_failed(boot))
+        # Recording a new result replaces the old one
+        self.plan.record_result(self.plan[1], True)
+        self.assertFalse(self.plan.dependencies_failed(boot))
+
+
+    def test_dependency_matches_whole_components(self):
+        self.plan.record_result(self.plan[3], False)
+        self.assertFalse(self.plan.dependencies_failed(self.plan[2]))
+
+
+    def test_unknown_dependency(self):
+        deps = self.plan.deps
+        self.assertFalse(deps.dep_failed("b.install"))
+        self.assertTrue(deps.dep_passed("b.install"))
+
+
+    def test_dep_passed(self):
+        deps = self.plan.deps
+        self.assertFalse(deps.dep_passed("a.install"))
+        deps.record_result(0, True)
+        self.assertFalse(deps.dep_passed("a.install"))
+        deps.record_result(1, True)
+        self.assertTrue(deps.dep_passed("a.install"))
+        self.assertEqual(deps.get_result(1), True)
+        self.assertEqual(deps.get_result(2), None)
+
+
+    def test_get_dependents(self):
+        deps = self.plan.deps
+        self.assertEqual(sorted(deps.get_dependents(0)), [2])
+        self.assertEqual(sorted(deps.get_dependents(1)), [2, 4])
+        self.assertEqual(deps.get_dependents(3), [])
+
+
+    def test_get_related(self):
+        deps = self.plan.deps
+        self.assertEqual(sorted(deps.get_related("a.install")), [2, 4])
+        self.assertEqual(sorted(deps.get_related("a.install.extra")), [2, 4])
+        self.assertEqual(sorted(deps.get_related("a")), [2, 4])
+        self.assertEqual(deps.get_related("c"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
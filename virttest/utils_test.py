@@ -124,9 +124,8 @@ def reboot(vm, session, method="shell", sleep_before_reset=10, nic_index=0,
         logging.info("Monitor command system_reset sent. Waiting for guest to "
                      "go down")
         # Look for RESET QMP events
-        time.sleep(1)
         for m in monitors:
-            if not m.get_event("RESET"):
+            if not m.wait_for_event("RESET", timeout=1):
                 raise error.TestFail("RESET QMP event not received after "
                                      "system_reset (monitor '%s')" % m.name)
             else:
@@ -208,42 +207,6 @@ def migrate(vm, env=None, mig_timeout=3600, mig_protocol="tcp",
     @return: The post-migration VM, in case of same host migration, True in
             case of multi-host migration.
     """
-    def mig_finished():
-        o = vm.monitor.info("migrate")
-        if isinstance(o, str):
-            return "status: active" not in o
-        else:
-            return o.get("status") != "active"
-
-    def mig_succeeded():
-        o = vm.monitor.info("migrate")
-        if isinstance(o, str):
-            return "status: completed" in o
-        else:
-            return o.get("status") == "completed"
-
-    def mig_failed():
-        o = vm.monitor.info("migrate")
-        if isinstance(o, str):
-            return "status: failed" in o
-        else:
-            return o.get("status") == "failed"
-
-    def mig_cancelled():
-        o = vm.monitor.info("migrate")
-        if isinstance(o, str):
-            return ("Migration status: cancelled" in o or
-                    "Migration status: canceled" in o)
-        else:
-            return (o.get("status") == "cancelled" or
-                    o.get("status") == "canceled")
-
-    def wait_for_migration():
-        if not utils_misc.wait_for(mig_finished, mig_timeout, 2, 2,
-                                  "Waiting for migration to finish"):
-            raise error.TestFail("Timeout expired while waiting for migration "
-                                 "to finish")
-
     if dest_host == 'localhost':
         dest_vm = vm.clone()
 
@@ -269,14 +232,13 @@ def migrate(vm, env=None, mig_timeout=3600, mig_protocol="tcp",
 
             if offline:
                 vm.pause()
+            tracker = vm.get_migration_tracker(new=True, check_spice=False)
             vm.monitor.migrate(uri)
 
             if mig_cancel:
                 time.sleep(2)
                 vm.monitor.cmd("migrate_cancel")
-                if not utils_misc.wait_for(mig_cancelled, 60, 2, 2,
-                                          "Waiting for migration "
-                                          "cancellation"):
+                if not (tracker.wait(60) and tracker.cancelled()):
                     raise error.TestFail("Failed to cancel migration")
                 if offline:
                     vm.resume()
@@ -284,7 +246,9 @@ def migrate(vm, env=None, mig_timeout=3600, mig_protocol="tcp",
                     dest_vm.destroy(gracefully=False)
                 return vm
             else:
-                wait_for_migration()
+                if not tracker.wait(mig_timeout):
+                    raise error.TestFail("Timeout expired while waiting for "
+                                         "migration to finish")
                 if (dest_host == 'localhost') and stable_check:
                     save_path = None or "/tmp"
                     save1 = os.path.join(save_path, "src")
@@ -316,9 +280,9 @@ def migrate(vm, env=None, mig_timeout=3600, mig_protocol="tcp",
                 os.remove(save2)
 
     # Report migration status
-    if mig_succeeded():
+    if tracker.succeeded():
         logging.info("Migration finished successfully")
-    elif mig_failed():
+    elif tracker.failed():
         raise error.TestFail("Migration failed")
     else:
         raise error.TestFail("Migration ended with unknown status")
@@ -8,7 +8,8 @@ and tools.
 """
 
 
-import os, time, glob, logging
+import os, time, glob, logging, tempfile, shutil, StringIO
+import screendump_archive
 
 
 __all__ = ['GstPythonVideoMaker', 'video_maker']
@@ -106,6 +107,58 @@ class GstPythonVideoMaker(object):
                 i.resize(image_size).save(f)
 
 
+    def extract_archive(self, archive_dir, output_dir):
+        '''
+        Write the frames of a screendump archive to output_dir as numbered
+        JPEG files of the same size, for multifilesrc.
+
+        Each distinct image in the archive is decoded and resized only once,
+        repeated frames are hardlinks to the first file written for them.
+
+        @return: The number of files written.
+        '''
+        archive = screendump_archive.ScreendumpArchive(archive_dir)
+        index = archive.read_index()
+        # Find the most common image size, counting repeated frames
+        image_sizes = {}
+        frame_counts = {}
+        for _, image_hash in index:
+            frame_counts[image_hash] = frame_counts.get(image_hash, 0) + 1
+        offsets = archive.read_offsets()
+        fin = open(archive.frames_filename, "rb")
+        try:
+            for image_hash, (offset, size) in offsets.items():
+                fin.seek(offset)
+                i = PIL.Image.open(StringIO.StringIO(fin.read(size)))
+                image_sizes[i.size] = (image_sizes.get(i.size, 0) +
+                                       frame_counts.get(image_hash, 0))
+        finally:
+            fin.close()
+        image_size = (800, 600)
+        if image_sizes:
+            image_size = max(image_sizes.items(), key=lambda x: x[1])[0]
+        if self.verbose:
+            logging.debug('Normalizing image files to size: %s', image_size)
+
+        written = {}
+        no_files = 0
+        for _, image_hash, data in archive.get_frames():
+            no_files += 1
+            filename = os.path.join(output_dir, "%04d.jpg" % no_files)
+            if image_hash in written:
+                os.link(written[image_hash], filename)
+                continue
+            i = PIL.Image.open(StringIO.StringIO(data))
+            if i.size != image_size:
+                i.resize(image_size).save(filename, format="JPEG")
+            else:
+                fout = open(filename, "wb")
+                fout.write(data)
+                fout.close()
+            written[image_hash] = filename
+        return no_files
+
+
     def has_element(self, kind):
         '''
         Returns True if a gstreamer element is available
@@ -149,9 +202,31 @@ class GstPythonVideoMaker(object):
     def start(self, input_dir, output_file):
         '''
         Process the input files and output the video file
+
+        input_dir may be either a directory of JPEG files named %04d.jpg or
+        a screendump archive (see screendump_archive).
+        '''
+        if screendump_archive.is_archive(input_dir):
+            # Create the frames next to the archive, not in /tmp
+            parent_dir = os.path.dirname(os.path.abspath(input_dir))
+            frames_dir = tempfile.mkdtemp(prefix="video_maker_",
+                                          dir=parent_dir)
+            try:
+                no_files = self.extract_archive(input_dir, frames_dir)
+                self.encode(frames_dir, no_files, output_file)
+            finally:
+                shutil.rmtree(frames_dir, ignore_errors=True)
+        else:
+            self.normalize_images(input_dir)
+            no_files = len(glob.glob(os.path.join(input_dir, '*.jpg')))
+            self.encode(input_dir, no_files, output_file)
+
+
+    def encode(self, input_dir, no_files, output_file):
+        '''
+        Encode the JPEG files 0001.jpg to <no_files>.jpg in input_dir, all
+        of the same size, into the video file
         '''
-        self.normalize_images(input_dir)
-        no_files = len(glob.glob(os.path.join(input_dir, '*.jpg')))
         if self.verbose:
             logging.debug('Number of files to encode as video: %s', no_files)
 
@@ -20,10 +20,18 @@ be present, the remainder may or may not be provided.  Therefor, virsh
 functions/methods should use the dict.get() method to retrieve with a default
 for non-existant keys.
 
+Module functions called with session_pool=True (and no session_id), as well
+as the methods of Virsh instances created with session_pool=True, run their
+commands through SESSION_POOL, a pool of persistent virsh sessions shared by
+all such callers, so that they don't pay for a new virsh process and libvirtd
+connection each time.  Commands the pool can't run faithfully (e.g. using
+shell syntax, or interactive ones) still run a new virsh process.  See
+VirshSessionPool for how pooled commands differ from one-shot ones.
+
 @copyright: 2012 Red Hat Inc.
 """
 
-import signal, logging, urlparse, re
+import signal, logging, urlparse, re, os, time, threading, tempfile, atexit
 from autotest.client import utils, os_dep
 from autotest.client.shared import error
 import aexpect, propcan
@@ -33,7 +41,7 @@ import aexpect, propcan
 NOCLOSE = globals().keys() + [
     'NOCLOSE', 'SCREENSHOT_ERROR_COUNT', 'VIRSH_COMMAND_CACHE',
     'VIRSH_EXEC', 'VirshBase', 'VirshClosure', 'VirshSession', 'Virsh',
-    'VirshPersistent',
+    'VirshPersistent', 'VirshSessionPool', 'SESSION_POOL',
 ]
 
 # Needs to be in-scope for Virsh* class screenshot method and module function
@@ -55,7 +63,8 @@ class VirshBase(propcan.PropCanBase):
     Base Class storing libvirt Connection & state to a host
     """
 
-    __slots__ = ('uri', 'ignore_status', 'debug', 'virsh_exec')
+    __slots__ = ('uri', 'ignore_status', 'debug', 'virsh_exec',
+                 'session_pool')
 
 
     def __init__(self, *args, **dargs):
@@ -78,6 +87,13 @@ class VirshBase(propcan.PropCanBase):
             self.dict_set('ignore_status', False)
 
 
+    def set_session_pool(self, session_pool):
+        """
+        Enforce setting session_pool as a boolean
+        """
+        self.dict_set('session_pool', bool(session_pool))
+
+
     def set_debug(self, debug):
         """
         Accessor method for 'debug' property that logs message on change
@@ -115,9 +131,16 @@ class VirshSession(aexpect.ShellSession):
     # No way to get virsh sub-command "exit" status
     # Check output against list of known error-status strings
     ERROR_REGEX_LIST = ['error:\s*.+$', '.*failed.*']
+    # When stderr is kept apart, a command failed if it printed an error.
+    # Reconnecting to a restarted libvirtd is reported as an error too, but
+    # the command runs nonetheless.
+    STDERR_ERROR_REGEX = re.compile(r"^error:", re.MULTILINE)
+    STDERR_RECONNECT_REGEX = re.compile(
+                        r"^error:\s*Reconnected to the hypervisor\s*\n?",
+                        re.MULTILINE)
 
     def __init__(self, virsh_exec=None, uri=None, a_id=None,
-                 prompt=r"virsh\s*\#\s*"):
+                 prompt=r"virsh\s*\#\s*", stderr_filename=None):
         """
         Initialize virsh session server, or client if id set.
 
@@ -126,12 +149,19 @@ class VirshSession(aexpect.ShellSession):
         @param: id: ID of an already running server, if accessing a running
                 server, or None if starting a new one.
         @param prompt: Regular expression describing the shell's prompt line.
+        @param stderr_filename: File to append the stderr of virsh to, which
+                lets cmd_result() return it apart from stdout and tell
+                failed commands by it.  Only valid for new sessions.
         """
 
         self.uri = uri
+        self.stderr_filename = stderr_filename
+        self.stderr_offset = 0
 
         if self.uri:
             virsh_exec += " -c '%s'" % self.uri
+        if self.stderr_filename:
+            virsh_exec += " 2>>'%s'" % self.stderr_filename
 
         # aexpect tries to auto close session because no clients connected yet
         aexpect.ShellSession.__init__(self, virsh_exec, a_id, prompt=prompt,
@@ -161,6 +191,10 @@ class VirshSession(aexpect.ShellSession):
         @raise ShellStatusError: Raised if the exit status cannot be obtained
         @raise ShellError: Raised if an unknown error occurs
         """
+        if self.stderr_filename:
+            exit_status, out, _ = self._cmd_status_output_stderr(
+                                cmd, timeout, internal_timeout, print_func)
+            return exit_status, out
         out = self.cmd_output(cmd, timeout, internal_timeout, print_func)
         for line in out.splitlines():
             if self.match_patterns(line, self.ERROR_REGEX_LIST) is not None:
@@ -168,10 +202,52 @@ class VirshSession(aexpect.ShellSession):
         return 0, out
 
 
-    def cmd_result(self, cmd, ignore_status=False):
+    def read_stderr(self):
+        """
+        Return what virsh wrote to stderr since the last call, if the session
+        was started with a stderr_filename.
+        """
+        if not self.stderr_filename:
+            return ""
+        try:
+            stderr_file = open(self.stderr_filename)
+        except IOError:
+            # virsh didn't write anything yet
+            return ""
+        try:
+            stderr_file.seek(self.stderr_offset)
+            data = stderr_file.read()
+        finally:
+            stderr_file.close()
+        self.stderr_offset += len(data)
+        return data
+
+
+    def _cmd_status_output_stderr(self, cmd, timeout=60, internal_timeout=None,
+                                  print_func=None):
+        """
+        Send a virsh command and return its exit status, stdout and stderr,
+        the session having been started with a stderr_filename.
+        """
+        # Drop anything left over by a previous command
+        self.read_stderr()
+        out = self.cmd_output(cmd, timeout, internal_timeout, print_func)
+        err = self.STDERR_RECONNECT_REGEX.sub("", self.read_stderr())
+        if self.STDERR_ERROR_REGEX.search(err):
+            return 1, out, err
+        return 0, out, err
+
+
+    def cmd_result(self, cmd, ignore_status=False, timeout=60,
+                   internal_timeout=None):
         """Mimic utils.run()"""
-        exit_status, stdout = self.cmd_status_output(cmd)
-        stderr = '' # no way to retrieve this separately
+        if self.stderr_filename:
+            exit_status, stdout, stderr = self._cmd_status_output_stderr(
+                                            cmd, timeout, internal_timeout)
+        else:
+            exit_status, stdout = self.cmd_status_output(cmd, timeout,
+                                                         internal_timeout)
+            stderr = '' # no way to retrieve this separately
         result = utils.CmdResult(cmd, stdout, stderr, exit_status)
         if not ignore_status and exit_status:
             raise error.CmdError(cmd, result,
@@ -320,6 +396,233 @@ class VirshPersistent(Virsh):
             # otherwise do nothing
 
 
+class VirshSessionPool(object):
+    """
+    Persistent virsh sessions shared by the module functions called with
+    session_pool=True.
+
+    Sessions are kept per virsh executable and uri, and each one is used by
+    a single caller at a time.  Up to max_sessions of them are opened as
+    needed, past that (or if they can't be opened) commands run in a new
+    virsh process.  Sessions found dead, or that fail while running a
+    command, are replaced by new ones.
+
+    Pooled commands differ from one-shot ones in that:
+        - virsh doesn't report the exit status of the commands of a session,
+          so a command is considered failed (exit status 1) if it printed a
+          line starting with "error:" on stderr.
+        - A session keeps the environment (e.g. LIBVIRT_DEFAULT_URI, when
+          no uri is given) and the libvirt connection it was started with,
+          changes made afterwards don't apply to it.  Call close() to start
+          over with new sessions.
+    """
+    # Seconds to wait for a command to complete, and for more output once
+    # some arrived (the prompt is looked for in between)
+    command_timeout = 600
+    internal_timeout = 0
+    # Seconds to do without new sessions after failing to open one
+    retry_interval = 30
+    # Longer commands are not sent to sessions
+    max_command_length = 2048
+    # Commands not run in sessions as they are interactive, change the
+    # state of the session or may take longer than command_timeout
+    excluded_commands = set((
+            'cd', 'connect', 'console', 'edit', 'event', 'exit', 'quit',
+            'migrate', 'save', 'restore', 'managedsave', 'dump',
+            'blockcopy', 'blockcommit', 'blockpull', 'snapshot-create',
+            'snapshot-create-as', 'snapshot-revert', 'vol-upload',
+            'vol-download', 'vol-wipe', 'vol-clone', 'vol-create-from',
+            'pool-build', 'qemu-monitor-event'))
+    # Characters the shell would interpret (besides quotes and spaces)
+    shell_chars_regex = re.compile(r"[|&;<>()$`\\*?\[\]~{}\t\n]")
+
+    def __init__(self, max_sessions=4):
+        """
+        @param max_sessions: Maximum number of sessions per virsh executable
+                and uri, 0 disables the pool.
+        """
+        self.max_sessions = max_sessions
+        self._reset()
+
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        # Idle sessions, number of sessions and time of the last failure to
+        # open one, by (virsh_exec, uri)
+        self.idle = {}
+        self.count = {}
+        self.failed = {}
+
+
+    def can_run(self, cmd):
+        """
+        Return True if cmd can be run in a pooled session with the same
+        results as in a new virsh process.
+        """
+        words = cmd.split(None, 1)
+        return bool(words and
+                    len(cmd) <= self.max_command_length and
+                    not words[0].startswith("-") and
+                    words[0] not in self.excluded_commands and
+                    not words[0].endswith("-edit") and
+                    not self.shell_chars_regex.search(cmd))
+
+
+    def _open(self, virsh_exec, uri):
+        fd, stderr_filename = tempfile.mkstemp(prefix="virsh_stderr_")
+        os.close(fd)
+        try:
+            # A wide terminal keeps virsh from wrapping long command lines
+            return VirshSession("stty cols 4096 2>/dev/null; exec %s" %
+                                virsh_exec, uri,
+                                stderr_filename=stderr_filename)
+        except Exception:
+            os.unlink(stderr_filename)
+            raise
+
+
+    def _close(self, session):
+        try:
+            session.close()
+        finally:
+            try:
+                os.unlink(session.stderr_filename)
+            except OSError:
+                pass
+
+
+    def checkout(self, virsh_exec, uri):
+        """
+        Return a live session for the exclusive use of the caller, or None
+        if there's none available.  The session must be given back with
+        checkin().
+        """
+        # Sessions of the parent process can't be shared by forked children
+        if os.getpid() != self.pid:
+            self._reset()
+        key = (virsh_exec, uri)
+        dead = []
+        self.lock.acquire()
+        try:
+            session = None
+            idle = self.idle.get(key, [])
+            while idle and session is None:
+                session = idle.pop()
+                if not session.is_alive():
+                    dead.append(session)
+                    self.count[key] -= 1
+                    session = None
+            if (session is None and
+                self.count.get(key, 0) < self.max_sessions and
+                time.time() - self.failed.get(key, 0) > self.retry_interval):
+                # Reserve a place for the new session
+                self.count[key] = self.count.get(key, 0) + 1
+                session = True
+        finally:
+            self.lock.release()
+        for dead_session in dead:
+            logging.debug("Pooled virsh session %s died, closing it",
+                          dead_session.get_id())
+            self._close(dead_session)
+        if session is True:
+            try:
+                session = self._open(virsh_exec, uri)
+            except Exception, e:
+                logging.debug("Could not open a pooled virsh session for uri "
+                              "%s: %s", uri, e)
+                self.lock.acquire()
+                try:
+                    self.count[key] -= 1
+                    self.failed[key] = time.time()
+                finally:
+                    self.lock.release()
+                return None
+        return session
+
+
+    def checkin(self, session, virsh_exec, uri, discard=False):
+        """
+        Give back a session obtained from checkout().
+
+        @param discard: Close the session instead of keeping it.
+        """
+        if os.getpid() != self.pid:
+            return
+        key = (virsh_exec, uri)
+        if not discard and session.is_alive():
+            self.lock.acquire()
+            try:
+                self.idle.setdefault(key, []).append(session)
+            finally:
+                self.lock.release()
+            return
+        self.lock.acquire()
+        try:
+            self.count[key] -= 1
+        finally:
+            self.lock.release()
+        self._close(session)
+
+
+    def run(self, cmd, virsh_exec, uri, ignore_status):
+        """
+        Run a virsh command in a pooled session.
+
+        @return: CmdResult object, or None if no session was available.
+        @raises: CmdError if non-zero exit status and ignore_status=False
+        """
+        session = self.checkout(virsh_exec, uri)
+        if session is None:
+            return None
+        if uri:
+            command_line = "%s -c '%s' %s" % (virsh_exec, uri, cmd)
+        else:
+            command_line = "%s %s" % (virsh_exec, cmd)
+        start = time.time()
+        try:
+            result = session.cmd_result(cmd, ignore_status=True,
+                                        timeout=self.command_timeout,
+                                        internal_timeout=self.internal_timeout)
+        except (aexpect.ShellError, OSError, IOError), e:
+            # Whatever state the session is in, don't reuse it
+            self.checkin(session, virsh_exec, uri, discard=True)
+            result = utils.CmdResult(command_line,
+                                     getattr(e, "output", None) or "",
+                                     "virsh session failed: %s" % e, 1)
+        else:
+            self.checkin(session, virsh_exec, uri)
+            result.command = command_line
+        result.duration = time.time() - start
+        if not ignore_status and result.exit_status:
+            raise error.CmdError(command_line, result,
+                                 "Virsh Command returned non-zero exit status")
+        return result
+
+
+    def close(self):
+        """
+        Close the idle sessions of this process.
+        """
+        if os.getpid() != self.pid:
+            return
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = {}
+            for key, sessions in idle.items():
+                self.count[key] -= len(sessions)
+        finally:
+            self.lock.release()
+        for sessions in idle.values():
+            for session in sessions:
+                self._close(session)
+
+
+SESSION_POOL = VirshSessionPool()
+atexit.register(SESSION_POOL.close)
+
+
 ##### virsh module functions follow (See module docstring for API) #####
 
 
@@ -358,12 +661,19 @@ def command(cmd, **dargs):
     if debug:
         logging.debug("Running virsh command: %s", cmd)
 
+    ret = None
     if session:
         # Utilize persistant virsh session
         ret = session.cmd_result(cmd, ignore_status)
         # Mark return value with session it came from
         ret.from_session_id = session_id
-    else:
+    elif (dargs.get('session_pool', False) and not session_id and
+          SESSION_POOL.can_run(cmd)):
+        # Use a session of the pool, if there's one available
+        ret = SESSION_POOL.run(cmd, virsh_exec, uri, ignore_status)
+        if ret is not None:
+            ret.from_session_id = None
+    if ret is None:
         # Normal call to run virsh command
         if uri:
             # uri argument IS being used
@@ -1,8 +1,9 @@
 #!/usr/bin/python
 
-import unittest, logging
+import unittest, logging, os, sys, tempfile, shutil
 import common
 from autotest.client import utils
+from autotest.client.shared import error
 
 class ModuleLoad(unittest.TestCase):
     import virsh
@@ -242,5 +243,135 @@ class VirshPersistentClassHasHelpCommandTest(VirshHasHelpCommandTest):
         self.assertFalse(utils.process_is_alive(self.virsh.virsh_exec))
 
 
+# Mimics an interactive virsh shell, echoing commands as readline does
+FAKE_VIRSH = """#!%s
+import sys, os
+args = sys.argv[1:]
+if args[:2] == ["-c", "test:///default"]:
+    args = args[2:]
+if args:
+    print "oneshot " + " ".join(args)
+    sys.exit(0)
+while True:
+    sys.stdout.write("virsh # ")
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line:
+        break
+    sys.stdout.write(line)
+    words = line.split()
+    if words == ["fail"]:
+        sys.stderr.write("error: failed to get domain 'x'\\n")
+    elif words == ["pid"]:
+        sys.stderr.write("error: Reconnected to the hypervisor\\n")
+        print os.getpid()
+    elif words == ["exit"]:
+        sys.exit(1)
+    else:
+        print "shell " + " ".join(words)
+"""
+
+
+class VirshSessionPoolTest(ModuleLoad):
+
+    def setUp(self):
+        logging.disable(logging.INFO)
+        self.tmpdir = tempfile.mkdtemp()
+        self.virsh_exec = os.path.join(self.tmpdir, "virsh")
+        fake_virsh = open(self.virsh_exec, "w")
+        fake_virsh.write(FAKE_VIRSH % sys.executable)
+        fake_virsh.close()
+        os.chmod(self.virsh_exec, 0755)
+        self.pool = self.virsh.VirshSessionPool(max_sessions=1)
+        self.key = (self.virsh_exec, "test:///default")
+
+
+    def run_cmd(self, cmd, ignore_status=True):
+        return self.pool.run(cmd, self.virsh_exec, "test:///default",
+                             ignore_status)
+
+
+    def test_run(self):
+        result = self.run_cmd("domstate vm1")
+        self.assertEqual(result.stdout, "shell domstate vm1\n")
+        self.assertEqual(result.exit_status, 0)
+        result = self.run_cmd("fail")
+        self.assertEqual(result.exit_status, 1)
+        self.assertEqual(result.stderr, "error: failed to get domain 'x'\n")
+        self.assertRaises(error.CmdError, self.run_cmd, "fail", False)
+        # The session is reused, and reconnecting is not an error
+        result = self.run_cmd("pid")
+        self.assertEqual(result.stderr, "")
+        self.assertEqual(result.exit_status, 0)
+        self.assertEqual(self.run_cmd("pid").stdout, result.stdout)
+        self.assertEqual(self.pool.count[self.key], 1)
+
+
+    def test_busy(self):
+        session = self.pool.checkout(self.virsh_exec, "test:///default")
+        self.assertEqual(self.run_cmd("list"), None)
+        self.pool.checkin(session, self.virsh_exec, "test:///default")
+        self.assertEqual(self.run_cmd("list").stdout, "shell list\n")
+
+
+    def test_dead_session(self):
+        pid = self.run_cmd("pid").stdout
+        self.assertEqual(self.run_cmd("exit").exit_status, 1)
+        self.assertNotEqual(self.run_cmd("pid").stdout, pid)
+        self.assertEqual(self.pool.count[self.key], 1)
+
+
+    def test_command(self):
+        self.assertTrue(self.pool.can_run("dumpxml vm1"))
+        self.assertFalse(self.pool.can_run("dumpxml vm1 > /tmp/vm1.xml"))
+        self.assertFalse(self.pool.can_run("console vm1"))
+        self.assertFalse(self.pool.can_run("net-edit default"))
+        result = self.virsh.command("dumpxml vm1 | cat",
+                                    virsh_exec=self.virsh_exec,
+                                    uri="test:///default", session_pool=True)
+        self.assertEqual(result.stdout, "oneshot dumpxml vm1\n")
+
+
+    def test_opt_in(self):
+        # The pool is only used when asked for
+        result = self.virsh.command("dumpxml vm1",
+                                    virsh_exec=self.virsh_exec,
+                                    uri="test:///default")
+        self.assertEqual(result.stdout, "oneshot dumpxml vm1\n")
+        virsh = self.virsh.Virsh(virsh_exec=self.virsh_exec,
+                                 uri="test:///default", session_pool=True)
+        try:
+            self.assertEqual(virsh.command("dumpxml vm1").stdout,
+                             "shell dumpxml vm1\n")
+        finally:
+            self.virsh.SESSION_POOL.close()
+
+
+    def test_libvirt_vm(self):
+        # libvirt_vm polls the state of VMs through the pool
+        import libvirt_vm
+        vm = libvirt_vm.VM.__new__(libvirt_vm.VM)
+        vm.name = "vm1"
+        vm.connect_uri = "test:///default"
+        virsh_exec = self.virsh.VIRSH_EXEC
+        self.virsh.VIRSH_EXEC = self.virsh_exec
+        try:
+            self.assertEqual(vm.state(), "shell domstate vm1")
+            self.assertEqual(vm.get_id(), "shell domid vm1")
+            self.assertEqual(vm.get_xml(), "shell dumpxml vm1")
+            self.assertTrue(vm.is_dead())
+            self.assertTrue(vm.wait_for_shutdown(count=5))
+            self.assertEqual(self.virsh.SESSION_POOL.count[self.key], 1)
+        finally:
+            self.virsh.VIRSH_EXEC = virsh_exec
+            self.virsh.SESSION_POOL.close()
+
+
+    def tearDown(self):
+        self.pool.close()
+        self.assertEqual(self.pool.count.get(self.key, 0), 0)
+        shutil.rmtree(self.tmpdir)
+
+
 if __name__ == '__main__':
     unittest.main()